@@ -2,55 +2,154 @@ import os
 import json
 import logging
 import random
+import re
 import aiohttp
 import asyncio
 import traceback
-from typing import Optional, List, Dict
+import time
+from typing import Optional, List, Dict, Tuple
 from datetime import datetime
 from aiogram import Bot
 import base64
+import math
+import hashlib
+import copy
+from fetch_utils import PooledHttpClient, evict_cache_files
+from token_budget import estimate_tokens, estimate_raw_tokens, pack_posts, token_calibration
 logger = logging.getLogger(__name__)
 MONICA_MODELS = {
     "gpt-4o": {
         "name": "GPT-4 Optimized",
         "description": "Оптимизированная версия GPT-4",
-        "max_tokens": "8,000"
+        "max_tokens": "8,000",
+        "context_tokens": 128000
     },
     "claude-3-5-sonnet-20241022": {
         "name": "Claude 3.5 Sonnet", 
         "description": "Мощная модель с большим контекстом",
-        "max_tokens": "200,000"
+        "max_tokens": "200,000",
+        "context_tokens": 200000
     },
     "claude-3-haiku-20240307": {
         "name": "Claude 3 Haiku",
         "description": "Быстрая и эффективная модель Claude 3",
-        "max_tokens": "4000"
+        "max_tokens": "4000",
+        "context_tokens": 200000
     },
     "o1-mini": {
         "name": "O1 Mini",
         "description": "Компактная и быстрая модель",
-        "max_tokens": "2,000"
+        "max_tokens": "2,000",
+        "context_tokens": 128000
     }
 }
 OPENROUTER_MODELS = {
     "anthropic/claude-3-7-sonnet": {
         "name": "Claude 3.7 Sonnet",
         "description": "Мощная модель с модерацией контента и большим контекстом",
-        "max_tokens": "200,000"
+        "max_tokens": "200,000",
+        "context_tokens": 200000
     },
     "anthropic/claude-3-7-sonnet:thinking": {
         "name": "Claude 3.7 Sonnet (Thinking)",
         "description": "Версия с расширенным режимом рассуждений для сложных задач",
-        "max_tokens": "200,000"
+        "max_tokens": "200,000",
+        "context_tokens": 200000
     },
     "anthropic/claude-3-7-sonnet:beta": {
         "name": "Claude 3.7 Sonnet (Beta)",
         "description": "Версия без модерации контента с полным доступом",
-        "max_tokens": "200,000"
+        "max_tokens": "200,000",
+        "context_tokens": 200000
     }
 }
 user_models: Dict[int, str] = {}
 user_model_services: Dict[int, str] = {}
+PROVIDER_POOL_LIMIT = int(os.getenv('PROVIDER_POOL_LIMIT', '20'))
+PROVIDER_KEEPALIVE_TIMEOUT = int(os.getenv('PROVIDER_KEEPALIVE_TIMEOUT', '120'))
+def create_provider_client(name: str) -> PooledHttpClient:
+    """Долгоживущая сессия к одному провайдеру: ответы моделей могут идти минутами, общего таймаута нет"""
+    return PooledHttpClient(
+        name,
+        {'limit': PROVIDER_POOL_LIMIT, 'keepalive_timeout': PROVIDER_KEEPALIVE_TIMEOUT},
+        timeout=aiohttp.ClientTimeout(total=None)
+    )
+provider_clients: Dict[str, PooledHttpClient] = {
+    "monica": create_provider_client("monica"),
+    "openrouter": create_provider_client("openrouter")
+}
+def get_provider_session(service: str) -> aiohttp.ClientSession:
+    return provider_clients[service].get_session()
+def get_provider_stats() -> dict:
+    return {service: client.get_stats() for service, client in provider_clients.items()}
+async def start_provider_clients():
+    for client in provider_clients.values():
+        client.get_session()
+    logger.info(f"Созданы сессии провайдеров: {', '.join(provider_clients)}")
+async def close_provider_clients():
+    for client in provider_clients.values():
+        await client.close()
+LLM_STREAMING_ENABLED = os.getenv('LLM_STREAMING_ENABLED', '1') == '1'
+STREAM_STATUS_INTERVAL = float(os.getenv('STREAM_STATUS_INTERVAL', '3'))
+STREAM_STATUS_TAIL = 1000
+async def read_sse_completion(response: aiohttp.ClientResponse, status_message=None, provider: str = "") -> dict:
+    """
+    Читает потоковый ответ (SSE) chat/completions и собирает текст из дельт.
+    Строки-комментарии (начинаются с ':') пропускаются. Не чаще раза в STREAM_STATUS_INTERVAL
+    секунд в статусное сообщение выводится конец уже полученного текста.
+    """
+    parts = []
+    received = 0
+    model = None
+    usage = None
+    start_time = time.monotonic()
+    first_token_at = None
+    last_status_at = start_time
+    shown = 0
+    async for raw_line in response.content:
+        line = raw_line.decode('utf-8', errors='replace').strip()
+        if not line or line.startswith(':') or not line.startswith('data:'):
+            continue
+        payload = line[5:].strip()
+        if payload == '[DONE]':
+            break
+        try:
+            event = json.loads(payload)
+        except json.JSONDecodeError:
+            logger.warning(f"{provider}: не удалось разобрать событие потока: {payload[:200]}")
+            continue
+        if event.get('error'):
+            error = event['error']
+            raise Exception(f"Ошибка в потоке ответа {provider}: {error.get('message', error) if isinstance(error, dict) else error}")
+        model = event.get('model') or model
+        usage = event.get('usage') or usage
+        for choice in event.get('choices') or []:
+            content = (choice.get('delta') or {}).get('content')
+            if content:
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                parts.append(content)
+                received += len(content)
+        now = time.monotonic()
+        if status_message and received > shown and now - last_status_at >= STREAM_STATUS_INTERVAL:
+            last_status_at = now
+            shown = received
+            tail = ''.join(parts)[-STREAM_STATUS_TAIL:]
+            try:
+                await status_message.edit_text(f"✍️ {provider} пишет отчет ({received} символов)...\n\n…{tail}")
+            except Exception as e:
+                logger.debug(f"Не удалось обновить статус потоковой генерации: {e}")
+    elapsed = time.monotonic() - start_time
+    time_to_first_token = first_token_at - start_time if first_token_at is not None else None
+    if time_to_first_token is not None:
+        logger.info(f"{provider}: первый токен через {time_to_first_token:.2f} с, ответ {received} символов за {elapsed:.2f} с")
+    return {
+        'content': ''.join(parts),
+        'model': model,
+        'usage': usage,
+        'time_to_first_token': time_to_first_token,
+        'elapsed': elapsed
+    }
 def get_available_models():
     all_models = {**MONICA_MODELS, **OPENROUTER_MODELS}
     return all_models
@@ -83,7 +182,7 @@ def get_user_model_service(user_id: int) -> str:
     else:
         service = "monica"
     return service
-async def try_gpt_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict):
+async def try_gpt_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict, quiet: bool = False):
     service = get_user_model_service(user_id)
     selected_model = get_user_model(user_id)
     if service == "monica" and selected_model not in MONICA_MODELS:
@@ -99,21 +198,240 @@ async def try_gpt_request(prompt: str, posts_text: str, user_id: int, bot: Bot,
     service = get_user_model_service(user_id)
     selected_model = get_user_model(user_id)
     if service == "monica":
-        return await try_monica_request(prompt, posts_text, user_id, bot, user_data)
+        request_func = try_monica_request
     elif service == "openrouter":
-        return await try_openrouter_request(prompt, posts_text, user_id, bot, user_data)
+        request_func = try_openrouter_request
     else:
         error_msg = f"❌ Неизвестный сервис модели: {service}"
         logger.error(error_msg)
         raise Exception(error_msg)
-async def try_monica_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict):
+    input_limit = get_model_input_limit(selected_model)
+    estimated_tokens = estimate_tokens(prompt, selected_model) + estimate_tokens(posts_text, selected_model)
+    if posts_text and estimated_tokens > input_limit:
+        logger.info(f"Оценка входа {estimated_tokens} токенов больше лимита {input_limit} для {selected_model}, включаю map-reduce")
+        return await try_map_reduce_request(prompt, posts_text, user_id, bot, user_data, request_func, selected_model, quiet)
+    return await request_func(prompt, posts_text, user_id, bot, user_data, quiet=quiet)
+MAP_REDUCE_INPUT_SHARE = float(os.getenv('MAP_REDUCE_INPUT_SHARE', '0.6'))
+MAP_REDUCE_CONCURRENCY = int(os.getenv('MAP_REDUCE_CONCURRENCY', '3'))
+MAP_REDUCE_MAX_CHUNKS = int(os.getenv('MAP_REDUCE_MAX_CHUNKS', '8'))
+IMAGE_TOKEN_COST = int(os.getenv('IMAGE_TOKEN_COST', '1600'))
+SYSTEM_PROMPT_TOKENS = 1000
+# Контекст модели, для которой не указан context_tokens
+DEFAULT_CONTEXT_TOKENS = int(os.getenv('DEFAULT_CONTEXT_TOKENS', '8000'))
+POSTS_SEPARATOR = "\n\n---\n\n"
+MAP_PROMPT = ("Это часть данных для аналитического отчета, остальные части обрабатываются отдельно. "
+              "Сожми ее: перечисли все значимые новости и факты с датами, цифрами, именами и источниками, "
+              "без выводов и рекомендаций. Пиши кратко, без вступлений.")
+def get_model_input_limit(model: str) -> int:
+    """Сколько токенов входа отдаем одному запросу: доля MAP_REDUCE_INPUT_SHARE от контекста модели"""
+    model_info = get_available_models().get(model, {})
+    return int(model_info.get('context_tokens', DEFAULT_CONTEXT_TOKENS) * MAP_REDUCE_INPUT_SHARE)
+LLM_CACHE_DIR = os.getenv('LLM_CACHE_DIR', 'llm_cache')
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', '3600'))
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+TIMESTAMP_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
+# Начало требований к формату отчета, которые main.py добавляет к промпту
+FORMAT_INSTRUCTIONS_PREFIX = "\n\nФОРМАТ ОТВЕТА:"
+FORMAT_INSTRUCTIONS_PATTERN = re.compile(re.escape(FORMAT_INSTRUCTIONS_PREFIX) + r'[^\n]*')
+class ResponseCache:
+    """
+    Дисковый кэш ответов моделей с временем жизни и вытеснением давно не использованных
+    записей (LRU по времени последнего обращения), когда кэш превышает max_bytes.
+    """
+    def __init__(self, directory: str, ttl: int, max_bytes: int):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+    def get(self, key: str) -> Optional[str]:
+        path = self.get_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if time.time() - entry['created_at'] > self.ttl:
+                os.remove(path)
+                self.misses += 1
+                return None
+            # Время последнего обращения хранится в mtime файла
+            os.utime(path)
+            self.hits += 1
+            return entry['content']
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать кэш ответа {key}: {e}")
+            self.misses += 1
+            return None
+    def put(self, key: str, model: str, content: str):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.get_path(key), 'w', encoding='utf-8') as f:
+                json.dump({'model': model, 'created_at': time.time(), 'content': content}, f, ensure_ascii=False)
+            self.evict()
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить ответ в кэш: {e}")
+    def evict(self):
+        removed, _ = evict_cache_files(self.directory, self.ttl, self.max_bytes)
+        self.evictions += removed
+    def get_stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+llm_response_cache = ResponseCache(LLM_CACHE_DIR, LLM_CACHE_TTL, LLM_CACHE_MAX_BYTES)
+def normalize_cache_text(text: str) -> str:
+    return TIMESTAMP_PATTERN.sub('', FORMAT_INSTRUCTIONS_PATTERN.sub('', text))
+def get_llm_cache_key(data: dict) -> str:
+    """
+    Ключ кэша по телу запроса: модель, системный промпт, промпт пользователя, данные и
+    настройки плагинов. Не учитываются метки времени (текущее время в промптах и время
+    загрузки страниц сайтов меняются от запуска к запуску) и требования к формату отчета,
+    чтобы отчет в другом формате строился из того же ответа модели.
+    """
+    key_data = copy.deepcopy({key: value for key, value in data.items() if key not in ('stream', 'stream_options')})
+    for message in key_data.get('messages', []):
+        if isinstance(message.get('content'), str):
+            message['content'] = normalize_cache_text(message['content'])
+        else:
+            for item in message.get('content', []):
+                if item.get('type') == 'text':
+                    item['text'] = normalize_cache_text(item['text'])
+    for plugin in key_data.get('plugins', []):
+        if 'search_prompt' in plugin:
+            plugin['search_prompt'] = TIMESTAMP_PATTERN.sub('', plugin['search_prompt'])
+    return hashlib.sha256(json.dumps(key_data, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+def lookup_cached_response(data: dict) -> Tuple[str, Optional[str]]:
+    cache_key = get_llm_cache_key(data)
+    return cache_key, llm_response_cache.get(cache_key)
+async def get_cached_response(data: dict, model: str) -> Tuple[str, Optional[str]]:
+    # Хэширование тела запроса и чтение файла кэша не должны блокировать цикл событий
+    cache_key, cached_response = await asyncio.to_thread(lookup_cached_response, data)
+    if cached_response is not None:
+        logger.info(f"Ответ модели {model} взят из кэша, статистика кэша: {llm_response_cache.get_stats()}")
+    return cache_key, cached_response
+def get_text_budget(model: str) -> int:
+    return get_model_input_limit(model) * MAP_REDUCE_MAX_CHUNKS
+def get_image_budget(model: str, prompt: str) -> int:
+    return get_model_input_limit(model) - estimate_tokens(prompt, model) - SYSTEM_PROMPT_TOKENS
+def get_post_photo_paths(post: dict) -> List[str]:
+    """Пути к скачанным фото поста: photo_paths у постов каналов (все фото альбома), иначе одиночный photo_path"""
+    if post.get('photo_paths'):
+        return post['photo_paths']
+    return [post['photo_path']] if post.get('photo_path') else []
+def estimate_post_tokens(post: dict, model: str, with_images: bool = False) -> int:
+    tokens = estimate_tokens(f"[{post.get('date', '')}]\n{post.get('text', '')}", model) if post.get('has_text') else 10
+    if with_images and post.get('has_photo'):
+        tokens += IMAGE_TOKEN_COST * max(len(post.get('photo_refs') or []), len(get_post_photo_paths(post)))
+    return tokens
+def pack_posts_for_model(posts: list, prompt: str, model: str, with_images: bool = False):
+    """
+    Оставляет посты, помещающиеся в бюджет модели. Для текста бюджет - MAP_REDUCE_MAX_CHUNKS
+    частей map-reduce, для изображений - один запрос с учетом стоимости каждого изображения.
+    """
+    budget = get_image_budget(model, prompt) if with_images else get_text_budget(model)
+    return pack_posts(posts, budget, lambda post: estimate_post_tokens(post, model, with_images))
+def get_messages_text(messages: list) -> str:
+    parts = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(item.get('text', '') for item in content if item.get('type') == 'text')
+    return "\n".join(parts)
+def record_token_usage(model: str, messages: list, usage: Optional[dict]):
+    """
+    Уточняет коэффициент оценки токенов модели по usage из ответа провайдера
+
+    Вызывается только для текстовых запросов: в запросах с изображениями prompt_tokens
+    включает стоимость картинок, которая зависит от провайдера и размера фото, и сдвинула бы
+    коэффициент для текста.
+    """
+    if usage and usage.get('prompt_tokens'):
+        token_calibration.update(model, estimate_raw_tokens(get_messages_text(messages)), usage['prompt_tokens'])
+def split_posts_text(posts_text: str, max_tokens: int, model: Optional[str] = None) -> List[str]:
+    max_tokens = max(max_tokens, 500)
+    separator_tokens = estimate_tokens(POSTS_SEPARATOR, model)
+    chunks = []
+    current = []
+    current_tokens = 0
+    for post in posts_text.split(POSTS_SEPARATOR):
+        post_tokens = estimate_tokens(post, model)
+        # Слишком длинный пост режем на части примерно по max_tokens
+        parts = max(1, math.ceil(post_tokens / max_tokens))
+        piece_chars = max(1, math.ceil(len(post) / parts))
+        for start in range(0, max(len(post), 1), piece_chars):
+            piece = post[start:start + piece_chars]
+            piece_tokens = post_tokens if parts == 1 else estimate_tokens(piece, model)
+            if current and current_tokens + piece_tokens + separator_tokens > max_tokens:
+                chunks.append(POSTS_SEPARATOR.join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens + separator_tokens
+    if current:
+        chunks.append(POSTS_SEPARATOR.join(current))
+    return chunks
+async def try_map_reduce_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict,
+                                 request_func, model: str, quiet: bool = False):
+    """
+    Анализ данных, не помещающихся в контекст модели: части сжимаются параллельно (map),
+    затем промпт пользователя применяется к сводкам частей (reduce).
+    """
+    input_limit = get_model_input_limit(model)
+    chunks = split_posts_text(posts_text, input_limit - estimate_tokens(MAP_PROMPT, model) - SYSTEM_PROMPT_TOKENS, model)
+    status_message = None if quiet else await bot.send_message(
+        user_id,
+        f"📚 Данных слишком много для одного запроса (~{estimate_tokens(posts_text, model)} токенов)\n"
+        f"Анализирую по частям: {len(chunks)}"
+    )
+    semaphore = asyncio.Semaphore(MAP_REDUCE_CONCURRENCY)
+    completed = 0
+    async def summarize(chunk: str) -> str:
+        nonlocal completed
+        async with semaphore:
+            # Веб-поиск нужен только итоговому запросу, сжатие частей обходится без него
+            summary = await request_func(MAP_PROMPT, chunk, user_id, bot, user_data, quiet=True, web_search=False)
+        completed += 1
+        if status_message:
+            try:
+                await status_message.edit_text(f"📚 Анализирую по частям: готово {completed} из {len(chunks)}")
+            except Exception as e:
+                logger.debug(f"Не удалось обновить статус map-reduce: {e}")
+        return summary
+    start_time = time.monotonic()
+    results = await asyncio.gather(*(summarize(chunk) for chunk in chunks), return_exceptions=True)
+    summaries = []
+    for index, result in enumerate(results, 1):
+        if isinstance(result, Exception):
+            logger.error(f"Не удалось обработать часть {index} из {len(chunks)}: {result}")
+        elif result:
+            summaries.append(f"Сводка части {index} из {len(chunks)}:\n{result}")
+    logger.info(f"Map-reduce: обработано частей {len(summaries)} из {len(chunks)} за {time.monotonic() - start_time:.2f} с")
+    if status_message:
+        await status_message.delete()
+    if not summaries:
+        raise Exception("❌ Не удалось обработать ни одной части данных")
+    reduce_prompt = (f"{prompt}\n\nДанные ниже - сводки частей исходных материалов, подготовленные заранее. "
+                     f"Анализируй их как единый набор данных.")
+    if len(summaries) < len(chunks):
+        reduce_prompt += f" Часть материалов ({len(chunks) - len(summaries)} из {len(chunks)}) обработать не удалось."
+    reduce_text = POSTS_SEPARATOR.join(summaries)
+    if len(reduce_text) >= len(posts_text):
+        raise Exception("❌ Не удалось сжать данные до размера контекста модели")
+    # Если сводки все еще не помещаются, try_gpt_request сожмет их еще раз
+    return await try_gpt_request(reduce_prompt, reduce_text, user_id, bot, user_data, quiet)
+async def try_monica_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict, quiet: bool = False,
+                             web_search: bool = False):
     status_message = None
     try:
         text_length = len(posts_text)
         selected_model = get_user_model(user_id)
         model_info = MONICA_MODELS[selected_model]
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        status_message = await bot.send_message(
+        status_message = None if quiet else await bot.send_message(
             user_id,
             f"🔄 Начинаю анализ...\n"
             f"Размер данных: {text_length} символов\n"
@@ -175,6 +493,15 @@ async def try_monica_request(prompt: str, posts_text: str, user_id: int, bot: Bo
             "model": selected_model,
             "messages": messages
         }
+        if LLM_STREAMING_ENABLED:
+            data["stream"] = True
+            # Без include_usage OpenAI-совместимые провайдеры не присылают usage в потоке
+            data["stream_options"] = {"include_usage": True}
+        cache_key, cached_response = await get_cached_response(data, selected_model)
+        if cached_response is not None:
+            if status_message:
+                await status_message.delete()
+            return cached_response
         if status_message:
             await status_message.edit_text(
                 f"🔄 Отправляю запрос к Monica AI...\n"
@@ -184,34 +511,46 @@ async def try_monica_request(prompt: str, posts_text: str, user_id: int, bot: Bo
             )
         logger.info(f"Отправляем запрос к Monica API, модель: {selected_model}, размер данных: {text_length}")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    "https://openapi.monica.im/v1/chat/completions",
-                    headers=headers,
-                    json=data,
-                    timeout=None
-                ) as response:
-                    response_text = await response.text()
-                    logger.info(f"Получен ответ от Monica API, статус: {response.status}")
-                    if response.status == 200:
-                        try:
-                            result = json.loads(response_text)
-                            response_text = result['choices'][0]['message']['content']
-                            if status_message:
-                                await status_message.delete()
-                            return response_text
-                        except (json.JSONDecodeError, KeyError, IndexError) as e:
-                            error_msg = f"❌ Ошибка при обработке ответа от Monica AI: {str(e)}, ответ: {response_text[:200]}..."
-                            logger.error(error_msg)
-                            if status_message:
-                                await status_message.edit_text(error_msg)
-                            raise Exception(error_msg)
-                    else:
-                        error_msg = f"❌ Ошибка Monica API ({response.status}): {response_text[:200]}..."
+            session = get_provider_session("monica")
+            async with session.post(
+                "https://openapi.monica.im/v1/chat/completions",
+                headers=headers,
+                json=data,
+                timeout=None
+            ) as response:
+                if response.status == 200 and response.content_type == 'text/event-stream':
+                    logger.info(f"Monica API начал потоковый ответ, соединения: {provider_clients['monica'].get_stats()}")
+                    result = await read_sse_completion(response, status_message, "Monica AI")
+                    if not result['content']:
+                        raise Exception("Monica AI вернула пустой ответ")
+                    record_token_usage(selected_model, messages, result['usage'])
+                    await asyncio.to_thread(llm_response_cache.put, cache_key, selected_model, result['content'])
+                    if status_message:
+                        await status_message.delete()
+                    return result['content']
+                response_text = await response.text()
+                logger.info(f"Получен ответ от Monica API, статус: {response.status}, соединения: {provider_clients['monica'].get_stats()}")
+                if response.status == 200:
+                    try:
+                        result = json.loads(response_text)
+                        response_text = result['choices'][0]['message']['content']
+                        record_token_usage(selected_model, messages, result.get('usage'))
+                        await asyncio.to_thread(llm_response_cache.put, cache_key, selected_model, response_text)
+                        if status_message:
+                            await status_message.delete()
+                        return response_text
+                    except (json.JSONDecodeError, KeyError, IndexError) as e:
+                        error_msg = f"❌ Ошибка при обработке ответа от Monica AI: {str(e)}, ответ: {response_text[:200]}..."
                         logger.error(error_msg)
                         if status_message:
                             await status_message.edit_text(error_msg)
                         raise Exception(error_msg)
+                else:
+                    error_msg = f"❌ Ошибка Monica API ({response.status}): {response_text[:200]}..."
+                    logger.error(error_msg)
+                    if status_message:
+                        await status_message.edit_text(error_msg)
+                    raise Exception(error_msg)
         except asyncio.TimeoutError:
             error_msg = f"❌ Превышено время ожидания ответа от Monica AI. Возможно, запрос слишком большой или сервер перегружен."
             logger.error(error_msg)
@@ -231,7 +570,8 @@ async def try_monica_request(prompt: str, posts_text: str, user_id: int, bot: Bo
         if status_message:
             await status_message.edit_text(error_msg)
         raise Exception(error_msg)
-async def try_openrouter_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict):
+async def try_openrouter_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict, quiet: bool = False,
+                                 web_search: bool = True):
     status_message = None
     try:
         text_length = len(posts_text)
@@ -244,11 +584,11 @@ async def try_openrouter_request(prompt: str, posts_text: str, user_id: int, bot
             user_data.save()
         model_info = OPENROUTER_MODELS[selected_model]
         user_settings = user_data.get_user_data(user_id)
-        web_search_enabled = user_settings['ai_settings'].get('web_search_enabled', False)
+        web_search_enabled = web_search and user_settings['ai_settings'].get('web_search_enabled', False)
         web_search_results = user_settings['ai_settings'].get('web_search_results', 3)
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         web_info = "🔍 С поиском в интернете" if web_search_enabled else ""
-        status_message = await bot.send_message(
+        status_message = None if quiet else await bot.send_message(
             user_id,
             f"🔄 Начинаю анализ...\n"
             f"Размер данных: {text_length} символов\n"
@@ -304,6 +644,10 @@ async def try_openrouter_request(prompt: str, posts_text: str, user_id: int, bot
             "messages": messages
         }
         data["models"] = [selected_model]
+        if LLM_STREAMING_ENABLED:
+            data["stream"] = True
+            # Без include_usage OpenAI-совместимые провайдеры не присылают usage в потоке
+            data["stream_options"] = {"include_usage": True}
         logger.info(f"Используем только основную модель без резервных: {selected_model}")
         if web_search_enabled:
             data["plugins"] = [{
@@ -312,6 +656,11 @@ async def try_openrouter_request(prompt: str, posts_text: str, user_id: int, bot
                 "search_prompt": f"Поиск в интернете был проведен {current_time}. Используй следующие результаты поиска для обоснования своего ответа. ВАЖНО: Цитируй источники, используя формат markdown [домен.com](ссылка)."
             }]
             logger.info(f"Веб-поиск активирован, max_results: {web_search_results}")
+        cache_key, cached_response = await get_cached_response(data, selected_model)
+        if cached_response is not None:
+            if status_message:
+                await status_message.delete()
+            return cached_response
         web_info_status = "🔍 Веб-поиск включен" if web_search_enabled else ""
         if status_message:
             await status_message.edit_text(
@@ -323,58 +672,72 @@ async def try_openrouter_request(prompt: str, posts_text: str, user_id: int, bot
             )
         logger.info(f"Отправляем запрос к OpenRouter API, модель: {selected_model}, размер данных: {text_length}, веб-поиск: {web_search_enabled}")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    headers=headers,
-                    json=data,
-                    timeout=None
-                ) as response:
-                    response_text = await response.text()
-                    logger.info(f"Получен ответ от OpenRouter API, статус: {response.status}")
-                    if response.status == 200:
-                        try:
-                            result = json.loads(response_text)
-                            response_text = result['choices'][0]['message']['content']
-                            used_model = result.get('model', selected_model)
-                            if used_model != selected_model:
-                                logger.info(f"Запрос был обработан резервной моделью: {used_model}")
-                            if status_message:
-                                await status_message.delete()
-                            return response_text
-                        except (json.JSONDecodeError, KeyError, IndexError) as e:
-                            error_msg = f"❌ Ошибка при обработке ответа от OpenRouter: {str(e)}, ответ: {response_text[:200]}..."
-                            logger.error(error_msg)
-                            if status_message:
-                                await status_message.edit_text(error_msg)
-                            raise Exception(error_msg)
-                    else:
-                        error_data = json.loads(response_text) if response_text else {}
-                        error_message = error_data.get('error', {}).get('message', 'Неизвестная ошибка')
-                        error_code = error_data.get('error', {}).get('code', response.status)
-                        if error_code == 400:
-                            error_msg = "❌ Некорректный запрос к API. Пожалуйста, попробуйте позже."
-                        elif error_code == 401:
-                            if "No auth credentials found" in error_message:
-                                error_msg = "❌ Ошибка авторизации: API ключ не найден или некорректен."
-                            else:
-                                error_msg = "❌ Ошибка авторизации: закончились кредиты или API ключ устарел."
-                        elif error_code == 403:
-                            error_msg = "❌ Доступ запрещен: контент не прошел модерацию."
-                        elif error_code == 408:
-                            error_msg = "❌ Превышено время ожидания ответа от ИИ. OpenRouter прервал соединение."
-                        elif error_code == 429:
-                            error_msg = "❌ Нет доступа к API. Возможно, вы используете API из неподдерживаемого региона."
-                        elif error_code == 502:
-                            error_msg = "❌ Некорректный ответ от ИИ. Попробуйте повторить запрос."
-                        elif error_code == 503:
-                            error_msg = "❌ Выбранная модель ИИ больше не доступна в OpenRouter."
-                        else:
-                            error_msg = f"❌ Ошибка OpenRouter API ({error_code}): {error_message}"
-                        logger.error(f"{error_msg}\nПолный ответ: {response_text[:200]}...")
+            session = get_provider_session("openrouter")
+            async with session.post(
+                "https://openrouter.ai/api/v1/chat/completions",
+                headers=headers,
+                json=data,
+                timeout=None
+            ) as response:
+                if response.status == 200 and response.content_type == 'text/event-stream':
+                    logger.info(f"OpenRouter API начал потоковый ответ, соединения: {provider_clients['openrouter'].get_stats()}")
+                    result = await read_sse_completion(response, status_message, "OpenRouter")
+                    if not result['content']:
+                        raise Exception("OpenRouter вернул пустой ответ")
+                    record_token_usage(selected_model, messages, result['usage'])
+                    if result['model'] and result['model'] != selected_model:
+                        logger.info(f"Запрос был обработан резервной моделью: {result['model']}")
+                    await asyncio.to_thread(llm_response_cache.put, cache_key, selected_model, result['content'])
+                    if status_message:
+                        await status_message.delete()
+                    return result['content']
+                response_text = await response.text()
+                logger.info(f"Получен ответ от OpenRouter API, статус: {response.status}, соединения: {provider_clients['openrouter'].get_stats()}")
+                if response.status == 200:
+                    try:
+                        result = json.loads(response_text)
+                        response_text = result['choices'][0]['message']['content']
+                        record_token_usage(selected_model, messages, result.get('usage'))
+                        used_model = result.get('model', selected_model)
+                        if used_model != selected_model:
+                            logger.info(f"Запрос был обработан резервной моделью: {used_model}")
+                        await asyncio.to_thread(llm_response_cache.put, cache_key, selected_model, response_text)
+                        if status_message:
+                            await status_message.delete()
+                        return response_text
+                    except (json.JSONDecodeError, KeyError, IndexError) as e:
+                        error_msg = f"❌ Ошибка при обработке ответа от OpenRouter: {str(e)}, ответ: {response_text[:200]}..."
+                        logger.error(error_msg)
                         if status_message:
                             await status_message.edit_text(error_msg)
                         raise Exception(error_msg)
+                else:
+                    error_data = json.loads(response_text) if response_text else {}
+                    error_message = error_data.get('error', {}).get('message', 'Неизвестная ошибка')
+                    error_code = error_data.get('error', {}).get('code', response.status)
+                    if error_code == 400:
+                        error_msg = "❌ Некорректный запрос к API. Пожалуйста, попробуйте позже."
+                    elif error_code == 401:
+                        if "No auth credentials found" in error_message:
+                            error_msg = "❌ Ошибка авторизации: API ключ не найден или некорректен."
+                        else:
+                            error_msg = "❌ Ошибка авторизации: закончились кредиты или API ключ устарел."
+                    elif error_code == 403:
+                        error_msg = "❌ Доступ запрещен: контент не прошел модерацию."
+                    elif error_code == 408:
+                        error_msg = "❌ Превышено время ожидания ответа от ИИ. OpenRouter прервал соединение."
+                    elif error_code == 429:
+                        error_msg = "❌ Нет доступа к API. Возможно, вы используете API из неподдерживаемого региона."
+                    elif error_code == 502:
+                        error_msg = "❌ Некорректный ответ от ИИ. Попробуйте повторить запрос."
+                    elif error_code == 503:
+                        error_msg = "❌ Выбранная модель ИИ больше не доступна в OpenRouter."
+                    else:
+                        error_msg = f"❌ Ошибка OpenRouter API ({error_code}): {error_message}"
+                    logger.error(f"{error_msg}\nПолный ответ: {response_text[:200]}...")
+                    if status_message:
+                        await status_message.edit_text(error_msg)
+                    raise Exception(error_msg)
         except asyncio.TimeoutError:
             error_msg = "❌ Превышено время ожидания ответа от OpenRouter. Возможно, запрос слишком большой или сервер перегружен."
             logger.error(error_msg)
@@ -416,7 +779,13 @@ __all__ = [
     'load_models_from_user_data',
     'try_openrouter_request_with_images',
     'check_monica_credits',
-    'check_openrouter_credits'
+    'check_openrouter_credits',
+    'start_provider_clients',
+    'close_provider_clients',
+    'get_provider_stats',
+    'llm_response_cache',
+    'FORMAT_INSTRUCTIONS_PREFIX',
+    'pack_posts_for_model'
 ]
 async def try_openrouter_request_with_images(prompt: str, posts: list, user_id: int, bot: Bot, user_data: dict):
     status_message = None
@@ -441,7 +810,7 @@ async def try_openrouter_request_with_images(prompt: str, posts: list, user_id:
         text_content = "\n\n---\n\n".join([
             f"[{post['date']}]\n{post['text']}" for post in posts if post.get('has_text', False)
         ])
-        image_count = sum(1 for post in posts if post.get('has_photo', False))
+        image_count = sum(len(get_post_photo_paths(post)) for post in posts if post.get('has_photo', False))
         web_info = "🔍 С поиском в интернете" if web_search_enabled else ""
         status_message = await bot.send_message(
             user_id,
@@ -504,32 +873,36 @@ async def try_openrouter_request_with_images(prompt: str, posts: list, user_id:
                 "text": f"[{post_date}]"
             })
             if post.get('has_text', False) and post.get('text'):
+                post_text = post['text']
+                if post.get('also_in'):
+                    post_text += f"\n(Также опубликовано: {', '.join(post['also_in'])})"
                 user_message_content.append({
                     "type": "text",
-                    "text": post['text']
+                    "text": post_text
                 })
-            if post.get('has_photo', False) and post.get('photo_path'):
-                try:
-                    with open(post['photo_path'], 'rb') as img_file:
-                        img_data = img_file.read()
-                        img_base64 = base64.b64encode(img_data).decode('utf-8')
-                        img_type = "jpeg"
-                        if post['photo_path'].lower().endswith('.png'):
-                            img_type = "png"
-                        elif post['photo_path'].lower().endswith('.webp'):
-                            img_type = "webp"
+            if post.get('has_photo', False):
+                for photo_path in get_post_photo_paths(post):
+                    try:
+                        with open(photo_path, 'rb') as img_file:
+                            img_data = img_file.read()
+                            img_base64 = base64.b64encode(img_data).decode('utf-8')
+                            img_type = "jpeg"
+                            if photo_path.lower().endswith('.png'):
+                                img_type = "png"
+                            elif photo_path.lower().endswith('.webp'):
+                                img_type = "webp"
+                            user_message_content.append({
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:image/{img_type};base64,{img_base64}"
+                                }
+                            })
+                    except Exception as img_error:
+                        logger.error(f"Ошибка при обработке изображения {photo_path}: {str(img_error)}")
                         user_message_content.append({
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/{img_type};base64,{img_base64}"
-                            }
+                            "type": "text",
+                            "text": f"[Не удалось загрузить изображение: {photo_path}]"
                         })
-                except Exception as img_error:
-                    logger.error(f"Ошибка при обработке изображения {post['photo_path']}: {str(img_error)}")
-                    user_message_content.append({
-                        "type": "text",
-                        "text": f"[Не удалось загрузить изображение: {post['photo_path']}]"
-                    })
             user_message_content.append({
                 "type": "text",
                 "text": "---"
@@ -543,6 +916,10 @@ async def try_openrouter_request_with_images(prompt: str, posts: list, user_id:
             "messages": [system_message, user_message]
         }
         data["models"] = [selected_model]
+        if LLM_STREAMING_ENABLED:
+            data["stream"] = True
+            # Без include_usage OpenAI-совместимые провайдеры не присылают usage в потоке
+            data["stream_options"] = {"include_usage": True}
         logger.info(f"Используем только основную модель без резервных: {selected_model}")
         if web_search_enabled:
             data["plugins"] = [{
@@ -551,6 +928,11 @@ async def try_openrouter_request_with_images(prompt: str, posts: list, user_id:
                 "search_prompt": f"Поиск в интернете был проведен {current_time}. Используй следующие результаты поиска для обоснования своего ответа. ВАЖНО: Цитируй источники, используя формат markdown [домен.com](ссылка)."
             }]
             logger.info(f"Веб-поиск активирован, max_results: {web_search_results}")
+        cache_key, cached_response = await get_cached_response(data, selected_model)
+        if cached_response is not None:
+            if status_message:
+                await status_message.delete()
+            return cached_response
         web_info_status = "🔍 Веб-поиск включен" if web_search_enabled else ""
         if status_message:
             await status_message.edit_text(
@@ -562,58 +944,70 @@ async def try_openrouter_request_with_images(prompt: str, posts: list, user_id:
             )
         logger.info(f"Отправляем запрос к OpenRouter API с изображениями, модель: {selected_model}, размер текста: {len(text_content)}, кол-во изображений: {image_count}, веб-поиск: {web_search_enabled}")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    headers=headers,
-                    json=data,
-                    timeout=None
-                ) as response:
-                    response_text = await response.text()
-                    logger.info(f"Получен ответ от OpenRouter API, статус: {response.status}")
-                    if response.status == 200:
-                        try:
-                            result = json.loads(response_text)
-                            response_text = result['choices'][0]['message']['content']
-                            used_model = result.get('model', selected_model)
-                            if used_model != selected_model:
-                                logger.info(f"Запрос был обработан резервной моделью: {used_model}")
-                            if status_message:
-                                await status_message.delete()
-                            return response_text
-                        except (json.JSONDecodeError, KeyError, IndexError) as e:
-                            error_msg = f"❌ Ошибка при обработке ответа от OpenRouter: {str(e)}, ответ: {response_text[:200]}..."
-                            logger.error(error_msg)
-                            if status_message:
-                                await status_message.edit_text(error_msg)
-                            raise Exception(error_msg)
-                    else:
-                        error_data = json.loads(response_text) if response_text else {}
-                        error_message = error_data.get('error', {}).get('message', 'Неизвестная ошибка')
-                        error_code = error_data.get('error', {}).get('code', response.status)
-                        if error_code == 400:
-                            error_msg = "❌ Некорректный запрос к API. Пожалуйста, попробуйте позже."
-                        elif error_code == 401:
-                            if "No auth credentials found" in error_message:
-                                error_msg = "❌ Ошибка авторизации: API ключ не найден или некорректен."
-                            else:
-                                error_msg = "❌ Ошибка авторизации: закончились кредиты или API ключ устарел."
-                        elif error_code == 403:
-                            error_msg = "❌ Доступ запрещен: контент не прошел модерацию."
-                        elif error_code == 408:
-                            error_msg = "❌ Превышено время ожидания ответа от ИИ. OpenRouter прервал соединение."
-                        elif error_code == 429:
-                            error_msg = "❌ Нет доступа к API. Возможно, вы используете API из неподдерживаемого региона."
-                        elif error_code == 502:
-                            error_msg = "❌ Некорректный ответ от ИИ. Попробуйте повторить запрос."
-                        elif error_code == 503:
-                            error_msg = "❌ Выбранная модель ИИ больше не доступна в OpenRouter."
-                        else:
-                            error_msg = f"❌ Ошибка OpenRouter API ({error_code}): {error_message}"
-                        logger.error(f"{error_msg}\nПолный ответ: {response_text[:200]}...")
+            session = get_provider_session("openrouter")
+            async with session.post(
+                "https://openrouter.ai/api/v1/chat/completions",
+                headers=headers,
+                json=data,
+                timeout=None
+            ) as response:
+                if response.status == 200 and response.content_type == 'text/event-stream':
+                    logger.info(f"OpenRouter API начал потоковый ответ, соединения: {provider_clients['openrouter'].get_stats()}")
+                    result = await read_sse_completion(response, status_message, "OpenRouter")
+                    if not result['content']:
+                        raise Exception("OpenRouter вернул пустой ответ")
+                    if result['model'] and result['model'] != selected_model:
+                        logger.info(f"Запрос был обработан резервной моделью: {result['model']}")
+                    await asyncio.to_thread(llm_response_cache.put, cache_key, selected_model, result['content'])
+                    if status_message:
+                        await status_message.delete()
+                    return result['content']
+                response_text = await response.text()
+                logger.info(f"Получен ответ от OpenRouter API, статус: {response.status}, соединения: {provider_clients['openrouter'].get_stats()}")
+                if response.status == 200:
+                    try:
+                        result = json.loads(response_text)
+                        response_text = result['choices'][0]['message']['content']
+                        used_model = result.get('model', selected_model)
+                        if used_model != selected_model:
+                            logger.info(f"Запрос был обработан резервной моделью: {used_model}")
+                        await asyncio.to_thread(llm_response_cache.put, cache_key, selected_model, response_text)
+                        if status_message:
+                            await status_message.delete()
+                        return response_text
+                    except (json.JSONDecodeError, KeyError, IndexError) as e:
+                        error_msg = f"❌ Ошибка при обработке ответа от OpenRouter: {str(e)}, ответ: {response_text[:200]}..."
+                        logger.error(error_msg)
                         if status_message:
                             await status_message.edit_text(error_msg)
                         raise Exception(error_msg)
+                else:
+                    error_data = json.loads(response_text) if response_text else {}
+                    error_message = error_data.get('error', {}).get('message', 'Неизвестная ошибка')
+                    error_code = error_data.get('error', {}).get('code', response.status)
+                    if error_code == 400:
+                        error_msg = "❌ Некорректный запрос к API. Пожалуйста, попробуйте позже."
+                    elif error_code == 401:
+                        if "No auth credentials found" in error_message:
+                            error_msg = "❌ Ошибка авторизации: API ключ не найден или некорректен."
+                        else:
+                            error_msg = "❌ Ошибка авторизации: закончились кредиты или API ключ устарел."
+                    elif error_code == 403:
+                        error_msg = "❌ Доступ запрещен: контент не прошел модерацию."
+                    elif error_code == 408:
+                        error_msg = "❌ Превышено время ожидания ответа от ИИ. OpenRouter прервал соединение."
+                    elif error_code == 429:
+                        error_msg = "❌ Нет доступа к API. Возможно, вы используете API из неподдерживаемого региона."
+                    elif error_code == 502:
+                        error_msg = "❌ Некорректный ответ от ИИ. Попробуйте повторить запрос."
+                    elif error_code == 503:
+                        error_msg = "❌ Выбранная модель ИИ больше не доступна в OpenRouter."
+                    else:
+                        error_msg = f"❌ Ошибка OpenRouter API ({error_code}): {error_message}"
+                    logger.error(f"{error_msg}\nПолный ответ: {response_text[:200]}...")
+                    if status_message:
+                        await status_message.edit_text(error_msg)
+                    raise Exception(error_msg)
         except asyncio.TimeoutError:
             error_msg = "❌ Превышено время ожидания ответа от OpenRouter. Возможно, запрос слишком большой или сервер перегружен."
             logger.error(error_msg)
@@ -654,42 +1048,42 @@ async def check_openrouter_credits() -> dict:
             "X-Title": "Telegram Bot Analyzer"
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://openrouter.ai/api/v1/credits",
-                headers=headers,
-                timeout=10
-            ) as response:
-                response_text = await response.text()
+        session = get_provider_session("openrouter")
+        async with session.get(
+            "https://openrouter.ai/api/v1/credits",
+            headers=headers,
+            timeout=10
+        ) as response:
+            response_text = await response.text()
                 
-                if response.status == 200:
-                    try:
-                        result = json.loads(response_text)
-                        data = result.get("data", {})
+            if response.status == 200:
+                try:
+                    result = json.loads(response_text)
+                    data = result.get("data", {})
                         
-                        total_credits = data.get("total_credits", 0)
-                        total_usage = data.get("total_usage", 0)
+                    total_credits = data.get("total_credits", 0)
+                    total_usage = data.get("total_usage", 0)
                         
-                        # Округляем до двух знаков после запятой
-                        if isinstance(total_credits, (int, float)):
-                            total_credits = round(total_credits, 2)
-                        if isinstance(total_usage, (int, float)):
-                            total_usage = round(total_usage, 2)
+                    # Округляем до двух знаков после запятой
+                    if isinstance(total_credits, (int, float)):
+                        total_credits = round(total_credits, 2)
+                    if isinstance(total_usage, (int, float)):
+                        total_usage = round(total_usage, 2)
                         
-                        remaining = total_credits - total_usage if isinstance(total_credits, (int, float)) and isinstance(total_usage, (int, float)) else "Неизвестно"
-                        if isinstance(remaining, (int, float)):
-                            remaining = round(remaining, 2)
+                    remaining = total_credits - total_usage if isinstance(total_credits, (int, float)) and isinstance(total_usage, (int, float)) else "Неизвестно"
+                    if isinstance(remaining, (int, float)):
+                        remaining = round(remaining, 2)
                         
-                        return {
-                            "success": True,
-                            "total": total_credits,
-                            "used": total_usage,
-                            "remaining": remaining
-                        }
-                    except (json.JSONDecodeError, KeyError) as e:
-                        return {"success": False, "error": f"Ошибка обработки ответа: {str(e)}"}
-                else:
-                    return {"success": False, "error": f"Ошибка API ({response.status}): {response_text[:200]}"}
+                    return {
+                        "success": True,
+                        "total": total_credits,
+                        "used": total_usage,
+                        "remaining": remaining
+                    }
+                except (json.JSONDecodeError, KeyError) as e:
+                    return {"success": False, "error": f"Ошибка обработки ответа: {str(e)}"}
+            else:
+                return {"success": False, "error": f"Ошибка API ({response.status}): {response_text[:200]}"}
     except Exception as e:
         logger.error(f"Ошибка при проверке кредитов OpenRouter: {e}")
         return {"success": False, "error": str(e)}
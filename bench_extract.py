@@ -0,0 +1,82 @@
+"""
+Микробенчмарк запасного извлечения текста
+
+Сравнивает прежний вариант на BeautifulSoup (html.parser) с extract_fallback из
+web_extract на сохраненных страницах из каталога.
+
+Пример:
+    python bench_extract.py saved_pages --repeat 20 --find-main
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Optional, Tuple
+from bs4 import BeautifulSoup
+from web_extract import extract_fallback
+
+def legacy_fallback(html: str, find_main: bool = False) -> Tuple[Optional[str], Optional[str]]:
+    """Прежний запасной вариант извлечения (до перехода на lxml)"""
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Удаляем скрипты, стили и другие ненужные элементы
+    for script in soup(["script", "style", "nav", "footer", "header"]):
+        script.decompose()
+
+    content = soup.get_text(separator="\n", strip=True)
+    if content and len(content) >= 100:
+        return content, 'beautifulsoup'
+
+    if find_main:
+        main_content = soup.find(['article', 'main', 'div.content', 'div.main', 'div.article', 'body'])
+        if main_content:
+            return main_content.get_text(separator="\n", strip=True) or None, 'main_tag'
+
+    return content or None, 'beautifulsoup'
+
+def load_pages(directory: str) -> list:
+    """Загружает все .html/.htm файлы каталога"""
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(('.html', '.htm')):
+            with open(os.path.join(directory, name), 'r', encoding='utf-8', errors='replace') as f:
+                pages.append((name, f.read()))
+    return pages
+
+def measure(func, html: str, repeat: int, find_main: bool) -> Tuple[float, Optional[str], Optional[str]]:
+    """Среднее время одного вызова в миллисекундах и результат последнего вызова"""
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        content, method = func(html, find_main)
+    return (time.perf_counter() - start_time) * 1000 / repeat, content, method
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение запасных способов извлечения текста из HTML")
+    parser.add_argument('directory', help="каталог с сохраненными страницами (.html)")
+    parser.add_argument('--repeat', type=int, default=10, help="число повторов на страницу")
+    parser.add_argument('--find-main', action='store_true', help="искать основной контент по типичным тегам")
+    args = parser.parse_args()
+
+    pages = load_pages(args.directory)
+    if not pages:
+        print(f"В каталоге {args.directory} нет HTML-страниц")
+        sys.exit(1)
+
+    print(f"{'Страница':<40} {'КБ':>7} {'bs4, мс':>9} {'lxml, мс':>9} {'x':>6} {'bs4 симв.':>10} {'lxml симв.':>10}  способ")
+    total_legacy = 0.0
+    total_fast = 0.0
+    for name, html in pages:
+        legacy_ms, legacy_content, _ = measure(legacy_fallback, html, args.repeat, args.find_main)
+        fast_ms, fast_content, fast_method = measure(extract_fallback, html, args.repeat, args.find_main)
+        total_legacy += legacy_ms
+        total_fast += fast_ms
+        print(
+            f"{name[:40]:<40} {len(html.encode('utf-8')) / 1024:>7.1f} {legacy_ms:>9.2f} {fast_ms:>9.2f} "
+            f"{legacy_ms / fast_ms if fast_ms else 0:>6.1f} {len(legacy_content or ''):>10} {len(fast_content or ''):>10}  {fast_method}"
+        )
+
+    print(f"\nВсего страниц: {len(pages)}, bs4: {total_legacy:.1f} мс, lxml: {total_fast:.1f} мс, "
+          f"ускорение: {total_legacy / total_fast if total_fast else 0:.1f}x")
+
+if __name__ == '__main__':
+    main()
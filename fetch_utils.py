@@ -0,0 +1,366 @@
+"""Загрузка источников: HTTP-сессии, планировщик запросов к доменам, чтение ответов сайтов и дисковые кэши"""
+import asyncio
+import codecs
+import copy
+import logging
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+
+try:
+    from charset_normalizer import from_bytes as detect_encodings
+except ImportError:  # charset_normalizer ставится вместе с requests, но может отсутствовать
+    detect_encodings = None
+
+logger = logging.getLogger(__name__)
+
+# Сколько байт начала документа используется для поиска объявленной кодировки
+# и сколько - для ее определения по содержимому
+CHARSET_SNIFF_BYTES = 4096
+CHARSET_DETECT_BYTES = 64 * 1024
+
+class SingleFlight:
+    """
+    Объединяет одинаковые запросы: одновременные вызовы с одним ключом ждут одну загрузку,
+    а ее результат переиспользуется еще ttl секунд после завершения
+    """
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.tasks = {}  # {ключ: asyncio.Task}
+        self.completed_at = {}  # {ключ: время завершения по time.monotonic()}
+        self.hits = 0
+        self.misses = 0
+    
+    def cleanup(self):
+        """Удаляет результаты с истекшим сроком жизни"""
+        now = time.monotonic()
+        for key, completed_at in list(self.completed_at.items()):
+            if now - completed_at > self.ttl:
+                self.completed_at.pop(key, None)
+                self.tasks.pop(key, None)
+    
+    def on_done(self, key, task: asyncio.Task):
+        # Пустые и неудачные результаты не кэшируем, чтобы следующий запрос попробовал снова
+        if task.cancelled() or task.exception() or not task.result():
+            if self.tasks.get(key) is task:
+                self.tasks.pop(key, None)
+            return
+        self.completed_at[key] = time.monotonic()
+    
+    async def run(self, key, func, *args, **kwargs):
+        self.cleanup()
+        task = self.tasks.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(func(*args, **kwargs))
+            self.tasks[key] = task
+            task.add_done_callback(lambda done_task: self.on_done(key, done_task))
+        else:
+            self.hits += 1
+            logger.info(f"Переиспользую загрузку {key}")
+        # shield: отмена одного из ожидающих не должна отменять общую загрузку
+        result = await asyncio.shield(task)
+        # Каждый получает свою копию, так как посты дополняются данными об источнике
+        return copy.deepcopy(result)
+
+class PooledHttpClient:
+    """
+    Долгоживущая aiohttp-сессия с пулом соединений
+    
+    Сессия создается при первом обращении и пересоздается, если была закрыта. Через
+    TraceConfig считается, сколько соединений было создано и переиспользовано.
+    connector_options передаются в aiohttp.TCPConnector, session_options - в aiohttp.ClientSession.
+    """
+    def __init__(self, name: str, connector_options: dict, **session_options):
+        self.name = name
+        self.connector_options = connector_options
+        self.session_options = session_options
+        self.session = None
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+    
+    async def on_request_start(self, session, trace_config_ctx, params):
+        self.requests += 1
+    
+    async def on_connection_create_end(self, session, trace_config_ctx, params):
+        self.connections_created += 1
+    
+    async def on_connection_reuseconn(self, session, trace_config_ctx, params):
+        self.connections_reused += 1
+    
+    def get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию, создавая ее при первом обращении"""
+        if self.session is None or self.session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self.on_request_start)
+            trace_config.on_connection_create_end.append(self.on_connection_create_end)
+            trace_config.on_connection_reuseconn.append(self.on_connection_reuseconn)
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(**self.connector_options),
+                trace_configs=[trace_config],
+                **self.session_options
+            )
+        return self.session
+    
+    def get_stats(self) -> dict:
+        """Статистика пула соединений"""
+        return {
+            'requests': self.requests,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused
+        }
+    
+    async def close(self):
+        """Закрывает сессию и все соединения пула"""
+        if self.session is not None and not self.session.closed:
+            logger.info(f"Закрываю HTTP-пул {self.name}, статистика: {self.get_stats()}")
+            await self.session.close()
+        self.session = None
+
+def evict_cache_files(directory: str, max_age: float, max_bytes: int, suffix: str = '.json') -> Tuple[int, int]:
+    """
+    Удаляет файлы кэша с окончанием suffix, к которым не обращались дольше max_age секунд,
+    и самые давно использованные, пока их общий размер больше max_bytes
+
+    Время последнего обращения - mtime файла. Остальные файлы каталога не трогаются.
+
+    Returns:
+        Кортеж (число удаленных файлов, размер оставшихся)
+    """
+    now = time.time()
+    entries = []
+    total_size = 0
+    removed = 0
+    for name in os.listdir(directory):
+        if not name.endswith(suffix):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+            if now - stat.st_mtime > max_age:
+                os.remove(path)
+                removed += 1
+                continue
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total_size += stat.st_size
+    for _, size, path in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total_size -= size
+    return removed, total_size
+
+class DomainRateLimited(Exception):
+    """Сайт ответил 429/503 и попросил подождать: источник нужно поставить в очередь повторно"""
+    def __init__(self, url: str, retry_after: float):
+        super().__init__(f"Сайт {url} ограничил частоту запросов, повтор через {retry_after:.0f} с")
+        self.url = url
+        self.retry_after = retry_after
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After: число секунд или HTTP-дата"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+class DomainScheduler:
+    """
+    Планировщик запросов к сайтам по доменам
+    
+    Ограничивает число одновременных запросов к одному домену, выдерживает минимальный
+    интервал между их началом и приостанавливает домен, если он вернул Retry-After
+    (без заголовка - на default_backoff секунд). Паузу дольше retry_after_max не ждем.
+    Разные домены друг другу не мешают.
+    """
+    def __init__(self, concurrency: int, min_interval: float, default_backoff: float, retry_after_max: float):
+        self.concurrency = concurrency
+        self.min_interval = min_interval
+        self.default_backoff = default_backoff
+        self.retry_after_max = retry_after_max
+        self.semaphores = {}  # {домен: asyncio.Semaphore}
+        self.next_start = {}  # {домен: время (monotonic), раньше которого новый запрос не начинать}
+        self.paused_until = {}  # {домен: время (monotonic) окончания паузы после Retry-After}
+        self.requests = 0
+        self.waited = 0.0
+        self.penalties = 0
+    
+    @staticmethod
+    def get_domain(url: str) -> str:
+        return urlparse(url).netloc.lower()
+    
+    async def wait_ready(self, url: str):
+        """Ждет окончания паузы домена, не занимая его слот"""
+        delay = self.paused_until.get(self.get_domain(url), 0) - time.monotonic()
+        if delay > 0:
+            self.waited += delay
+            await asyncio.sleep(delay)
+    
+    @asynccontextmanager
+    async def slot(self, url: str):
+        """Слот для одного запроса к домену url: соблюдает лимит параллельности, интервал и паузу"""
+        domain = self.get_domain(url)
+        semaphore = self.semaphores.setdefault(domain, asyncio.Semaphore(self.concurrency))
+        async with semaphore:
+            while True:
+                now = time.monotonic()
+                if self.paused_until.get(domain, 0) - now > self.retry_after_max:
+                    # Столько ждать не будем, источник завершится с ошибкой
+                    raise DomainRateLimited(url, self.paused_until[domain] - now)
+                start_at = max(self.next_start.get(domain, 0), self.paused_until.get(domain, 0))
+                if start_at <= now:
+                    break
+                self.waited += start_at - now
+                await asyncio.sleep(start_at - now)
+            self.next_start[domain] = time.monotonic() + self.min_interval
+            self.requests += 1
+            yield
+    
+    def penalize(self, url: str, retry_after: Optional[float]) -> float:
+        """Приостанавливает домен на retry_after секунд (или default_backoff) и возвращает паузу"""
+        domain = self.get_domain(url)
+        delay = retry_after if retry_after is not None else self.default_backoff
+        self.paused_until[domain] = max(self.paused_until.get(domain, 0), time.monotonic() + delay)
+        self.penalties += 1
+        logger.warning(f"Домен {domain} ограничил частоту запросов, пауза {delay:.0f} с")
+        return delay
+    
+    def check_status(self, url: str, status: int, headers):
+        """Если сайт ответил 429 или 503 с Retry-After, приостанавливает домен и выбрасывает DomainRateLimited"""
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        if status == 429 or (status == 503 and retry_after is not None):
+            raise DomainRateLimited(url, self.penalize(url, retry_after))
+    
+    def check_response(self, url: str, response: aiohttp.ClientResponse):
+        """check_status для ответа aiohttp"""
+        self.check_status(url, response.status, response.headers)
+    
+    def get_stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'domains': len(self.semaphores),
+            'waited': round(self.waited, 2),
+            'penalties': self.penalties
+        }
+
+def sniff_charset(head: bytes) -> Optional[str]:
+    """Ищет кодировку в <meta charset> или в XML-декларации в начале документа"""
+    match = re.search(rb'<meta[^>]+charset=["\']?([\w-]+)', head, re.IGNORECASE)
+    if not match:
+        match = re.search(rb'<\?xml[^>]+encoding=["\']([\w-]+)', head, re.IGNORECASE)
+    return match.group(1).decode('ascii') if match else None
+
+def detect_charset(head: bytes) -> str:
+    """
+    Определяет кодировку по содержимому, когда сайт ее не объявил
+
+    Корректный utf-8 принимается сразу, иначе кодировку угадывает charset_normalizer
+    (так распознаются cp1251 и koi8-r у старых сайтов). Если угадать не удалось - utf-8.
+    """
+    try:
+        # final=False: многобайтовый символ мог оборваться на границе фрагмента
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    if detect_encodings is not None:
+        # Длинный ASCII-префикс (скрипты, стили) только мешает угадыванию, берем текст с первого не-ASCII байта
+        start = re.search(rb'[\x80-\xff]', head).start()
+        best = detect_encodings(head[start:start + CHARSET_DETECT_BYTES]).best()
+        if best is not None:
+            return best.encoding
+    return 'utf-8'
+
+def get_incremental_decoder(charset: str):
+    """Потоковый декодер для кодировки, при неизвестной кодировке - utf-8"""
+    try:
+        return codecs.getincrementaldecoder(charset)(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+def get_response_charset(response: aiohttp.ClientResponse, head: bytes) -> Optional[str]:
+    """
+    Кодировка из Content-Type, иначе из <meta charset>, иначе определенная по содержимому
+
+    Возвращает None, если кодировка не объявлена, а в начале документа пока только ASCII:
+    по нему кодировку не определить.
+    """
+    declared = response.charset or sniff_charset(head[:CHARSET_SNIFF_BYTES])
+    if declared:
+        return declared
+    if head.isascii():
+        return None
+    return detect_charset(head)
+
+async def read_response_text(response: aiohttp.ClientResponse, max_bytes: int) -> Tuple[str, bool]:
+    """
+    Читает тело ответа потоком, не больше max_bytes байт
+
+    Кодировка определяется по началу документа (см. get_response_charset), и текст
+    декодируется по мере чтения. Если Content-Length больше лимита, обрезка известна
+    заранее. Лимит считается по распакованным данным.
+
+    Returns:
+        Кортеж (текст, был ли ответ обрезан)
+    """
+    truncated = False
+    if response.content_length and response.content_length > max_bytes:
+        logger.info(f"Ответ {response.url} ({response.content_length} байт) больше лимита {max_bytes}, читаю только начало")
+        truncated = True
+
+    decoder = None
+    head = b''
+    parts = []
+    received = 0
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        if received + len(chunk) > max_bytes:
+            chunk = chunk[:max_bytes - received]
+            truncated = True
+        received += len(chunk)
+
+        if decoder is None:
+            # Копим начало документа, пока не станет понятна кодировка
+            head += chunk
+            if len(head) < CHARSET_SNIFF_BYTES and received < max_bytes:
+                continue
+            charset = get_response_charset(response, head)
+            if charset is None and received < max_bytes:
+                continue
+            decoder = get_incremental_decoder(charset or 'utf-8')
+            chunk, head = head, b''
+        parts.append(decoder.decode(chunk))
+
+        if received >= max_bytes:
+            truncated = True
+            break
+
+    if decoder is None:
+        decoder = get_incremental_decoder(get_response_charset(response, head) or 'utf-8')
+        parts.append(decoder.decode(head))
+    parts.append(decoder.decode(b'', final=True))
+
+    if truncated:
+        logger.warning(f"Ответ {response.url} обрезан до {received} байт")
+    return ''.join(parts), truncated
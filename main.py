@@ -1,6 +1,6 @@
 import os
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import asyncio
 import logging
 import re
@@ -14,10 +14,11 @@ from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from dotenv import load_dotenv
-from telethon import TelegramClient
+from telethon import TelegramClient, events
 from telethon.tl.functions.messages import GetHistoryRequest
 from telethon.tl.functions.channels import JoinChannelRequest
-from telethon.errors import ChannelPrivateError, UsernameNotOccupiedError
+from telethon.errors import ChannelPrivateError, UsernameNotOccupiedError, FloodWaitError
+from telethon.tl.types import InputPeerChannel
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import random
 from fpdf import FPDF
@@ -37,14 +38,25 @@ from ai_service import (
     try_openrouter_request_with_images,
     load_models_from_user_data,
     check_monica_credits,
-    check_openrouter_credits
+    check_openrouter_credits,
+    start_provider_clients,
+    close_provider_clients,
+    pack_posts_for_model,
+    FORMAT_INSTRUCTIONS_PREFIX
 )
 import aiohttp
 from typing import List, Optional, Tuple
 import zlib
-import trafilatura
-from bs4 import BeautifulSoup
+import hashlib
+import multiprocessing
+from urllib.parse import urlparse
 import cloudscraper
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from web_extract import extract_content, find_feed_links, parse_feed, parse_sitemap
+from post_utils import build_channel_posts, choose_photo_thumb, deduplicate_posts, format_post_for_prompt
+from fetch_utils import DomainRateLimited, DomainScheduler, PooledHttpClient, SingleFlight, evict_cache_files, read_response_text
+from token_budget import token_calibration
 
 # Настраиваем логирование
 logging.basicConfig(
@@ -66,6 +78,117 @@ logger.info(f"Токен: {token}")
 # Константы
 DEFAULT_PROMPT = "Проанализируй предоставленные данные и составь краткий отчет с ключевыми моментами, трендами и рекомендациями"
 
+# Ограничения на количество одновременных загрузок источников
+TELETHON_FETCH_CONCURRENCY = int(os.getenv('TELETHON_FETCH_CONCURRENCY', '5'))
+HTTP_FETCH_CONCURRENCY = int(os.getenv('HTTP_FETCH_CONCURRENCY', '10'))
+
+# Сколько дней хранить посты каналов в локальном хранилище
+POST_STORE_RETENTION_DAYS = int(os.getenv('POST_STORE_RETENTION_DAYS', '7'))
+
+# Как часто повторять попытку вступить в канал, если прошлая не удалась (в часах)
+CHANNEL_JOIN_RETRY_HOURS = int(os.getenv('CHANNEL_JOIN_RETRY_HOURS', '24'))
+
+# Загрузка фото: число параллельных скачиваний и максимальная сторона для модели с изображениями
+PHOTO_DOWNLOAD_CONCURRENCY = int(os.getenv('PHOTO_DOWNLOAD_CONCURRENCY', '4'))
+PHOTO_MAX_DIMENSION = int(os.getenv('PHOTO_MAX_DIMENSION', '1280'))
+
+# Лимиты запросов к Telegram по методам: (запросов в секунду, размер всплеска)
+TELETHON_RATE_LIMITS = {
+    'get_entity': (0.5, 3),
+    'join_channel': (0.1, 1),
+    'iter_messages': (2.0, 5),
+    'get_messages': (2.0, 5),
+    'download_media': (5.0, 10),
+}
+# Сколько раз повторять запрос после FloodWait, прежде чем сдаться
+TELETHON_FLOOD_MAX_RETRIES = int(os.getenv('TELETHON_FLOOD_MAX_RETRIES', '5'))
+# Максимальная пауза FloodWait (с), которую готовы ждать: при большей источник завершается с ошибкой
+TELEGRAM_FLOOD_WAIT_MAX = int(os.getenv('TELEGRAM_FLOOD_WAIT_MAX', '300'))
+
+# Режим живого приема постов через события NewMessage
+LIVE_INGESTION_ENABLED = os.getenv('LIVE_INGESTION_ENABLED', '0') == '1'
+# Глубина дозагрузки истории при старте (максимальный период анализа) и интервал пересинхронизации
+LIVE_BACKFILL_HOURS = int(os.getenv('LIVE_BACKFILL_HOURS', '72'))
+LIVE_RESYNC_MINUTES = int(os.getenv('LIVE_RESYNC_MINUTES', '30'))
+
+# Сколько секунд результат загрузки канала переиспользуется другими запросами
+SINGLE_FLIGHT_TTL = int(os.getenv('SINGLE_FLIGHT_TTL', '60'))
+
+# Поиск почти одинаковых постов: максимальное расстояние Хэмминга между SimHash
+# и минимальное число слов в посте, при котором его имеет смысл сравнивать
+DEDUP_SIMHASH_DISTANCE = int(os.getenv('DEDUP_SIMHASH_DISTANCE', '12'))
+DEDUP_MIN_WORDS = int(os.getenv('DEDUP_MIN_WORDS', '8'))
+
+# Пул HTTP-соединений для загрузки сайтов
+WEB_HTTP_POOL_LIMIT = int(os.getenv('WEB_HTTP_POOL_LIMIT', '100'))
+WEB_HTTP_PER_HOST_LIMIT = int(os.getenv('WEB_HTTP_PER_HOST_LIMIT', '4'))
+WEB_HTTP_DNS_CACHE_TTL = int(os.getenv('WEB_HTTP_DNS_CACHE_TTL', '300'))
+WEB_HTTP_KEEPALIVE_TIMEOUT = int(os.getenv('WEB_HTTP_KEEPALIVE_TIMEOUT', '30'))
+
+# Вежливость к сайтам: одновременных запросов к одному домену, минимальный интервал между запросами (с),
+# пауза после 429 без Retry-After, максимальная пауза, которую готовы ждать, и число повторов источника
+WEB_DOMAIN_CONCURRENCY = int(os.getenv('WEB_DOMAIN_CONCURRENCY', '2'))
+WEB_DOMAIN_MIN_INTERVAL = float(os.getenv('WEB_DOMAIN_MIN_INTERVAL', '0.5'))
+WEB_RATE_LIMIT_BACKOFF = int(os.getenv('WEB_RATE_LIMIT_BACKOFF', '30'))
+WEB_RETRY_AFTER_MAX = int(os.getenv('WEB_RETRY_AFTER_MAX', '120'))
+WEB_RATE_LIMIT_RETRIES = int(os.getenv('WEB_RATE_LIMIT_RETRIES', '2'))
+
+# Предельный объем ответа сайта в байтах: для HTML-страниц и статей, для лент и sitemap
+WEB_MAX_RESPONSE_BYTES = int(os.getenv('WEB_MAX_RESPONSE_BYTES', str(3 * 1024 * 1024)))
+WEB_MAX_XML_BYTES = int(os.getenv('WEB_MAX_XML_BYTES', str(20 * 1024 * 1024)))
+
+# Каталог HTTP-кэша сайтов (ETag/Last-Modified и извлеченный текст), его предельный размер
+# и срок хранения записей, к которым не обращались
+HTTP_CACHE_DIR = os.getenv('HTTP_CACHE_DIR', 'http_cache')
+HTTP_CACHE_MAX_BYTES = int(os.getenv('HTTP_CACHE_MAX_BYTES', str(100 * 1024 * 1024)))
+HTTP_CACHE_MAX_AGE_DAYS = int(os.getenv('HTTP_CACHE_MAX_AGE_DAYS', '7'))
+
+# Через сколько часов снова пробовать прямой запрос для доменов, где сработал только CloudScraper
+DOMAIN_REPROBE_HOURS = int(os.getenv('DOMAIN_REPROBE_HOURS', '24'))
+
+# Потоки для CloudScraper и файл, где между запусками хранятся cookies прохождения защиты
+CLOUDSCRAPER_THREADS = int(os.getenv('CLOUDSCRAPER_THREADS', '4'))
+CLOUDSCRAPER_COOKIES_FILE = os.getenv('CLOUDSCRAPER_COOKIES_FILE', 'cloudscraper_cookies.json')
+
+# Пул процессов для извлечения текста из HTML: число процессов, размер очереди и таймаут задачи
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', '2'))
+EXTRACTION_QUEUE_LIMIT = int(os.getenv('EXTRACTION_QUEUE_LIMIT', '16'))
+EXTRACTION_TIMEOUT = int(os.getenv('EXTRACTION_TIMEOUT', '30'))
+# Способ запуска процессов пула. fork небезопасен: к моменту пересоздания пула в боте уже
+# работают потоки (CloudScraper, asyncio.to_thread, резолвер), поэтому по умолчанию forkserver,
+# а где его нет (Windows) - spawn
+EXTRACTION_START_METHOD = os.getenv(
+    'EXTRACTION_START_METHOD',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+# RSS/Atom-ленты и sitemap сайтов: как часто искать их заново (и повторять поиск, если ничего
+# не нашлось или сайт не ответил), сколько статей и вложенных sitemap обрабатывать за один анализ,
+# сколько статей загружать параллельно и предельный размер статьи
+FEED_DISCOVERY_TTL_HOURS = int(os.getenv('FEED_DISCOVERY_TTL_HOURS', '24'))
+FEED_DISCOVERY_NEGATIVE_TTL_HOURS = int(os.getenv('FEED_DISCOVERY_NEGATIVE_TTL_HOURS', '3'))
+FEED_MAX_ARTICLES = int(os.getenv('FEED_MAX_ARTICLES', '30'))
+FEED_MAX_CHILD_SITEMAPS = int(os.getenv('FEED_MAX_CHILD_SITEMAPS', '3'))
+FEED_ARTICLE_CONCURRENCY = int(os.getenv('FEED_ARTICLE_CONCURRENCY', '5'))
+FEED_ARTICLE_MAX_CHARS = int(os.getenv('FEED_ARTICLE_MAX_CHARS', '15000'))
+
+# Заголовки для имитации браузера при загрузке сайтов
+WEBSITE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+    'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Referer': 'https://www.google.com/',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'cross-site',
+    'Sec-Fetch-User': '?1',
+    'Cache-Control': 'max-age=0',
+}
+
 # Секретный код для самостоятельного получения прав администратора
 ADMIN_SECRET_CODE = "super_secure_admin_code"
 
@@ -118,6 +241,58 @@ def init_db():
                       added_by INTEGER,
                       added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
         
+        # Локальное хранилище постов каналов
+        c.execute('''CREATE TABLE IF NOT EXISTS channel_posts
+                     (channel_id INTEGER,
+                      message_id INTEGER,
+                      date INTEGER,
+                      text TEXT,
+                      has_photo BOOLEAN,
+                      grouped_id INTEGER,
+                      PRIMARY KEY (channel_id, message_id))''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_channel_posts_date
+                     ON channel_posts (channel_id, date)''')
+        
+        # Состояние синхронизации каналов: сохраненный диапазон сообщений
+        c.execute('''CREATE TABLE IF NOT EXISTS channel_sync_state
+                     (channel_id INTEGER PRIMARY KEY,
+                      max_message_id INTEGER,
+                      min_message_id INTEGER,
+                      covered_since INTEGER,
+                      synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        
+        # Кэш сущностей каналов и членства в них
+        c.execute('''CREATE TABLE IF NOT EXISTS channel_entities
+                     (username TEXT PRIMARY KEY,
+                      channel_id INTEGER,
+                      access_hash INTEGER,
+                      joined BOOLEAN DEFAULT 0,
+                      joined_at TIMESTAMP,
+                      resolved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        
+        # Способ загрузки, который последним сработал для домена
+        c.execute('''CREATE TABLE IF NOT EXISTS domain_fetch_strategy
+                     (domain TEXT PRIMARY KEY,
+                      method TEXT,
+                      elapsed REAL,
+                      updated_at TIMESTAMP,
+                      probed_at TIMESTAMP)''')
+        
+        # Хэши абзацев сайтов с прошлого анализа (отдельно для каждой папки пользователя)
+        c.execute('''CREATE TABLE IF NOT EXISTS website_snapshots
+                     (scope TEXT,
+                      url TEXT,
+                      paragraph_hashes TEXT,
+                      updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      PRIMARY KEY (scope, url))''')
+        
+        # Найденные у сайтов RSS/Atom-ленты и sitemap
+        c.execute('''CREATE TABLE IF NOT EXISTS website_feeds
+                     (url TEXT PRIMARY KEY,
+                      feeds TEXT,
+                      sitemaps TEXT,
+                      checked_at TIMESTAMP)''')
+        
         conn.commit()
     finally:
         conn.close()
@@ -184,9 +359,143 @@ client = TelegramClient(
     os.getenv('API_HASH'),
     system_version="4.16.30-vxCUSTOM",
     device_model="Desktop",
-    app_version="1.0.0"
+    app_version="1.0.0",
+    # FloodWait обрабатывает telegram_scheduler, а не встроенный автосон Telethon
+    flood_sleep_threshold=0
 )
 
+class TokenBucket:
+    """Простой token bucket: rate токенов в секунду, не больше capacity"""
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        # Очередь ожидающих обслуживается по порядку благодаря блокировке
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class TelegramFloodWaitTooLong(Exception):
+    """Telegram потребовал паузу дольше TELEGRAM_FLOOD_WAIT_MAX"""
+    def __init__(self, method: str, seconds: float):
+        self.method = method
+        self.seconds = seconds
+        super().__init__(f"Telegram ограничил {method} на {seconds:.0f} с")
+
+class TelegramRequestScheduler:
+    """
+    Общий планировщик всех запросов к Telethon-клиенту
+    
+    Каждый метод ограничен своим token bucket. При FloodWaitError метод ставится на паузу
+    на указанное Telegram время, а запрос возвращается в очередь вместо того, чтобы падать.
+    Паузы дольше TELEGRAM_FLOOD_WAIT_MAX не ждем: запрос завершается TelegramFloodWaitTooLong.
+    """
+    def __init__(self, limits: dict):
+        self.buckets = {method: TokenBucket(rate, capacity) for method, (rate, capacity) in limits.items()}
+        self.paused_until = {}  # {метод: время окончания паузы по time.monotonic()}
+        self.queue_depth = 0
+        self.calls = 0
+        self.flood_waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    async def wait_turn(self, method: str):
+        """Ждет окончания паузы метода и свободного токена"""
+        started = time.monotonic()
+        self.queue_depth += 1
+        try:
+            while True:
+                pause = self.paused_until.get(method, 0) - time.monotonic()
+                if pause > TELEGRAM_FLOOD_WAIT_MAX:
+                    # Столько ждать не будем, источник завершится с ошибкой
+                    raise TelegramFloodWaitTooLong(method, pause)
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                await self.buckets[method].acquire()
+                # Пауза могла начаться, пока мы ждали токен
+                if self.paused_until.get(method, 0) <= time.monotonic():
+                    break
+        finally:
+            self.queue_depth -= 1
+            waited = time.monotonic() - started
+            self.calls += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+    
+    def pause(self, method: str, seconds: int):
+        """Ставит метод на паузу после FloodWaitError"""
+        self.flood_waits += 1
+        self.paused_until[method] = max(self.paused_until.get(method, 0), time.monotonic() + seconds)
+        logger.warning(f"FloodWait для {method}: пауза {seconds} с, в очереди {self.queue_depth} запросов")
+        if seconds > TELEGRAM_FLOOD_WAIT_MAX:
+            raise TelegramFloodWaitTooLong(method, seconds)
+    
+    async def call(self, method: str, func, *args, **kwargs):
+        """Выполняет запрос к Telethon с учетом лимитов и повтором после FloodWait"""
+        for attempt in range(TELETHON_FLOOD_MAX_RETRIES + 1):
+            await self.wait_turn(method)
+            try:
+                return await func(*args, **kwargs)
+            except FloodWaitError as e:
+                if attempt == TELETHON_FLOOD_MAX_RETRIES:
+                    raise
+                self.pause(method, e.seconds)
+    
+    async def iter_messages(self, entity, page_size: int = 100, **kwargs):
+        """
+        Аналог client.iter_messages, запрашивающий историю страницами
+        
+        Перед каждой страницей берется токен, а после FloodWait итерация продолжается
+        с последнего полученного сообщения.
+        """
+        offset_id = kwargs.pop('offset_id', 0)
+        flood_retries = 0
+        while True:
+            await self.wait_turn('iter_messages')
+            try:
+                page = [
+                    message async for message in client.iter_messages(
+                        entity, limit=page_size, offset_id=offset_id, **kwargs
+                    )
+                ]
+            except FloodWaitError as e:
+                flood_retries += 1
+                if flood_retries > TELETHON_FLOOD_MAX_RETRIES:
+                    raise
+                self.pause('iter_messages', e.seconds)
+                continue
+            
+            for message in page:
+                yield message
+            if len(page) < page_size:
+                return
+            offset_id = page[-1].id
+    
+    def get_stats(self) -> dict:
+        """Статистика очереди и ожидания"""
+        now = time.monotonic()
+        return {
+            'queue_depth': self.queue_depth,
+            'calls': self.calls,
+            'flood_waits': self.flood_waits,
+            'avg_wait': self.total_wait / self.calls if self.calls else 0.0,
+            'max_wait': self.max_wait,
+            'paused': {method: round(until - now, 1) for method, until in self.paused_until.items() if until > now}
+        }
+
+telegram_scheduler = TelegramRequestScheduler(TELETHON_RATE_LIMITS)
+
 # Структура для хранения данных
 class UserData:
     def __init__(self):
@@ -273,6 +582,213 @@ def get_active_schedules() -> list:
     schedules = c.fetchall()
     return schedules
 
+def store_channel_messages(rows: list):
+    """Сохраняем сообщения канала в локальное хранилище"""
+    if not rows:
+        return
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.executemany('''INSERT OR REPLACE INTO channel_posts
+                         (channel_id, message_id, date, text, has_photo, grouped_id)
+                         VALUES (?, ?, ?, ?, ?, ?)''', rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_stored_channel_posts(channel_id: int, since_ts: int) -> list:
+    """Получаем сохраненные посты канала начиная с указанного момента (новые первыми)"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''SELECT message_id, date, text, has_photo, grouped_id FROM channel_posts
+                     WHERE channel_id = ? AND date >= ? AND (text != '' OR has_photo)
+                     ORDER BY message_id DESC''', (channel_id, since_ts))
+        return c.fetchall()
+    finally:
+        conn.close()
+
+def normalize_channel_username(channel_link: str) -> str:
+    """Приводит ссылку вида @Channel к ключу кэша"""
+    return channel_link.lstrip('@').lower()
+
+def get_cached_channel_entity(channel_link: str) -> Optional[dict]:
+    """Получаем сущность канала из кэша"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''SELECT channel_id, access_hash, joined, joined_at FROM channel_entities
+                     WHERE username = ?''', (normalize_channel_username(channel_link),))
+        row = c.fetchone()
+        if not row:
+            return None
+        return {
+            'channel_id': row[0],
+            'access_hash': row[1],
+            'joined': bool(row[2]),
+            'joined_at': datetime.fromisoformat(row[3]) if row[3] else None
+        }
+    finally:
+        conn.close()
+
+def save_channel_entity(channel_link: str, channel_id: int, access_hash: int, joined: bool):
+    """Сохраняем сущность канала и время последней проверки членства"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''INSERT OR REPLACE INTO channel_entities
+                     (username, channel_id, access_hash, joined, joined_at, resolved_at)
+                     VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)''',
+                  (normalize_channel_username(channel_link), channel_id, access_hash,
+                   joined, datetime.now().isoformat()))
+        conn.commit()
+    finally:
+        conn.close()
+
+def invalidate_channel_entity(channel_link: str):
+    """Удаляем канал из кэша сущностей"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('DELETE FROM channel_entities WHERE username = ?',
+                  (normalize_channel_username(channel_link),))
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_channel_sync_state(channel_id: int) -> Optional[dict]:
+    """Получаем состояние синхронизации канала"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''SELECT max_message_id, min_message_id, covered_since FROM channel_sync_state
+                     WHERE channel_id = ?''', (channel_id,))
+        row = c.fetchone()
+        if not row:
+            return None
+        return {'max_message_id': row[0], 'min_message_id': row[1], 'covered_since': row[2]}
+    finally:
+        conn.close()
+
+def save_channel_sync_state(channel_id: int, max_message_id: int, min_message_id: int, covered_since: int):
+    """Сохраняем состояние синхронизации канала"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''INSERT OR REPLACE INTO channel_sync_state
+                     (channel_id, max_message_id, min_message_id, covered_since, synced_at)
+                     VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)''',
+                  (channel_id, max_message_id, min_message_id, covered_since))
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_domain_strategy(domain: str) -> Optional[dict]:
+    """Получаем сохраненный способ загрузки для домена"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('SELECT method, elapsed, probed_at FROM domain_fetch_strategy WHERE domain = ?', (domain,))
+        row = c.fetchone()
+        if not row:
+            return None
+        return {
+            'method': row[0],
+            'elapsed': row[1],
+            'probed_at': datetime.fromisoformat(row[2]) if row[2] else None
+        }
+    finally:
+        conn.close()
+
+def save_domain_strategy(domain: str, method: str, elapsed: float, probed: bool):
+    """Сохраняем сработавший способ загрузки и время, за которое он отработал"""
+    now = datetime.now().isoformat()
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''INSERT INTO domain_fetch_strategy (domain, method, elapsed, updated_at, probed_at)
+                     VALUES (?, ?, ?, ?, ?)
+                     ON CONFLICT(domain) DO UPDATE SET
+                         method = excluded.method,
+                         elapsed = excluded.elapsed,
+                         updated_at = excluded.updated_at,
+                         probed_at = COALESCE(excluded.probed_at, domain_fetch_strategy.probed_at)''',
+                  (domain, method, elapsed, now, now if probed else None))
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_website_snapshot(scope: str, url: str) -> Optional[set]:
+    """Получаем хэши абзацев сайта с прошлого анализа"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('SELECT paragraph_hashes FROM website_snapshots WHERE scope = ? AND url = ?', (scope, url))
+        row = c.fetchone()
+        return set(json.loads(row[0])) if row else None
+    finally:
+        conn.close()
+
+def save_website_snapshot(scope: str, url: str, paragraph_hashes: set):
+    """Сохраняем хэши абзацев сайта для следующего анализа"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''INSERT OR REPLACE INTO website_snapshots (scope, url, paragraph_hashes, updated_at)
+                     VALUES (?, ?, ?, CURRENT_TIMESTAMP)''', (scope, url, json.dumps(sorted(paragraph_hashes))))
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_website_feeds(url: str) -> Optional[dict]:
+    """Получаем ранее найденные ленты и sitemap сайта"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('SELECT feeds, sitemaps, checked_at FROM website_feeds WHERE url = ?', (url,))
+        row = c.fetchone()
+        if not row:
+            return None
+        return {
+            'feeds': json.loads(row[0]),
+            'sitemaps': json.loads(row[1]),
+            'checked_at': datetime.fromisoformat(row[2])
+        }
+    finally:
+        conn.close()
+
+def save_website_feeds(url: str, feeds: list, sitemaps: list):
+    """Сохраняем найденные ленты и sitemap сайта (пустые списки тоже, чтобы не искать их каждый раз)"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('''INSERT OR REPLACE INTO website_feeds (url, feeds, sitemaps, checked_at)
+                     VALUES (?, ?, ?, ?)''', (url, json.dumps(feeds), json.dumps(sitemaps), datetime.now().isoformat()))
+        conn.commit()
+    finally:
+        conn.close()
+
+def prune_channel_posts(retention_days: int = POST_STORE_RETENTION_DAYS):
+    """Удаляем из хранилища посты старше срока хранения и сдвигаем границы синхронизации"""
+    cutoff_ts = int((datetime.now(timezone.utc) - timedelta(days=retention_days)).timestamp())
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute('DELETE FROM channel_posts WHERE date < ?', (cutoff_ts,))
+        deleted = c.rowcount
+        # Удаленный диапазон придется загрузить заново, если он снова понадобится
+        c.execute('''UPDATE channel_sync_state
+                     SET covered_since = ?,
+                         min_message_id = COALESCE(
+                             (SELECT MIN(message_id) FROM channel_posts p
+                              WHERE p.channel_id = channel_sync_state.channel_id),
+                             max_message_id + 1)
+                     WHERE covered_since < ?''', (cutoff_ts, cutoff_ts))
+        conn.commit()
+        logger.info(f"Из хранилища постов удалено {deleted} устаревших сообщений")
+    finally:
+        conn.close()
+
 def generate_unique_filename(base_name: str, extension: str) -> str:
     """
     Генерирует уникальное имя файла, добавляя (!n) если файл существует
@@ -828,12 +1344,13 @@ async def cmd_list_folders(message: types.Message, state: FSMContext = None):
     await list_folders(message)
 
 @dp.callback_query_handler(lambda c: c.data.startswith('edit_folder_'))
-async def edit_folder_menu(callback_query: types.CallbackQuery):
-    folder = callback_query.data.replace('edit_folder_', '')
+async def edit_folder_menu(callback_query: types.CallbackQuery, folder: str = None):
+    folder = folder or callback_query.data.replace('edit_folder_', '')
     keyboard = types.InlineKeyboardMarkup(row_width=1)
     
     # Добавляем кнопки для каждого источника
-    sources = user_data.get_user_data(callback_query.from_user.id)['folders'][folder]
+    user = user_data.get_user_data(callback_query.from_user.id)
+    sources = user['folders'][folder]
     for source in sources:
         # Определяем тип источника по формату
         icon = "📱 " if source.startswith('@') else "🌐 "
@@ -849,6 +1366,9 @@ async def edit_folder_menu(callback_query: types.CallbackQuery):
         types.InlineKeyboardButton("➕ Добавить источники", callback_data=f"add_channels_{folder}"),
         types.InlineKeyboardButton("❌ Удалить папку", callback_data=f"delete_folder_{folder}")
     )
+    # Режим отправки сайтов папки: страница целиком (по умолчанию) или только изменения
+    website_mode = "Только изменения" if is_website_diff_enabled(user, folder) else "Вся страница"
+    keyboard.add(types.InlineKeyboardButton(f"🌐 Сайты: {website_mode}", callback_data=f"toggle_website_diff_{folder}"))
     keyboard.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_to_folders"))
     
     # Разделяем источники по типам для отображения
@@ -873,6 +1393,27 @@ async def edit_folder_menu(callback_query: types.CallbackQuery):
         reply_markup=keyboard
     )
 
+@dp.callback_query_handler(lambda c: c.data.startswith('toggle_website_diff_'))
+async def toggle_website_diff(callback_query: types.CallbackQuery):
+    folder = callback_query.data.replace('toggle_website_diff_', '')
+    user = user_data.get_user_data(callback_query.from_user.id)
+    if folder not in user['folders']:
+        await callback_query.answer("Папка не найдена")
+        return
+    
+    # Переключаем режим отправки сайтов для папки
+    diff_folders = user['ai_settings'].setdefault('website_diff_folders', [])
+    if folder in diff_folders:
+        diff_folders.remove(folder)
+    else:
+        diff_folders.append(folder)
+    user_data.save()
+    
+    await callback_query.answer(
+        f"Сайты папки {folder}: {'отправляются только изменения' if folder in diff_folders else 'отправляется вся страница'}."
+    )
+    await edit_folder_menu(callback_query, folder)
+
 @dp.callback_query_handler(lambda c: c.data.startswith('add_channels_'))
 async def add_channels_start(callback_query: types.CallbackQuery, state: FSMContext):
     folder = callback_query.data.replace('add_channels_', '')
@@ -895,6 +1436,8 @@ async def delete_folder(callback_query: types.CallbackQuery):
     if folder in user['folders']:
         del user['folders'][folder]
         del user['prompts'][folder]
+        if folder in user['ai_settings'].get('website_diff_folders', []):
+            user['ai_settings']['website_diff_folders'].remove(folder)
         user_data.save()
         
         await callback_query.message.edit_text(f"✅ Папка {folder} удалена")
@@ -1427,66 +1970,433 @@ async def get_channel_posts(channel_link: str, hours: int = 24) -> list:
             return []
             
         try:
-            # Пытаемся присоединиться к каналу
-            channel = await client.get_entity(channel_link)
-            try:
-                await client(JoinChannelRequest(channel))
-                logger.info(f"Успешно присоединился к каналу {channel_link}")
-            except Exception as e:
-                logger.warning(f"Не удалось присоединиться к каналу {channel_link}: {str(e)}")
-                # Продолжаем работу, возможно мы уже подписаны
+            channel, channel_id = await resolve_channel(channel_link)
+            
+            # Догружаем недостающие сообщения, остальное окно берем из локального хранилища
+            threshold_ts = int((datetime.now(timezone.utc) - timedelta(hours=hours)).timestamp())
+            if is_live_covered(channel_id, threshold_ts):
+                logger.info(f"Канал {channel_link} обновляется в живом режиме, читаю посты локально")
+            else:
+                await sync_channel_history(channel, channel_id, threshold_ts)
+            stored_posts = get_stored_channel_posts(channel_id, threshold_ts)
         except (ChannelPrivateError, UsernameNotOccupiedError) as e:
             logger.error(f"Не удалось получить доступ к каналу {channel_link}: {str(e)}")
+            invalidate_channel_entity(channel_link)
             return []
         
-        # Получаем историю сообщений
-        posts = []
-        time_threshold = datetime.now(channel.date.tzinfo) - timedelta(hours=hours)
-        
-        async for message in client.iter_messages(channel, limit=None):
-            if message.date < time_threshold:
-                break
-                
-            post_data = {
-                'date': message.date.strftime('%Y-%m-%d %H:%M:%S'),
-                'has_text': bool(message.text and len(message.text.strip()) > 0),
-                'text': message.text if message.text else '',
-                'has_photo': bool(message.photo),
-                'photo_path': None
-            }
-            
-            # Если есть фото, скачиваем его
-            if message.photo:
-                photo_path = await download_message_photo(message)
-                post_data['photo_path'] = photo_path
-            
-            # Добавляем пост только если есть текст или фото
-            if post_data['has_text'] or post_data['has_photo']:
-                posts.append(post_data)
+        posts = build_channel_posts(channel_link, stored_posts)
         
         logger.info(f"Получено {len(posts)} постов из канала {channel_link}")
         return posts
         
+    except TelegramFloodWaitTooLong as e:
+        # Передаем причину в fetch_source, чтобы пользователь увидел ее в списке ошибок источников
+        logger.error(f"Канал {channel_link} пропущен: {str(e)}")
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении постов из канала {channel_link}: {str(e)}")
         return []
 
-async def get_website_content_with_cloudscraper(url: str) -> list:
+async def resolve_channel(channel_link: str) -> Tuple[InputPeerChannel, int]:
     """
-    Получает контент с веб-сайта с использованием cloudscraper для обхода Cloudflare и других защит.
+    Возвращает InputPeerChannel и id канала, используя кэш сущностей
     
-    Args:
-        url: URL сайта для получения контента
+    get_entity и JoinChannelRequest выполняются только для новых каналов, а повторная
+    попытка вступления - не чаще раза в CHANNEL_JOIN_RETRY_HOURS.
+    """
+    cached = get_cached_channel_entity(channel_link)
+    if cached:
+        peer = InputPeerChannel(cached['channel_id'], cached['access_hash'])
+        retry_join = (
+            not cached['joined']
+            and (not cached['joined_at']
+                 or datetime.now() - cached['joined_at'] > timedelta(hours=CHANNEL_JOIN_RETRY_HOURS))
+        )
+        if not retry_join:
+            return peer, cached['channel_id']
+        channel_id, access_hash = cached['channel_id'], cached['access_hash']
+        joined = False
+    else:
+        entity = await telegram_scheduler.call('get_entity', client.get_entity, channel_link)
+        peer = InputPeerChannel(entity.id, entity.access_hash)
+        channel_id, access_hash = entity.id, entity.access_hash
+        # left=False означает, что мы уже состоим в канале
+        joined = getattr(entity, 'left', True) is False
+    
+    if not joined:
+        try:
+            await telegram_scheduler.call('join_channel', client, JoinChannelRequest(peer))
+            joined = True
+            logger.info(f"Успешно присоединился к каналу {channel_link}")
+        except (ChannelPrivateError, UsernameNotOccupiedError):
+            raise
+        except Exception as e:
+            logger.warning(f"Не удалось присоединиться к каналу {channel_link}: {str(e)}")
+            # Продолжаем работу, публичные каналы читаются и без подписки
+    
+    save_channel_entity(channel_link, channel_id, access_hash, joined)
+    return peer, channel_id
+
+def message_to_row(channel_id: int, message) -> tuple:
+    """Преобразует сообщение Telethon в строку для хранилища постов"""
+    return (
+        channel_id,
+        message.id,
+        int(message.date.timestamp()),
+        message.text or '',
+        bool(message.photo),
+        message.grouped_id
+    )
+
+async def sync_channel_history(channel, channel_id: int, threshold_ts: int):
+    """
+    Догружает в локальное хранилище только недостающие сообщения канала
+    
+    Новые сообщения запрашиваются начиная с последнего синхронизированного (min_id), но не
+    раньше начала окна threshold_ts, а более старые - только если сохраненный диапазон не
+    покрывает начало окна.
+    
+    Уже сохраненные сообщения повторно не запрашиваются, поэтому их правки после загрузки
+    видны только в живом режиме (событие MessageEdited). Без него пост остается в том виде,
+    в каком был загружен впервые.
+    """
+    state = get_channel_sync_state(channel_id)
+    rows = []
+    
+    if state:
+        max_message_id = state['max_message_id']
+        min_message_id = state['min_message_id']
+        covered_since = state['covered_since']
         
-    Returns:
-        Список с контентом сайта в формате, совместимом с постами из Telegram
+        # Сообщения идут от новых к старым; после долгого перерыва не грузим то, что старше окна
+        gap_message_id = None
+        async for message in telegram_scheduler.iter_messages(channel, min_id=max_message_id):
+            rows.append(message_to_row(channel_id, message))
+            max_message_id = max(max_message_id, message.id)
+            if message.date.timestamp() < threshold_ts:
+                gap_message_id = message.id
+                covered_since = int(message.date.timestamp())
+                break
+        if gap_message_id is not None:
+            # Между старым диапазоном и загруженными сообщениями остался пропуск, сохраненный
+            # диапазон начинается заново с последнего загруженного сообщения
+            min_message_id = gap_message_id
+    else:
+        max_message_id = 0
+        min_message_id = 0
+        covered_since = None
+    
+    if covered_since is None or covered_since > threshold_ts:
+        # offset_id=0 означает загрузку начиная с самого нового сообщения
+        reached_threshold = False
+        async for message in telegram_scheduler.iter_messages(channel, offset_id=min_message_id):
+            rows.append(message_to_row(channel_id, message))
+            max_message_id = max(max_message_id, message.id)
+            min_message_id = message.id
+            if message.date.timestamp() < threshold_ts:
+                covered_since = int(message.date.timestamp())
+                reached_threshold = True
+                break
+        
+        if not reached_threshold:
+            # Дошли до начала канала
+            covered_since = 0
+    
+    store_channel_messages(rows)
+    save_channel_sync_state(channel_id, max_message_id, min_message_id, covered_since)
+    logger.info(f"Синхронизация канала {channel_id}: загружено {len(rows)} новых сообщений")
+
+# Каналы, на новые сообщения которых подписан живой режим: {id канала: ссылка}
+live_channel_ids = {}
+# Каналы, история которых дозагружена с момента запуска и дальше пополняется событиями.
+# Сюда попадают только каналы, в которых состоит аккаунт: без подписки Telegram не
+# присылает события о новых сообщениях
+live_synced_channel_ids = set()
+# Фоновая задача запуска живого режима: ссылка держится, чтобы задачу не собрал сборщик мусора
+live_ingestion_task: Optional[asyncio.Task] = None
+
+def is_live_covered(channel_id: int, threshold_ts: int) -> bool:
+    """
+    Проверяет, что окно канала целиком есть в хранилище благодаря живому режиму
+
+    События не двигают max_message_id: верхнюю границу сдвигает только sync_channel_history,
+    которая загружает все сообщения подряд. Поэтому потерянные события не оставляют
+    постоянных пропусков - их заполняет следующая периодическая синхронизация.
     """
+    if not LIVE_INGESTION_ENABLED or channel_id not in live_synced_channel_ids:
+        return False
+    state = get_channel_sync_state(channel_id)
+    return bool(state) and state['covered_since'] <= threshold_ts
+
+def get_all_folder_channels() -> set:
+    """Собирает каналы из папок всех пользователей"""
+    channels = set()
+    for user in user_data.users.values():
+        for sources in user.get('folders', {}).values():
+            channels.update(normalize_channel_username(source) for source in sources if is_valid_channel(source))
+    return channels
+
+async def live_message_handler(event):
+    """Сохраняет новые и отредактированные сообщения отслеживаемых каналов в хранилище"""
+    channel_id = getattr(event.message.peer_id, 'channel_id', None)
+    if channel_id not in live_channel_ids:
+        return
     try:
-        logger.info(f"Получаю контент с сайта {url} с использованием cloudscraper")
+        store_channel_messages([message_to_row(channel_id, event.message)])
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении сообщения из канала {live_channel_ids[channel_id]}: {str(e)}")
+
+async def sync_live_channels():
+    """
+    Подписывает живой режим на все каналы из папок и дозагружает пропущенную историю
+    
+    Вызывается при старте и периодически: так подхватываются новые каналы и заполняются
+    пропуски после простоя или потери обновлений.
+    """
+    threshold_ts = int((datetime.now(timezone.utc) - timedelta(hours=LIVE_BACKFILL_HOURS)).timestamp())
+    
+    async def sync_one(channel_link: str):
+        async with telethon_fetch_semaphore:
+            try:
+                channel, channel_id = await resolve_channel(f"@{channel_link}")
+                entity = get_cached_channel_entity(channel_link)
+                if not entity or not entity['joined']:
+                    # Вступить не удалось - события не придут, канал читается обычной синхронизацией
+                    live_channel_ids.pop(channel_id, None)
+                    live_synced_channel_ids.discard(channel_id)
+                    logger.info(f"Живой режим: канал @{channel_link} пропущен, аккаунт в нем не состоит")
+                    return
+                live_channel_ids[channel_id] = channel_link
+                await sync_channel_history(channel, channel_id, threshold_ts)
+                live_synced_channel_ids.add(channel_id)
+            except (ChannelPrivateError, UsernameNotOccupiedError) as e:
+                logger.error(f"Живой режим: нет доступа к каналу @{channel_link}: {str(e)}")
+                invalidate_channel_entity(channel_link)
+            except Exception as e:
+                logger.error(f"Живой режим: ошибка синхронизации канала @{channel_link}: {str(e)}")
+    
+    channels = get_all_folder_channels()
+    await asyncio.gather(*(sync_one(channel_link) for channel_link in channels))
+    logger.info(f"Живой режим: синхронизировано {len(live_synced_channel_ids)} из {len(channels)} каналов")
+
+async def start_live_ingestion():
+    """Включает живой прием постов через события Telethon"""
+    client.add_event_handler(live_message_handler, events.NewMessage())
+    client.add_event_handler(live_message_handler, events.MessageEdited())
+    await sync_live_channels()
+    scheduler.add_job(
+        sync_live_channels,
+        'interval',
+        minutes=LIVE_RESYNC_MINUTES,
+        id="sync_live_channels",
+        replace_existing=True
+    )
+
+def on_live_ingestion_done(task: asyncio.Task):
+    """Записывает в лог ошибку запуска живого режима, иначе она потерялась бы вместе с задачей"""
+    if task.cancelled():
+        return
+    if task.exception():
+        logger.error(f"Не удалось запустить живой режим приема постов: {str(task.exception())}", exc_info=task.exception())
+
+# Общий для всего процесса HTTP-клиент для загрузки сайтов: лимиты на хост, кэш DNS, keep-alive
+web_http_client = PooledHttpClient(
+    'для сайтов',
+    {
+        'limit': WEB_HTTP_POOL_LIMIT,
+        'limit_per_host': WEB_HTTP_PER_HOST_LIMIT,
+        'ttl_dns_cache': WEB_HTTP_DNS_CACHE_TTL,
+        'keepalive_timeout': WEB_HTTP_KEEPALIVE_TIMEOUT
+    },
+    headers=WEBSITE_HEADERS,
+    timeout=aiohttp.ClientTimeout(total=30)
+)
+
+domain_scheduler = DomainScheduler(WEB_DOMAIN_CONCURRENCY, WEB_DOMAIN_MIN_INTERVAL, WEB_RATE_LIMIT_BACKOFF, WEB_RETRY_AFTER_MAX)
+
+class ExtractionPool:
+    """
+    Пул процессов для извлечения текста из HTML
+    
+    trafilatura и lxml нагружают процессор и держат GIL, поэтому работают
+    в отдельных процессах. Число одновременно поставленных задач ограничено
+    (ограниченная очередь), у каждой задачи есть таймаут. Процесс, не уложившийся
+    в таймаут, нельзя прервать по отдельности, поэтому новые задачи уходят в новый пул,
+    а старый завершается, когда доработают его задачи.
+    """
+    def __init__(self, workers: int, queue_limit: int, timeout: int, start_method: str):
+        self.workers = workers
+        self.timeout = timeout
+        self.mp_context = multiprocessing.get_context(start_method)
+        self.slots = asyncio.Semaphore(queue_limit)
+        self.start_lock = asyncio.Lock()
+        self.executor = None
+        self.recycles = 0
+    
+    async def start(self):
+        """
+        Создает процессы пула
         
-        # Выполняем в отдельном потоке, так как cloudscraper не поддерживает async напрямую
-        def scrape():
-            # Создаем scraper с задержкой и различными настройками
+        Вызывается при старте бота, чтобы первый разбор не ждал запуска процессов.
+        Ожидание запуска не блокирует цикл событий.
+        """
+        async with self.start_lock:
+            if self.executor is not None:
+                return
+            executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context)
+            await asyncio.get_running_loop().run_in_executor(executor, int)
+            self.executor = executor
+            logger.info(f"Запущен пул извлечения текста: {self.workers} процессов ({self.mp_context.get_start_method()})")
+    
+    def recycle(self, executor: ProcessPoolExecutor):
+        """
+        Выводит пул из работы, следующий запрос создаст новый пул
+        
+        Ожидающие задачи старого пула отменяются, выполняющиеся у других вызывающих
+        дорабатывают, а его процессы завершаются после своих задач.
+        """
+        if self.executor is not executor:
+            # Пул уже пересоздан другой задачей
+            return
+        self.executor = None
+        self.recycles += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    async def run(self, func, *args):
+        """
+        Выполняет функцию разбора в пуле процессов
+        
+        Функция должна быть определена на уровне модуля (web_extract), чтобы ее можно было
+        передать в процесс. При таймауте или сбое пула возвращает None, исключения самой
+        функции пробрасываются вызывающему.
+        """
+        async with self.slots:
+            await self.start()
+            executor = self.executor
+            future = asyncio.wrap_future(executor.submit(func, *args))
+            try:
+                # shield: отмену самого вызывающего отличаем от отмены задачи при пересоздании пула
+                return await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                logger.warning("Задача разбора отменена при пересоздании пула")
+            except asyncio.TimeoutError:
+                logger.error(f"Разбор в пуле процессов не уложился в {self.timeout} с, пересоздаю пул")
+                self.recycle(executor)
+            except BrokenProcessPool:
+                logger.error("Пул извлечения текста аварийно завершился, пересоздаю его")
+                self.recycle(executor)
+            return None
+    
+    async def extract(self, html: str, find_main: bool = False) -> Tuple[Optional[str], Optional[str]]:
+        """Извлекает текст страницы в пуле процессов. При таймауте или сбое возвращает (None, None)"""
+        return await self.run(extract_content, html, find_main) or (None, None)
+    
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+extraction_pool = ExtractionPool(EXTRACTION_WORKERS, EXTRACTION_QUEUE_LIMIT, EXTRACTION_TIMEOUT, EXTRACTION_START_METHOD)
+
+def get_http_cache_path(url: str) -> str:
+    """Путь к записи HTTP-кэша для URL (без расширения)"""
+    return os.path.join(HTTP_CACHE_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+def load_http_cache_entry(url: str) -> Optional[dict]:
+    """Загружает метаданные и извлеченный текст страницы из HTTP-кэша"""
+    try:
+        with open(f"{get_http_cache_path(url)}.json", 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+        return entry if entry.get('url') == url else None
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать HTTP-кэш для {url}: {str(e)}")
+        return None
+
+def touch_http_cache_entry(url: str):
+    """Отмечает обращение к записи HTTP-кэша, чтобы ее не вытеснили как давно неиспользуемую"""
+    try:
+        os.utime(f"{get_http_cache_path(url)}.json")
+    except OSError as e:
+        logger.debug(f"Не удалось обновить время записи HTTP-кэша для {url}: {str(e)}")
+
+def evict_http_cache():
+    """
+    Удаляет записи HTTP-кэша, к которым не обращались дольше HTTP_CACHE_MAX_AGE_DAYS,
+    и самые давно использованные записи, пока кэш больше HTTP_CACHE_MAX_BYTES
+    """
+    removed, total_size = evict_cache_files(HTTP_CACHE_DIR, HTTP_CACHE_MAX_AGE_DAYS * 86400, HTTP_CACHE_MAX_BYTES)
+    if removed:
+        logger.info(f"Из HTTP-кэша удалено записей: {removed}, размер кэша {total_size} байт")
+
+def save_http_cache_entry(url: str, etag: Optional[str], last_modified: Optional[str], content: str):
+    """Сохраняет извлеченный текст страницы вместе с ETag и Last-Modified и ограничивает размер кэша"""
+    try:
+        os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+        base_path = get_http_cache_path(url)
+        with open(f"{base_path}.json", 'w', encoding='utf-8') as f:
+            json.dump({
+                'url': url,
+                'etag': etag,
+                'last_modified': last_modified,
+                'content': content,
+                'fetched_at': datetime.now().isoformat()
+            }, f, ensure_ascii=False)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить HTTP-кэш для {url}: {str(e)}")
+        return
+    evict_http_cache()
+
+class CloudscraperPool:
+    """
+    Долгоживущие сессии CloudScraper по доменам
+    
+    Сессия домена хранит cookies прохождения защиты (cf_clearance и др.), поэтому проверка
+    не решается заново при каждом запросе; cookies сохраняются на диск между запусками.
+    Запросы выполняются в отдельном пуле потоков, чтобы не занимать пул по умолчанию.
+    """
+    def __init__(self, threads: int, cookies_file: str):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='cloudscraper')
+        self.cookies_file = cookies_file
+        self.scrapers = {}  # {домен: scraper}
+        self.locks = {}  # {домен: asyncio.Lock}, одна сессия обслуживает один запрос за раз
+        self.saved_state = self.load_state()
+    
+    def load_state(self) -> dict:
+        try:
+            with open(self.cookies_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить cookies CloudScraper: {str(e)}")
+            return {}
+    
+    def save_state(self):
+        """Сохраняет cookies и User-Agent всех сессий (cf_clearance привязан к User-Agent)"""
+        state = dict(self.saved_state)
+        for domain, scraper in self.scrapers.items():
+            state[domain] = {
+                'user_agent': scraper.headers.get('User-Agent'),
+                'cookies': [
+                    {'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain,
+                     'path': cookie.path, 'expires': cookie.expires}
+                    for cookie in scraper.cookies
+                ]
+            }
+        try:
+            with open(self.cookies_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            self.saved_state = state
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить cookies CloudScraper: {str(e)}")
+    
+    def get_scraper(self, domain: str):
+        scraper = self.scrapers.get(domain)
+        if scraper is None:
             scraper = cloudscraper.create_scraper(
                 browser={
                     'browser': 'chrome',
@@ -1495,32 +2405,84 @@ async def get_website_content_with_cloudscraper(url: str) -> list:
                 },
                 delay=3
             )
+            saved = self.saved_state.get(domain)
+            if saved:
+                if saved.get('user_agent'):
+                    scraper.headers['User-Agent'] = saved['user_agent']
+                for cookie in saved.get('cookies', []):
+                    if cookie.get('expires') and cookie['expires'] < time.time():
+                        continue
+                    scraper.cookies.set(
+                        cookie['name'], cookie['value'],
+                        domain=cookie.get('domain'), path=cookie.get('path') or '/',
+                        expires=cookie.get('expires')
+                    )
+            self.scrapers[domain] = scraper
+        return scraper
+    
+    async def get(self, url: str, headers: dict) -> Tuple[int, dict, str]:
+        """Выполняет GET через сессию домена в выделенном пуле потоков, возвращает статус, заголовки и тело"""
+        domain = urlparse(url).netloc.lower()
+        lock = self.locks.setdefault(domain, asyncio.Lock())
+        async with lock:
+            scraper = self.get_scraper(domain)
             
-            # Добавляем дополнительные заголовки для имитации реального пользователя
-            headers = {
-                'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-                'Referer': 'https://www.google.com/',
-                'DNT': '1',
-                'Upgrade-Insecure-Requests': '1',
-            }
-            
-            # Выполняем запрос с повторными попытками
-            for attempt in range(3):
-                try:
-                    if attempt > 0:
-                        time.sleep(3 * attempt)  # Увеличиваем задержку с каждой попыткой
-                    response = scraper.get(url, headers=headers, timeout=30)
-                    if response.status_code == 200:
-                        return response.text
-                    logger.warning(f"cloudscraper: попытка {attempt+1}, статус {response.status_code}")
-                except Exception as e:
-                    logger.error(f"cloudscraper: ошибка в попытке {attempt+1}: {str(e)}")
+            def request():
+                response = scraper.get(url, headers=headers, timeout=30)
+                # Декодируем тело тоже в потоке пула
+                return response.status_code, response.headers, response.text
             
-            return None
+            loop = asyncio.get_running_loop()
+            status_code, response_headers, text = await loop.run_in_executor(self.executor, request)
+        if status_code == 200:
+            self.save_state()
+        return status_code, response_headers, text
+    
+    def shutdown(self):
+        self.save_state()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+cloudscraper_pool = CloudscraperPool(CLOUDSCRAPER_THREADS, CLOUDSCRAPER_COOKIES_FILE)
+
+async def get_website_content_with_cloudscraper(url: str) -> list:
+    """
+    Получает контент с веб-сайта с использованием cloudscraper для обхода Cloudflare и других защит.
+    
+    Args:
+        url: URL сайта для получения контента
         
-        # Выполняем блокирующую функцию в отдельном потоке
-        loop = asyncio.get_event_loop()
-        html = await loop.run_in_executor(None, scrape)
+    Returns:
+        Список с контентом сайта в формате, совместимом с постами из Telegram
+    """
+    try:
+        logger.info(f"Получаю контент с сайта {url} с использованием cloudscraper")
+        
+        # Добавляем дополнительные заголовки для имитации реального пользователя
+        headers = {
+            'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+            'Referer': 'https://www.google.com/',
+            'DNT': '1',
+            'Upgrade-Insecure-Requests': '1',
+        }
+        
+        # Выполняем запрос с повторными попытками; паузы между ними ждет цикл событий, а не поток
+        html = None
+        for attempt in range(3):
+            try:
+                if attempt > 0:
+                    await asyncio.sleep(3 * attempt)  # Увеличиваем задержку с каждой попыткой
+                async with domain_scheduler.slot(url):
+                    status_code, response_headers, text = await cloudscraper_pool.get(url, headers)
+                if status_code == 200:
+                    html = text
+                    break
+                logger.warning(f"cloudscraper: попытка {attempt+1}, статус {status_code}")
+                domain_scheduler.check_status(url, status_code, response_headers)
+            except DomainRateLimited:
+                # Повтор решает вызывающий код по паузе домена, а не фиксированная задержка
+                raise
+            except Exception as e:
+                logger.error(f"cloudscraper: ошибка в попытке {attempt+1}: {str(e)}")
         
         if not html:
             logger.error(f"Не удалось получить содержимое с сайта {url} с помощью cloudscraper")
@@ -1535,38 +2497,23 @@ async def get_website_content_with_cloudscraper(url: str) -> list:
                 'error': "cloudscraper_failed"
             }]
         
-        # Используем trafilatura для извлечения основного текста
-        content = trafilatura.extract(html, include_comments=False, include_tables=True, 
-                                     include_links=True, include_images=False)
+        # Извлекаем текст в пуле процессов, чтобы не блокировать цикл событий
+        content, method = await extraction_pool.extract(html, find_main=True)
         
         if not content:
-            # Пробуем BeautifulSoup если trafilatura не справилась
-            logger.warning(f"Trafilatura не смогла извлечь содержимое с сайта {url}, пробую BeautifulSoup")
-            soup = BeautifulSoup(html, 'html.parser')
-            
-            # Удаляем ненужные элементы
-            for script in soup(["script", "style", "nav", "footer", "header"]):
-                script.decompose()
-            
-            content = soup.get_text(separator="\n", strip=True)
-            
-            if not content or len(content) < 100:
-                # Пробуем найти основной контент по типичным тегам
-                main_content = soup.find(['article', 'main', 'div.content', 'div.main', 'div.article', 'body'])
-                if main_content:
-                    content = main_content.get_text(separator="\n", strip=True)
-                else:
-                    logger.warning(f"BeautifulSoup также не смог извлечь значимый контент с сайта {url}")
-                    return [{
-                        'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        'has_text': True,
-                        'text': f"На сайте {url} не удалось извлечь текстовое содержимое. Возможно, сайт использует нестандартный формат содержимого.",
-                        'has_photo': False,
-                        'photo_path': None,
-                        'source_type': 'website',
-                        'source_url': url,
-                        'error': "no_content_extracted"
-                    }]
+            logger.warning(f"Не удалось извлечь значимый контент с сайта {url}")
+            return [{
+                'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'has_text': True,
+                'text': f"На сайте {url} не удалось извлечь текстовое содержимое. Возможно, сайт использует нестандартный формат содержимого.",
+                'has_photo': False,
+                'photo_path': None,
+                'source_type': 'website',
+                'source_url': url,
+                'error': "no_content_extracted"
+            }]
+        if method != 'trafilatura':
+            logger.warning(f"Trafilatura не смогла извлечь содержимое с сайта {url}, использован запасной способ: {method}")
         
         # Ограничиваем размер контента
         if len(content) > 50000:
@@ -1581,9 +2528,13 @@ async def get_website_content_with_cloudscraper(url: str) -> list:
             'has_photo': False,
             'photo_path': None,
             'source_type': 'website',
-            'source_url': url
+            'source_url': url,
+            'fetch_method': 'cloudscraper',
+            'page_content': content
         }]
         
+    except DomainRateLimited:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении контента с сайта {url} с помощью cloudscraper: {str(e)}")
         return [{
@@ -1598,100 +2549,148 @@ async def get_website_content_with_cloudscraper(url: str) -> list:
         }]
 
 async def get_website_content(url: str) -> list:
+    """
+    Получает контент сайта, выбирая способ загрузки по истории домена
+    
+    Если для домена в прошлый раз сработал только CloudScraper, прямой запрос пропускается;
+    раз в DOMAIN_REPROBE_HOURS прямой запрос пробуется снова.
+    """
+    domain = urlparse(url).netloc.lower()
+    strategy = get_domain_strategy(domain)
+    
+    probe = False
+    start_time = time.monotonic()
+    if strategy and strategy['method'] == 'cloudscraper':
+        probe = (
+            not strategy['probed_at']
+            or datetime.now() - strategy['probed_at'] > timedelta(hours=DOMAIN_REPROBE_HOURS)
+        )
+        if probe:
+            logger.info(f"Перепроверяю прямой запрос для домена {domain}")
+            posts = await get_website_content_direct(url)
+        else:
+            logger.info(f"Для домена {domain} сразу использую CloudScraper")
+            posts = await get_website_content_with_cloudscraper(url)
+    else:
+        posts = await get_website_content_direct(url)
+    elapsed = time.monotonic() - start_time
+    
+    # Запоминаем способ, который сработал
+    if posts and not any('error' in post for post in posts):
+        method = posts[0].get('fetch_method', 'direct')
+        save_domain_strategy(domain, method, elapsed, probe)
+        logger.info(f"Сайт {url} загружен способом {method} за {elapsed:.2f} с")
+    elif probe:
+        save_domain_strategy(domain, 'cloudscraper', elapsed, probe)
+    return posts
+
+async def get_website_content_direct(url: str) -> list:
+    """Загружает сайт прямым запросом, при признаках защиты переключается на CloudScraper"""
     try:
         logger.info(f"Получаю контент с сайта {url}")
         
-        # Настройка заголовков для имитации браузера
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-            'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Referer': 'https://www.google.com/',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'cross-site',
-            'Sec-Fetch-User': '?1',
-            'Cache-Control': 'max-age=0',
-        }
-        
-        # Конфигурация клиентской сессии
-        timeout = aiohttp.ClientTimeout(total=30)
-        
-        async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    html = await response.text()
-                    
-                    # Проверка на Cloudflare
-                    if "CF-Browser-Verification" in html or "cf-browser-verification" in html or "cloudflare" in html.lower():
-                        logger.warning(f"Обнаружена защита Cloudflare на сайте {url}, переключаюсь на CloudScraper")
-                        return await get_website_content_with_cloudscraper(url)
-                    
-                    # Проверка на CAPTCHA
-                    if "captcha" in html.lower() or "robot" in html.lower():
-                        logger.warning(f"Обнаружена CAPTCHA на сайте {url}, переключаюсь на CloudScraper")
-                        return await get_website_content_with_cloudscraper(url)
-                        
-                elif response.status == 403:
-                    logger.warning(f"Получен статус 403 Forbidden от сайта {url}, пробую через CloudScraper")
-                    return await get_website_content_with_cloudscraper(url)
-                    
-                elif response.status == 429:
-                    logger.warning(f"Получен статус 429 Too Many Requests от сайта {url}, пробую через CloudScraper")
-                    return await get_website_content_with_cloudscraper(url)
-                    
-                elif response.status >= 400:
-                    logger.error(f"Не удалось получить доступ к сайту {url}, статус: {response.status}")
-                    return [{
-                        'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        'has_text': True,
-                        'text': f"Не удалось получить содержимое сайта {url}. Ошибка HTTP {response.status}.",
-                        'has_photo': False,
-                        'photo_path': None,
-                        'source_type': 'website',
-                        'source_url': url,
-                        'error': f"HTTP {response.status}"
-                    }]
-                
-                else:
-                    html = await response.text()
+        # Используем общий пул соединений: keep-alive, кэш DNS и лимиты на хост
+        session = web_http_client.get_session()
         
-        # Используем trafilatura для извлечения основного текста
-        content = trafilatura.extract(html, include_comments=False, include_tables=True, 
-                                     include_links=True, include_images=False)
+        # Условный запрос: если страница не менялась, сервер ответит 304 без тела
+        cache_entry = load_http_cache_entry(url)
+        conditional_headers = {}
+        if cache_entry:
+            if cache_entry.get('etag'):
+                conditional_headers['If-None-Match'] = cache_entry['etag']
+            if cache_entry.get('last_modified'):
+                conditional_headers['If-Modified-Since'] = cache_entry['last_modified']
         
-        if not content:
-            # Пробуем получить контент другим способом, если trafilatura не справился
-            logger.warning(f"Trafilatura не смогла извлечь содержимое с сайта {url}, пробую BeautifulSoup")
-            soup = BeautifulSoup(html, 'html.parser')
+        truncated = False
+        use_cloudscraper = False
+        async with domain_scheduler.slot(url), session.get(url, headers=conditional_headers) as response:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
             
-            # Удаляем скрипты, стили и другие ненужные элементы
-            for script in soup(["script", "style", "nav", "footer", "header"]):
-                script.decompose()
+            # 429 и 503 с Retry-After - не защита от ботов, а просьба подождать
+            domain_scheduler.check_response(url, response)
             
-            content = soup.get_text(separator="\n", strip=True)
+            if response.status == 304 and cache_entry:
+                # Переиспользуем ранее извлеченный текст без загрузки и разбора страницы
+                logger.info(f"Сайт {url} не изменился (304), использую кэш")
+                touch_http_cache_entry(url)
+                return [{
+                    'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'has_text': True,
+                    'text': f"Содержимое сайта {url}:\n\n{cache_entry['content']}",
+                    'has_photo': False,
+                    'photo_path': None,
+                    'source_type': 'website',
+                    'source_url': url,
+                    'from_cache': True,
+                    'fetch_method': 'direct',
+                    'page_content': cache_entry['content']
+                }]
             
-            if not content or len(content) < 100:
-                logger.warning(f"BeautifulSoup также не смог извлечь значимый контент с сайта {url}")
+            if response.status == 200:
+                html, truncated = await read_response_text(response, WEB_MAX_RESPONSE_BYTES)
+                
+                # Проверка на Cloudflare
+                if "CF-Browser-Verification" in html or "cf-browser-verification" in html or "cloudflare" in html.lower():
+                    logger.warning(f"Обнаружена защита Cloudflare на сайте {url}, переключаюсь на CloudScraper")
+                    use_cloudscraper = True
+                
+                # Проверка на CAPTCHA
+                elif "captcha" in html.lower() or "robot" in html.lower():
+                    logger.warning(f"Обнаружена CAPTCHA на сайте {url}, переключаюсь на CloudScraper")
+                    use_cloudscraper = True
+                    
+            elif response.status == 403:
+                logger.warning(f"Получен статус 403 Forbidden от сайта {url}, пробую через CloudScraper")
+                use_cloudscraper = True
+                
+            elif response.status >= 400:
+                logger.error(f"Не удалось получить доступ к сайту {url}, статус: {response.status}")
                 return [{
                     'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                     'has_text': True,
-                    'text': f"С сайта {url} не удалось извлечь текстовое содержимое. Возможно, сайт защищен от автоматического сканирования.",
+                    'text': f"Не удалось получить содержимое сайта {url}. Ошибка HTTP {response.status}.",
                     'has_photo': False,
                     'photo_path': None,
                     'source_type': 'website',
                     'source_url': url,
-                    'error': "Не удалось извлечь содержимое"
+                    'error': f"HTTP {response.status}"
                 }]
+            
+            else:
+                html, truncated = await read_response_text(response, WEB_MAX_RESPONSE_BYTES)
+        
+        # CloudScraper запускаем после освобождения слота домена: он займет свой
+        if use_cloudscraper:
+            return await get_website_content_with_cloudscraper(url)
+    
+        # Извлекаем текст в пуле процессов, чтобы не блокировать цикл событий
+        content, method = await extraction_pool.extract(html)
+        
+        if not content or len(content) < 100:
+            logger.warning(f"Не удалось извлечь значимый контент с сайта {url}")
+            return [{
+                'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'has_text': True,
+                'text': f"С сайта {url} не удалось извлечь текстовое содержимое. Возможно, сайт защищен от автоматического сканирования.",
+                'has_photo': False,
+                'photo_path': None,
+                'source_type': 'website',
+                'source_url': url,
+                'error': "Не удалось извлечь содержимое"
+            }]
+        if method != 'trafilatura':
+            logger.warning(f"Trafilatura не смогла извлечь содержимое с сайта {url}, использован запасной способ: {method}")
         
         # Ограничиваем размер контента
         if len(content) > 50000:
             content = content[:50000] + "... (текст обрезан из-за большого размера)"
             logger.info(f"Контент сайта {url} обрезан из-за большого размера")
+            truncated = True
+        
+        # Сохраняем страницу для следующих условных запросов
+        if etag or last_modified:
+            await asyncio.to_thread(save_http_cache_entry, url, etag, last_modified, content)
         
         # Возвращаем в формате, аналогичном формату постов Telegram
         return [{
@@ -1701,8 +2700,13 @@ async def get_website_content(url: str) -> list:
             'has_photo': False,
             'photo_path': None,
             'source_type': 'website',
-            'source_url': url
+            'source_url': url,
+            'fetch_method': 'direct',
+            'page_content': content,
+            'truncated': truncated
         }]
+    except DomainRateLimited:
+        raise
     except aiohttp.ClientError as e:
         logger.error(f"Ошибка сетевого подключения при доступе к сайту {url}: {str(e)}")
         # При ошибке сетевого подключения пробуем через CloudScraper
@@ -1721,6 +2725,316 @@ async def get_website_content(url: str) -> list:
             'error': f"Неизвестная ошибка: {str(e)}"
         }]
 
+async def fetch_feed_text_with_cloudscraper(url: str, max_bytes: int) -> Tuple[Optional[str], bool]:
+    """Загружает ленту, sitemap или статью через CloudScraper"""
+    try:
+        async with domain_scheduler.slot(url):
+            status_code, response_headers, text = await cloudscraper_pool.get(url, {'Accept-Language': WEBSITE_HEADERS['Accept-Language']})
+        if status_code != 200:
+            logger.info(f"Адрес {url} вернул статус {status_code} (CloudScraper)")
+            domain_scheduler.check_status(url, status_code, response_headers)
+            return None, False
+    except DomainRateLimited:
+        # Домен уже приостановлен, следующие запросы к нему подождут
+        return None, False
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить {url} через CloudScraper: {str(e)}")
+        return None, False
+    # Тело уже загружено целиком, ограничиваем его по числу символов
+    if len(text) > max_bytes:
+        return text[:max_bytes], True
+    return text, False
+
+async def fetch_feed_text(url: str, max_bytes: int = WEB_MAX_RESPONSE_BYTES) -> Tuple[Optional[str], bool]:
+    """
+    Загружает ленту, sitemap или статью через общий пул соединений
+    
+    Для доменов, которые открываются только через CloudScraper (см. get_website_content),
+    запрос сразу идет через него.
+    
+    Returns:
+        Кортеж (текст, был ли ответ обрезан); текст None, если ответ не 200
+    """
+    strategy = get_domain_strategy(urlparse(url).netloc.lower())
+    if strategy and strategy['method'] == 'cloudscraper':
+        return await fetch_feed_text_with_cloudscraper(url, max_bytes)
+    try:
+        session = web_http_client.get_session()
+        async with domain_scheduler.slot(url), session.get(url) as response:
+            if response.status != 200:
+                logger.info(f"Адрес {url} вернул статус {response.status}")
+                domain_scheduler.check_response(url, response)
+                return None, False
+            return await read_response_text(response, max_bytes)
+    except DomainRateLimited:
+        # Домен уже приостановлен, следующие запросы к нему подождут
+        return None, False
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"Не удалось загрузить {url}: {str(e)}")
+        return None, False
+
+def is_feed_document(text: str) -> bool:
+    """Похож ли ответ на RSS/Atom-ленту или sitemap, а не на HTML-страницу"""
+    head = text.lstrip()[:500].lower()
+    return head.startswith('<?xml') or any(tag in head for tag in ('<rss', '<feed', '<urlset', '<sitemapindex'))
+
+async def discover_website_feeds(url: str) -> dict:
+    """
+    Ищет у сайта RSS/Atom-ленты и sitemap
+    
+    Ленты ищутся в <link rel="alternate"> страницы, sitemap - в robots.txt и по адресу
+    /sitemap.xml. Если сам источник - лента или sitemap, используется он. Найденные ленты
+    кэшируются в БД на FEED_DISCOVERY_TTL_HOURS, пустой результат (ничего не найдено или
+    сайт не ответил) - на FEED_DISCOVERY_NEGATIVE_TTL_HOURS.
+    """
+    cached = get_website_feeds(url)
+    if cached:
+        ttl_hours = FEED_DISCOVERY_TTL_HOURS if cached['feeds'] or cached['sitemaps'] else FEED_DISCOVERY_NEGATIVE_TTL_HOURS
+        if datetime.now() - cached['checked_at'] < timedelta(hours=ttl_hours):
+            return cached
+    
+    logger.info(f"Ищу RSS/Atom-ленты и sitemap сайта {url}")
+    feeds = []
+    sitemaps = []
+    page, _ = await fetch_feed_text(url, WEB_MAX_XML_BYTES)
+    if page and is_feed_document(page):
+        if '<urlset' in page[:1000] or '<sitemapindex' in page[:1000]:
+            sitemaps.append(url)
+        else:
+            feeds.append(url)
+    elif page:
+        feeds = await extraction_pool.run(find_feed_links, page, url) or []
+    else:
+        # Сайт сейчас недоступен или ограничил запросы - повторим поиск через FEED_DISCOVERY_NEGATIVE_TTL_HOURS
+        logger.info(f"Сайт {url} не ответил при поиске лент")
+        save_website_feeds(url, [], [])
+        return {'feeds': [], 'sitemaps': []}
+    
+    # Sitemap нужен, только если у сайта нет лент
+    if not feeds and not sitemaps:
+        parsed = urlparse(url)
+        root_url = f"{parsed.scheme}://{parsed.netloc}"
+        robots, _ = await fetch_feed_text(f"{root_url}/robots.txt")
+        if robots:
+            for line in robots.splitlines():
+                if line.lower().startswith('sitemap:'):
+                    sitemap_url = line.split(':', 1)[1].strip()
+                    if sitemap_url and sitemap_url not in sitemaps:
+                        sitemaps.append(sitemap_url)
+        if not sitemaps:
+            sitemap_text, _ = await fetch_feed_text(f"{root_url}/sitemap.xml", WEB_MAX_XML_BYTES)
+            if sitemap_text and is_feed_document(sitemap_text):
+                sitemaps.append(f"{root_url}/sitemap.xml")
+    
+    save_website_feeds(url, feeds, sitemaps)
+    logger.info(f"Сайт {url}: найдено лент {len(feeds)}, sitemap {len(sitemaps)}")
+    return {'feeds': feeds, 'sitemaps': sitemaps}
+
+async def collect_feed_entries(discovery: dict) -> list:
+    """Собирает статьи из всех лент и sitemap сайта (вложенные sitemap - только самые свежие)"""
+    async def load(url: str, parser) -> Optional[object]:
+        text, truncated = await fetch_feed_text(url, WEB_MAX_XML_BYTES)
+        if not text:
+            return None
+        if truncated:
+            # Обрезанный XML не разобрать
+            logger.warning(f"{url} больше {WEB_MAX_XML_BYTES} байт, пропускаю")
+            return None
+        try:
+            return await extraction_pool.run(parser, text)
+        except Exception as e:
+            logger.warning(f"Не удалось разобрать {url}: {str(e)}")
+            return None
+    
+    entries = []
+    for feed_items in await asyncio.gather(*(load(feed, parse_feed) for feed in discovery['feeds'])):
+        for item in feed_items or []:
+            # В ленте только последние материалы, поэтому статьи без даты из нее не отбрасываются
+            item['from_feed'] = True
+            entries.append(item)
+    
+    children = []
+    for parsed in await asyncio.gather(*(load(sitemap, parse_sitemap) for sitemap in discovery['sitemaps'])):
+        if parsed:
+            entries.extend(parsed[0])
+            children.extend(parsed[1])
+    
+    # Индекс sitemap может ссылаться на сотни файлов, берем только последние обновленные
+    children.sort(key=lambda item: item['published'] or '', reverse=True)
+    children = children[:FEED_MAX_CHILD_SITEMAPS]
+    for child, parsed in zip(children, await asyncio.gather(*(load(child['url'], parse_sitemap) for child in children))):
+        if not parsed:
+            continue
+        for article in parsed[0]:
+            # Без lastmod у адреса берем lastmod вложенного sitemap из индекса
+            article['published'] = article['published'] or child['published']
+            entries.append(article)
+    return entries
+
+async def fetch_feed_article(entry: dict, source_url: str, semaphore: asyncio.Semaphore) -> Optional[dict]:
+    """Загружает статью из ленты и возвращает ее как отдельный пост с датой публикации"""
+    async with semaphore:
+        html, truncated = await fetch_feed_text(entry['url'])
+        if not html:
+            return None
+        content, method = await extraction_pool.extract(html)
+    
+    if not content or len(content) < 100:
+        logger.warning(f"Не удалось извлечь текст статьи {entry['url']}")
+        return None
+    if len(content) > FEED_ARTICLE_MAX_CHARS:
+        content = content[:FEED_ARTICLE_MAX_CHARS] + "... (текст обрезан из-за большого размера)"
+    
+    title = entry.get('title') or entry['url']
+    if entry['published']:
+        published = datetime.fromisoformat(entry['published'])
+        date_note = ""
+    else:
+        published = datetime.now(timezone.utc)
+        date_note = " (дата публикации в ленте не указана)"
+    return {
+        'date': published.strftime('%Y-%m-%d %H:%M:%S'),
+        'has_text': True,
+        'text': f"Статья «{title}» ({entry['url']}){date_note}:\n\n{content}",
+        'has_photo': False,
+        'photo_path': None,
+        'source_type': 'website',
+        'source': source_url,
+        'source_url': entry['url'],
+        'fetch_method': 'feed',
+        'truncated': truncated
+    }
+
+async def get_website_articles(url: str, hours: int = 24) -> Optional[list]:
+    """
+    Получает статьи сайта, опубликованные за последние hours часов, через RSS/Atom или sitemap
+    
+    Returns:
+        Список постов (по одному на статью) или None, если у сайта нет лент и sitemap
+        либо из них ничего не удалось получить - тогда сайт загружается целой страницей.
+    """
+    discovery = await discover_website_feeds(url)
+    if not discovery['feeds'] and not discovery['sitemaps']:
+        return None
+    
+    entries = await collect_feed_entries(discovery)
+    if not entries:
+        logger.warning(f"Ленты и sitemap сайта {url} не дали ни одной статьи")
+        return None
+    
+    # Оставляем статьи за выбранный период, без повторов, сначала самые свежие.
+    # Статьи лент без даты идут после датированных, адреса sitemap без даты пропускаются
+    threshold = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
+    recent = {}
+    undated = {}
+    skipped_undated = set()
+    for entry in entries:
+        if entry['published']:
+            if entry['published'] >= threshold and entry['url'] not in recent:
+                recent[entry['url']] = entry
+        elif entry.get('from_feed'):
+            undated.setdefault(entry['url'], entry)
+        else:
+            skipped_undated.add(entry['url'])
+    if skipped_undated:
+        logger.info(f"Сайт {url}: пропущено адресов sitemap без даты: {len(skipped_undated)}")
+    recent_entries = sorted(recent.values(), key=lambda item: item['published'], reverse=True)
+    recent_entries += [entry for entry_url, entry in undated.items() if entry_url not in recent]
+    if len(recent_entries) > FEED_MAX_ARTICLES:
+        logger.info(f"Сайт {url}: статей за период {len(recent_entries)}, загружаю {FEED_MAX_ARTICLES} самых свежих")
+        recent_entries = recent_entries[:FEED_MAX_ARTICLES]
+    
+    if not recent_entries:
+        return [{
+            'date': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            'has_text': True,
+            'text': f"На сайте {url} нет новых статей за последние {hours} ч.",
+            'has_photo': False,
+            'photo_path': None,
+            'source_type': 'website',
+            'source': url,
+            'source_url': url,
+            'fetch_method': 'feed'
+        }]
+    
+    semaphore = asyncio.Semaphore(FEED_ARTICLE_CONCURRENCY)
+    articles = await asyncio.gather(*(fetch_feed_article(entry, url, semaphore) for entry in recent_entries))
+    posts = [post for post in articles if post]
+    logger.info(f"Сайт {url}: загружено статей {len(posts)} из {len(recent_entries)}")
+    return posts or None
+
+# Скачивание фото идет отдельной стадией с собственным лимитом параллельности
+photo_download_semaphore = asyncio.Semaphore(PHOTO_DOWNLOAD_CONCURRENCY)
+photo_download_tasks = {}  # {id фото в Telegram: asyncio.Task}
+
+def schedule_photo_download(message) -> asyncio.Task:
+    """
+    Ставит фото сообщения в очередь на скачивание и возвращает задачу с путем к файлу
+    
+    Фото дедуплицируются по id в Telegram, поэтому пересланные копии скачиваются один раз.
+    """
+    photo_id = message.photo.id
+    task = photo_download_tasks.get(photo_id)
+    if task is not None:
+        # Фото уже скачивается - ждем ту же задачу
+        return task
+    
+    task = asyncio.create_task(download_message_photo(message))
+    photo_download_tasks[photo_id] = task
+    # Завершенные задачи не держим: уже скачанный файл переиспользует download_message_photo
+    task.add_done_callback(lambda _: photo_download_tasks.pop(photo_id, None))
+    return task
+
+async def fetch_post_photos(posts: list) -> list:
+    """
+    Скачивает фото для постов, у которых есть ссылки на фото (photo_refs)
+    
+    Сообщения запрашиваются пачкой по каждому каналу, а скачивание идет через общую очередь.
+    
+    Returns:
+        Список путей к скачанным файлам
+    """
+    refs_by_channel = {}
+    for post in posts:
+        if post.get('has_photo') and post.get('photo_refs') and not post.get('photo_paths'):
+            for index, photo_ref in enumerate(post['photo_refs']):
+                refs_by_channel.setdefault(photo_ref['channel'], []).append((post, index, photo_ref['message_id']))
+    
+    async def schedule_channel(channel_link: str, channel_refs: list) -> list:
+        try:
+            channel, _ = await resolve_channel(channel_link)
+            messages = await telegram_scheduler.call(
+                'get_messages',
+                client.get_messages,
+                channel,
+                ids=[message_id for _, _, message_id in channel_refs]
+            )
+        except Exception as e:
+            logger.error(f"Не удалось получить сообщения с фото из канала {channel_link}: {str(e)}")
+            return []
+        return [
+            (post, index, schedule_photo_download(message))
+            for (post, index, _), message in zip(channel_refs, messages)
+            if message and message.photo
+        ]
+    
+    scheduled = await asyncio.gather(*(
+        schedule_channel(channel_link, channel_refs)
+        for channel_link, channel_refs in refs_by_channel.items()
+    ))
+    pending = [item for channel_items in scheduled for item in channel_items]
+    # Сортируем по позиции в альбоме, чтобы сохранить порядок фото
+    pending.sort(key=lambda item: item[1])
+    results = await asyncio.gather(*(task for _, _, task in pending))
+    
+    photo_paths = []
+    for (post, _, _), path in zip(pending, results):
+        if path:
+            post['photo_paths'].append(path)
+            photo_paths.append(path)
+    logger.info(f"Скачано {len(photo_paths)} фото для анализа")
+    return photo_paths
+
 async def download_message_photo(message, folder_name="photo"):
     """Скачивает фото из сообщения если оно есть и возвращает путь к файлу"""
     if not message.photo:
@@ -1729,13 +3043,25 @@ async def download_message_photo(message, folder_name="photo"):
     # Создаем директорию если её нет
     os.makedirs(folder_name, exist_ok=True)
     
-    # Генерируем уникальное имя файла на основе даты и ID сообщения
-    file_name = f"{message.date.strftime('%Y%m%d_%H%M%S')}_{message.id}.jpg"
+    # Имя файла по id фото, чтобы одинаковые фото не скачивались повторно
+    file_name = f"{message.photo.id}.jpg"
     temp_path = os.path.join(folder_name, file_name)
+    if os.path.exists(temp_path):
+        return temp_path
     
     try:
-        # Скачиваем фото
-        path = await client.download_media(message.photo, temp_path)
+        async with photo_download_semaphore:
+            # Скачиваем наименьший подходящий размер фото
+            path = await telegram_scheduler.call(
+                'download_media',
+                client.download_media,
+                message.photo,
+                temp_path,
+                thumb=choose_photo_thumb(message.photo, PHOTO_MAX_DIMENSION)
+            )
+        if not path:
+            logger.warning(f"Telethon не скачал фото {message.photo.id}")
+            return None
         logger.info(f"Скачано фото: {path}")
         
         return path
@@ -1743,6 +3069,166 @@ async def download_message_photo(message, folder_name="photo"):
         logger.error(f"Ошибка при скачивании фото: {str(e)}")
         return None
 
+# Семафоры ограничивают параллельность отдельно для Telethon и HTTP
+telethon_fetch_semaphore = asyncio.Semaphore(TELETHON_FETCH_CONCURRENCY)
+http_fetch_semaphore = asyncio.Semaphore(HTTP_FETCH_CONCURRENCY)
+
+channel_fetch_flight = SingleFlight(SINGLE_FLIGHT_TTL)
+
+async def fetch_channel_posts_limited(channel_link: str, hours: int) -> list:
+    """Загружает посты канала с учетом лимита параллельных загрузок Telethon"""
+    async with telethon_fetch_semaphore:
+        return await get_channel_posts(channel_link, hours=hours)
+
+def hash_paragraph(paragraph: str) -> str:
+    """Хэш абзаца без учета регистра и пробелов"""
+    normalized = ' '.join(paragraph.lower().split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+def is_website_diff_enabled(user: dict, folder: str) -> bool:
+    """Включен ли для папки режим отправки только изменений сайтов"""
+    return folder in user['ai_settings'].get('website_diff_folders', [])
+
+def get_website_diff_scope(user_id: int, folder: str) -> str:
+    """Область сравнения сайтов: у каждой папки пользователя своя последняя версия страницы"""
+    return f"{user_id}:{folder}"
+
+def apply_website_diff(posts: list, scope: str) -> list:
+    """
+    Оставляет в постах сайтов только новые или измененные абзацы с прошлого анализа
+    
+    Хэши абзацев текущей версии кладутся в пост (paragraph_hashes) и сохраняются
+    save_website_snapshots только после доставки отчета: если анализ не удался,
+    следующий запуск сравнивается с той же версией.
+    """
+    for post in posts:
+        content = post.get('page_content')
+        url = post.get('source_url')
+        if not content or not url:
+            continue
+        
+        paragraphs = [paragraph.strip() for paragraph in content.split('\n') if paragraph.strip()]
+        hashes = [hash_paragraph(paragraph) for paragraph in paragraphs]
+        post['paragraph_hashes'] = hashes
+        previous = get_website_snapshot(scope, url)
+        
+        # Первый анализ сайта в этой папке - отправляем страницу целиком
+        if previous is None:
+            continue
+        
+        new_paragraphs = [paragraph for paragraph, paragraph_hash in zip(paragraphs, hashes) if paragraph_hash not in previous]
+        if new_paragraphs:
+            post['text'] = f"Новое на сайте {url} с прошлого анализа:\n\n" + "\n".join(new_paragraphs)
+        else:
+            post['text'] = f"На сайте {url} нет изменений с прошлого анализа."
+        post['changed_paragraphs'] = len(new_paragraphs)
+        logger.info(f"Сайт {url}: новых абзацев {len(new_paragraphs)} из {len(paragraphs)}")
+    
+    return posts
+
+def save_website_snapshots(scope: str, posts: list):
+    """Сохраняет версии страниц, вошедших в доставленный отчет, для следующего сравнения"""
+    for post in posts:
+        if post.get('paragraph_hashes') is not None and post.get('source_url'):
+            save_website_snapshot(scope, post['source_url'], set(post['paragraph_hashes']))
+
+async def fetch_source(source: str, hours: int = 24, diff_scope: Optional[str] = None) -> dict:
+    """
+    Загружает один источник с учетом лимитов параллельности и замеряет время загрузки
+    
+    Для сайтов при заданном diff_scope (см. get_website_diff_scope) остаются только
+    изменения с прошлого анализа. Без него сайт отправляется целиком.
+    """
+    result = {'source': source, 'type': None, 'posts': [], 'error': None, 'elapsed': 0.0}
+    
+    source_info = is_valid_source(source)
+    if not source_info["valid"]:
+        result['error'] = "Невалидный формат источника"
+        return result
+    result['type'] = source_info["type"]
+    
+    start_time = time.monotonic()
+    try:
+        if source_info["type"] == "channel":
+            # Один и тот же канал из разных папок и у разных пользователей загружается один раз
+            posts = await channel_fetch_flight.run(
+                (normalize_channel_username(source), hours),
+                fetch_channel_posts_limited,
+                source,
+                hours
+            )
+            if posts:
+                # Добавляем информацию об источнике
+                for post in posts:
+                    post['source_type'] = 'channel'
+                    post['source'] = source
+                result['posts'] = posts
+            else:
+                result['error'] = "Не удалось получить посты"
+        else:
+            for attempt in range(WEB_RATE_LIMIT_RETRIES + 1):
+                try:
+                    async with http_fetch_semaphore:
+                        # Сначала пробуем получить отдельные статьи за период из RSS/Atom или sitemap
+                        website_content = await get_website_articles(source, hours)
+                        if website_content is None:
+                            website_content = await get_website_content(source)
+                    break
+                except DomainRateLimited as e:
+                    if attempt == WEB_RATE_LIMIT_RETRIES or e.retry_after > WEB_RETRY_AFTER_MAX:
+                        raise
+                    # Ждем паузу домена, не занимая общий лимит загрузок: другие сайты идут дальше
+                    logger.info(f"Источник {source} повторно поставлен в очередь: {str(e)}")
+                    await domain_scheduler.wait_ready(source)
+            if not website_content:
+                result['error'] = "Не удалось получить контент"
+            elif any('error' in post for post in website_content):
+                error_post = next(post for post in website_content if 'error' in post)
+                result['error'] = error_post.get('error', 'Неизвестная ошибка')
+            else:
+                if diff_scope is not None:
+                    website_content = apply_website_diff(website_content, diff_scope)
+                result['posts'] = website_content
+    except Exception as e:
+        logger.error(f"Ошибка при обработке источника {source}: {str(e)}")
+        result['error'] = f"Ошибка: {str(e)}"
+    
+    result['elapsed'] = time.monotonic() - start_time
+    logger.info(f"Источник {source} обработан за {result['elapsed']:.2f} с, постов: {len(result['posts'])}")
+    return result
+
+async def fetch_folder_sources(sources: list, hours: int = 24,
+                               diff_scope: Optional[str] = None) -> Tuple[list, list, list]:
+    """
+    Параллельно загружает все источники папки
+    
+    Returns:
+        Кортеж (all_posts, error_sources, timings), где timings - список (источник, секунды)
+    """
+    start_time = time.monotonic()
+    results = await asyncio.gather(*(
+        fetch_source(source, hours, diff_scope) for source in sources
+    ))
+    
+    all_posts = []
+    error_sources = []
+    timings = []
+    for result in results:
+        timings.append((result['source'], result['elapsed']))
+        if result['error']:
+            error_sources.append((result['source'], result['error']))
+        else:
+            all_posts.extend(result['posts'])
+    
+    logger.info(
+        f"Загружено {len(sources)} источников за {time.monotonic() - start_time:.2f} с, "
+        f"постов: {len(all_posts)}, ошибок: {len(error_sources)}"
+    )
+    logger.info(f"Статистика запросов к Telegram: {telegram_scheduler.get_stats()}")
+    logger.info(f"Статистика HTTP-пула для сайтов: {web_http_client.get_stats()}")
+    logger.info(f"Статистика планировщика запросов к сайтам: {domain_scheduler.get_stats()}")
+    return all_posts, error_sources, timings
+
 @dp.message_handler(lambda message: message.text == "📊 История отчетов")
 async def show_reports(message: types.Message):
     user_id = message.from_user.id
@@ -1964,23 +3450,24 @@ async def run_scheduled_analysis(user_id: int, folder: str):
         user = user_data.get_user_data(user_id)
         channels = user['folders'][folder]
         
-        all_posts = []
-        for channel in channels:
-            if not is_valid_channel(channel):
-                continue
-                
-            posts = await get_channel_posts(channel)
-            if posts:
-                all_posts.extend(posts)
+        all_posts, _, _ = await fetch_folder_sources(
+            [channel for channel in channels if is_valid_channel(channel)]
+        )
                 
         if not all_posts:
             logger.error(f"Не удалось получить посты для автоматического анализа папки {folder}")
             return
             
+        all_posts = await asyncio.to_thread(deduplicate_posts, all_posts, DEDUP_SIMHASH_DISTANCE, DEDUP_MIN_WORDS)
+        prompt = user['prompts'][folder]
+        
+        # Отбрасываем наименее важные посты, если все не помещаются в бюджет модели
+        all_posts, dropped_posts = pack_posts_for_model(all_posts, prompt, get_user_model(user_id))
+        if dropped_posts:
+            logger.warning(f"Автоматический анализ папки {folder}: не вошло в бюджет модели {len(dropped_posts)} постов")
         posts_text = "\n\n---\n\n".join([
-            f"[{post['date']}]\n{post['text']}" for post in all_posts
+            format_post_for_prompt(post) for post in all_posts
         ])
-        prompt = user['prompts'][folder]
         
         response = await try_gpt_request(prompt, posts_text, user_id, bot, user_data)
         
@@ -1991,9 +3478,12 @@ async def run_scheduled_analysis(user_id: int, folder: str):
         logger.info("отчет удался")
         
         # Отправляем уведомление пользователю
+        dropped_info = (f"⚠️ В лимит контекста модели не вошло постов: {len(dropped_posts)}\n"
+                        if dropped_posts else "")
         await bot.send_message(
             user_id,
             f"✅ Автоматический анализ папки {folder} завершен!\n"
+            f"{dropped_info}"
             f"Используйте '📊 История отчетов' чтобы просмотреть результат."
         )
         
@@ -2150,60 +3640,29 @@ async def process_analysis_choice(callback_query: types.CallbackQuery):
     for folder, sources in folders:
         await callback_query.message.answer(f"Анализирую папку {folder}...")
         
-        all_posts = []
-        error_sources = []  # Список источников с ошибками
+        # Загружаем все источники папки параллельно
+        status_message = await callback_query.message.answer(f"🔄 Получаю данные из {len(sources)} источников...")
+        fetch_started = time.monotonic()
+        # Для сайтов отправляем только изменения, если этот режим включен для папки
+        diff_scope = get_website_diff_scope(user_id, folder) if is_website_diff_enabled(user, folder) else None
+        all_posts, error_sources, timings = await fetch_folder_sources(
+            sources,
+            hours=hours,
+            diff_scope=diff_scope
+        )
+        total_time = time.monotonic() - fetch_started
         
-        # Обрабатываем все источники в папке
-        for source in sources:
-            source_info = is_valid_source(source)
-            
-            if not source_info["valid"]:
-                await callback_query.message.answer(f"⚠️ Невалидный источник: {source}")
-                error_sources.append((source, "Невалидный формат источника"))
-                continue
-                
-            if source_info["type"] == "channel":
-                # Обработка Telegram-канала
-                posts = await get_channel_posts(source, hours=hours)
-                if posts:
-                    # Добавляем информацию об источнике
-                    for post in posts:
-                        post['source_type'] = 'channel'
-                        post['source'] = source
-                    all_posts.extend(posts)
-                else:
-                    error_message = f"⚠️ Не удалось получить посты из канала {source}"
-                    await callback_query.message.answer(error_message)
-                    error_sources.append((source, "Не удалось получить посты"))
-                    
-            elif source_info["type"] == "website":
-                # Обработка веб-сайта
-                try:
-                    # Запускаем парсинг веб-сайта
-                    status_message = await callback_query.message.answer(f"🔄 Получаю данные с сайта {source}...")
-                    
-                    website_content = await get_website_content(source)
-                    
-                    if website_content:
-                        # Проверяем на наличие ошибки в ответе
-                        if any('error' in post for post in website_content):
-                            error_post = next(post for post in website_content if 'error' in post)
-                            error_text = error_post.get('error', 'Неизвестная ошибка')
-                            error_message = f"⚠️ Проблема с сайтом {source}: {error_text}"
-                            await status_message.edit_text(error_message)
-                            error_sources.append((source, error_text))
-                        else:
-                            all_posts.extend(website_content)
-                            await status_message.edit_text(f"✅ Успешно получены данные с сайта {source}")
-                    else:
-                        error_message = f"⚠️ Не удалось получить контент с сайта {source}"
-                        await status_message.edit_text(error_message)
-                        error_sources.append((source, "Не удалось получить контент"))
-                except Exception as e:
-                    logger.error(f"Ошибка при парсинге сайта {source}: {str(e)}")
-                    error_message = f"❌ Ошибка при анализе сайта {source}: {str(e)}"
-                    await callback_query.message.answer(error_message)
-                    error_sources.append((source, f"Ошибка: {str(e)}"))
+        slowest = sorted(timings, key=lambda item: item[1], reverse=True)[:3]
+        await status_message.edit_text(
+            f"✅ Получены данные из {len(sources) - len(error_sources)} из {len(sources)} источников за {total_time:.1f} с"
+            + ("\n\nДольше всего загружались:" if slowest else "")
+            + "".join([f"\n- {src}: {elapsed:.1f} с" for src, elapsed in slowest])
+        )
+        if error_sources:
+            await callback_query.message.answer(
+                "⚠️ Проблемы с источниками:"
+                + "".join([f"\n- {src}: {err}" for src, err in error_sources])
+            )
         
         if not all_posts:
             await callback_query.message.answer(
@@ -2231,24 +3690,39 @@ async def process_analysis_choice(callback_query: types.CallbackQuery):
                 + "".join([f"\n- {src}: {err}" for src, err in error_sources])
             )
             continue
+        
+        # Схлопываем перепосты одной и той же новости разными источниками
+        all_posts = await asyncio.to_thread(deduplicate_posts, all_posts, DEDUP_SIMHASH_DISTANCE, DEDUP_MIN_WORDS)
             
-        # Проверяем, есть ли изображения в постах и включены ли они в настройках
-        has_images = photos_enabled and any(post.get('has_photo', False) for post in all_posts)
+        # Изображения отправляются только если они включены и выбрана модель OpenRouter:
+        # модели Monica работают только с текстом
+        images_supported = get_user_model(user_id) in OPENROUTER_MODELS
+        has_images = photos_enabled and images_supported and any(post.get('has_photo', False) for post in all_posts)
         
-        # Если фотографии отключены, очищаем пути к фото в постах
-        if not photos_enabled:
+        # Если фотографии не будут использоваться, убираем ссылки на фото из постов
+        if not has_images:
             for post in all_posts:
                 if post.get('has_photo', False):
                     post['has_photo'] = False
-                    post['photo_path'] = None
-                    logger.info(f"Фотография отключена в соответствии с настройками пользователя")
+                    post['photo_refs'] = []
+            if not photos_enabled:
+                logger.info("Фотографии отключены в соответствии с настройками пользователя")
+        
+        # Оставляем посты, помещающиеся в бюджет модели (с изображениями - в один запрос),
+        # до скачивания фото, чтобы не загружать лишние
+        all_posts, dropped_posts = pack_posts_for_model(
+            all_posts, user['prompts'][folder], get_user_model(user_id), with_images=has_images
+        )
+        if dropped_posts:
+            await callback_query.message.answer(
+                f"⚠️ В лимит контекста модели не вошло постов: {len(dropped_posts)} из {len(all_posts) + len(dropped_posts)}. "
+                f"Отброшены наименее важные: без повторов в других источниках и более старые."
+            )
         
         if has_images:
             photos_used = True
-            # Собираем пути ко всем используемым фотографиям
-            for post in all_posts:
-                if post.get('has_photo', False) and post.get('photo_path'):
-                    photo_paths.append(post['photo_path'])
+            # Скачиваем фото только сейчас, когда точно известно, что они будут отправлены
+            photo_paths.extend(await fetch_post_photos(all_posts))
         
         # Если есть изображения - используем новую функцию для анализа с изображениями
         prompt = user['prompts'][folder]
@@ -2256,11 +3730,11 @@ async def process_analysis_choice(callback_query: types.CallbackQuery):
         # Добавляем информацию о требуемом формате в промт
         format_instructions = ""
         if report_format == 'txt':
-            format_instructions = "\n\nФОРМАТ ОТВЕТА: Обычный текст без разметки. Используй только простое форматирование с разделами, заголовками и отступами."
+            format_instructions = FORMAT_INSTRUCTIONS_PREFIX + " Обычный текст без разметки. Используй только простое форматирование с разделами, заголовками и отступами."
         elif report_format == 'md':
-            format_instructions = "\n\nФОРМАТ ОТВЕТА: Markdown. Используй полное форматирование Markdown для заголовков (#, ##, ###), списков (*, -), жирного и курсивного текста (**жирный**, *курсив*), ссылок [текст](url), цитат (>) и разделителей (---)."
+            format_instructions = FORMAT_INSTRUCTIONS_PREFIX + " Markdown. Используй полное форматирование Markdown для заголовков (#, ##, ###), списков (*, -), жирного и курсивного текста (**жирный**, *курсив*), ссылок [текст](url), цитат (>) и разделителей (---)."
         else:  # pdf
-            format_instructions = "\n\nФОРМАТ ОТВЕТА: PDF-совместимый текст. Учитывай, что ответ будет преобразован в PDF документ. Используй четкую структуру с заголовками, разделами и абзацами. Избегай сложного форматирования, которое может плохо отображаться в PDF."
+            format_instructions = FORMAT_INSTRUCTIONS_PREFIX + " PDF-совместимый текст. Учитывай, что ответ будет преобразован в PDF документ. Используй четкую структуру с заголовками, разделами и абзацами. Избегай сложного форматирования, которое может плохо отображаться в PDF."
         
         modified_prompt = prompt + format_instructions
         
@@ -2274,15 +3748,11 @@ async def process_analysis_choice(callback_query: types.CallbackQuery):
                     bot, 
                     user_data
                 )
-                
-                # Файлы уже сохранены в папке photo, добавляем пути в список для последующего удаления
-                for post in all_posts:
-                    if post.get('has_photo', False) and post.get('photo_path'):
-                        photo_paths.append(post['photo_path'])
+
             else:
                 # Используем стандартную функцию для анализа только текста
                 posts_text = "\n\n---\n\n".join([
-                    f"[{post['date']}]\n{post['text']}" for post in all_posts if post.get('has_text', False)
+                    format_post_for_prompt(post) for post in all_posts if post.get('has_text', False)
                 ])
                 
                 response = await try_gpt_request(modified_prompt, posts_text, user_id, bot, user_data)
@@ -2325,6 +3795,10 @@ async def process_analysis_choice(callback_query: types.CallbackQuery):
                     caption=f"✅ Анализ для папки {folder} ({report_format.upper()})"
                 )
             
+            # Отчет доставлен - следующий анализ сайтов сравнивается с этими версиями
+            if diff_scope is not None:
+                save_website_snapshots(diff_scope, all_posts)
+            
             # Удаляем временный файл отчета выбранного формата, но сохраняем TXT копию
             os.remove(filename)
             
@@ -2856,19 +4330,36 @@ async def toggle_photos(callback_query: types.CallbackQuery, state: FSMContext =
     await ai_settings(message, state)
 
 async def main():
+    global live_ingestion_task
     try:
         # Инициализируем базу данных
         init_db()
         
+        # Запускаем процессы пула извлечения текста до старта фоновых потоков
+        await extraction_pool.start()
+        
         # Загружаем сохраненные модели пользователей
         load_models_from_user_data(user_data)
         logger.info("Загружены сохраненные модели пользователей")
         
+        # Открываем общие сессии к провайдерам ИИ
+        await start_provider_clients()
+        
         # Запускаем клиент Telethon
         await client.start()
         
+        # Очищаем устаревшие посты в локальном хранилище
+        prune_channel_posts()
+        
         # Запускаем планировщик
         scheduler.start()
+        scheduler.add_job(prune_channel_posts, 'cron', hour=3, minute=0, id="prune_channel_posts", replace_existing=True)
+        
+        # Запускаем живой прием постов в фоне, чтобы не задерживать старт бота
+        if LIVE_INGESTION_ENABLED:
+            live_ingestion_task = asyncio.create_task(start_live_ingestion())
+            live_ingestion_task.add_done_callback(on_live_ingestion_done)
+            logger.info("Живой режим приема постов включен")
         
         # Восстанавливаем сохраненные расписания
         for user_id, folder, time in get_active_schedules():
@@ -2901,9 +4392,16 @@ async def main():
         raise
     finally:
         # Закрываем все соединения
+        if live_ingestion_task is not None:
+            live_ingestion_task.cancel()
         await dp.storage.close()
         await dp.storage.wait_closed()
         await bot.session.close()
+        await web_http_client.close()
+        await close_provider_clients()
+        token_calibration.flush()
+        extraction_pool.shutdown()
+        cloudscraper_pool.shutdown()
         await client.disconnect()
         scheduler.shutdown()
 
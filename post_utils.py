@@ -0,0 +1,173 @@
+"""Посты: выбор размера фото, сборка постов каналов, поиск дубликатов и текст для модели"""
+import hashlib
+import logging
+import re
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import combinations
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+def choose_photo_size(photo, max_dimension: int):
+    """Выбирает наименьший размер фото, у которого большая сторона не меньше max_dimension"""
+    sizes = [size for size in photo.sizes if getattr(size, 'w', None) and getattr(size, 'h', None)]
+    if not sizes:
+        return None
+    sizes.sort(key=lambda size: max(size.w, size.h))
+    for size in sizes:
+        if max(size.w, size.h) >= max_dimension:
+            return size
+    # Все размеры меньше лимита - берем самый большой
+    return sizes[-1]
+
+def choose_photo_thumb(photo, max_dimension: int) -> Optional[str]:
+    """
+    Тип размера фото (например, 'y') для параметра thumb в download_media
+
+    Telethon принимает объект размера только для PhotoSize и пропускает
+    PhotoSizeProgressive, поэтому размер передается по типу. None - самый большой размер.
+    """
+    size = choose_photo_size(photo, max_dimension)
+    return size.type if size is not None else None
+
+def build_channel_posts(channel_link: str, stored_posts: list) -> list:
+    """
+    Собирает посты из сохраненных сообщений, объединяя альбомы (общий grouped_id) в один пост
+    
+    Пост альбома получает общую подпись и список ссылок на все его фото.
+    """
+    posts = []
+    albums = {}  # {grouped_id: пост альбома}
+    for message_id, date_ts, text, has_photo, grouped_id in stored_posts:
+        photo_ref = {'channel': channel_link, 'message_id': message_id}
+        
+        if grouped_id and grouped_id in albums:
+            post = albums[grouped_id]
+            if text and text.strip():
+                post['text'] = f"{text}\n{post['text']}" if post['text'] else text
+                post['has_text'] = True
+            if has_photo:
+                post['has_photo'] = True
+                post['photo_refs'].insert(0, photo_ref)
+            # Сообщения идут от новых к старым, датой альбома считаем самое раннее
+            post['date'] = datetime.fromtimestamp(date_ts, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            continue
+        
+        post = {
+            'date': datetime.fromtimestamp(date_ts, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            'has_text': bool(text and len(text.strip()) > 0),
+            'text': text or '',
+            'has_photo': bool(has_photo),
+            'photo_paths': [],
+            # Сами фото скачиваются лениво через fetch_post_photos
+            'photo_refs': [photo_ref] if has_photo else []
+        }
+        if grouped_id:
+            albums[grouped_id] = post
+        posts.append(post)
+    
+    return posts
+
+def normalize_post_text(text: str) -> list:
+    """Приводит текст поста к списку слов без ссылок, пунктуации и регистра"""
+    text = re.sub(r'https?://\S+|@\w+', ' ', text.lower())
+    return re.findall(r'\w+', text.replace('ё', 'е'))
+
+def simhash(words: list, shingle_size: int = 2) -> int:
+    """Считает 64-битный SimHash по шинглам из нескольких слов (для коротких постов хватает пар слов)"""
+    if len(words) < shingle_size:
+        shingles = [' '.join(words)]
+    else:
+        shingles = [' '.join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)]
+    
+    # Биты хэшей шинглов строками '0'/'1': столбцы считаются через zip без цикла по битам
+    hashes = [format(int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big'), '064b')
+              for shingle in shingles]
+    half = len(hashes) / 2
+    bits = ''.join('1' if column.count('1') > half else '0' for column in zip(*hashes))
+    return int(bits, 2)
+
+def get_post_source(post: dict) -> str:
+    return post.get('source') or post.get('source_url') or ''
+
+# Число полос SimHash для поиска кандидатов в дубликаты (полосы по 64 // DEDUP_BANDS бит)
+DEDUP_BANDS = 4
+
+@lru_cache(maxsize=None)
+def get_probe_masks(bits: int, radius: int) -> tuple:
+    """Все маски из bits бит, в которых не больше radius единиц (начиная с нулевой)"""
+    return tuple(
+        sum(1 << bit for bit in positions)
+        for count in range(radius + 1)
+        for positions in combinations(range(bits), count)
+    )
+
+def deduplicate_posts(posts: list, max_distance: int, min_words: int) -> list:
+    """
+    Убирает почти одинаковые посты (перепосты одной новости разными каналами)
+    
+    Из каждой группы остается самый ранний пост, а в его поле 'also_in' записываются
+    остальные источники, опубликовавшие ту же новость. Посты короче min_words слов
+    не сравниваются. max_distance - наибольшее расстояние Хэмминга между SimHash.
+    """
+    # Сигнатура делится на DEDUP_BANDS полос по 16 бит. У хэшей на расстоянии не больше
+    # max_distance хотя бы одна полоса отличается не больше чем на radius бит. Радиус делится
+    # между записью и поиском (multi-probe): представитель записывается под всеми значениями
+    # полосы в радиусе radius // 2, а пост ищется по значениям в оставшемся радиусе
+    band_bits = 64 // DEDUP_BANDS
+    band_mask = (1 << band_bits) - 1
+    radius = max_distance // DEDUP_BANDS
+    insert_probes = get_probe_masks(band_bits, radius // 2)
+    query_probes = get_probe_masks(band_bits, radius - radius // 2)
+    buckets = [{} for _ in range(DEDUP_BANDS)]  # по полосам: {значение полосы: [индексы представителей]}
+    representatives = []  # [(simhash, пост)]
+    duplicates = set()  # id() удаленных постов
+    
+    for post in sorted(posts, key=lambda x: x.get('date', '')):
+        words = normalize_post_text(post.get('text', '')) if post.get('has_text', False) else []
+        if len(words) < min_words:
+            continue
+        signature = simhash(words)
+        band_values = [signature >> (band * band_bits) & band_mask for band in range(DEDUP_BANDS)]
+        
+        match = None
+        checked = set()
+        for band, value in enumerate(band_values):
+            band_buckets = buckets[band]
+            for probe in query_probes:
+                for index in band_buckets.get(value ^ probe, ()):
+                    if index in checked:
+                        continue
+                    checked.add(index)
+                    if bin(signature ^ representatives[index][0]).count('1') <= max_distance:
+                        match = representatives[index][1]
+                        break
+                if match:
+                    break
+            if match:
+                break
+        
+        if match:
+            source = get_post_source(post)
+            also_in = match.setdefault('also_in', [])
+            if source and source != get_post_source(match) and source not in also_in:
+                also_in.append(source)
+            duplicates.add(id(post))
+            continue
+        
+        representatives.append((signature, post))
+        for band, value in enumerate(band_values):
+            for probe in insert_probes:
+                buckets[band].setdefault(value ^ probe, []).append(len(representatives) - 1)
+    
+    if duplicates:
+        logger.info(f"Удалено {len(duplicates)} почти одинаковых постов из {len(posts)}")
+    return [post for post in posts if id(post) not in duplicates]
+
+def format_post_for_prompt(post: dict) -> str:
+    """Форматирует пост для передачи в модель"""
+    text = f"[{post['date']}]\n{post['text']}"
+    if post.get('also_in'):
+        text += f"\n(Также опубликовано: {', '.join(post['also_in'])})"
+    return text
@@ -0,0 +1,352 @@
+import asyncio
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+from aiohttp import web
+
+from fetch_utils import (
+    DomainRateLimited, DomainScheduler, PooledHttpClient, SingleFlight, detect_charset, evict_cache_files,
+    parse_retry_after, read_response_text, sniff_charset
+)
+
+
+class FakeContent:
+    def __init__(self, body: bytes, chunk_size: int):
+        self.body = body
+        self.chunk_size = chunk_size
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+
+
+class FakeResponse:
+    """Ответ aiohttp с телом, которое отдается потоком фрагментами chunk_size"""
+    def __init__(self, body: bytes, charset=None, chunk_size: int = 1000, content_length=None):
+        self.content = FakeContent(body, chunk_size)
+        self.charset = charset
+        self.content_length = content_length
+        self.url = 'https://example.com/'
+
+
+def read(response, max_bytes=10 ** 6):
+    return asyncio.run(read_response_text(response, max_bytes))
+
+
+RUSSIAN_TEXT = 'Новости Республики Башкортостан: в Уфе открылся новый парк. ' * 20
+
+
+def test_declared_charset_is_used():
+    text, truncated = read(FakeResponse(RUSSIAN_TEXT.encode('cp1251'), charset='windows-1251'))
+    assert text == RUSSIAN_TEXT
+    assert not truncated
+
+
+def test_meta_charset_is_used():
+    body = '<html><head><meta charset="windows-1251"></head><body>' + RUSSIAN_TEXT + '</body></html>'
+    text, _ = read(FakeResponse(body.encode('cp1251')))
+    assert RUSSIAN_TEXT in text
+
+
+def test_undeclared_cp1251_is_detected():
+    body = '<html><body><p>' + RUSSIAN_TEXT + '</p></body></html>'
+    text, _ = read(FakeResponse(body.encode('cp1251')))
+    assert RUSSIAN_TEXT in text
+
+
+def test_undeclared_cp1251_after_long_ascii_head():
+    # Без кодировки в заголовках и meta, а первые килобайты - только ASCII (скрипты, стили)
+    head = '<html><head><script>' + 'var x = 1;\n' * 1000 + '</script></head>'
+    body = head + '<body><p>' + RUSSIAN_TEXT + '</p></body></html>'
+    text, _ = read(FakeResponse(body.encode('cp1251'), chunk_size=4096))
+    assert RUSSIAN_TEXT in text
+
+
+def test_undeclared_utf8_split_across_chunks():
+    body = ('<p>' + RUSSIAN_TEXT + '</p>').encode('utf-8')
+    # Нечетный размер фрагмента разрезает двухбайтовые символы
+    text, _ = read(FakeResponse(body, chunk_size=4097))
+    assert RUSSIAN_TEXT in text
+
+
+def test_response_is_truncated_to_limit():
+    body = b'a' * 10000
+    text, truncated = read(FakeResponse(body, chunk_size=3000), max_bytes=5000)
+    assert text == 'a' * 5000
+    assert truncated
+
+
+def test_content_length_over_limit_marks_truncated():
+    _, truncated = read(FakeResponse(b'abc', content_length=10 ** 7), max_bytes=100)
+    assert truncated
+
+
+def test_sniff_charset_from_meta_and_xml_declaration():
+    assert sniff_charset(b'<meta http-equiv="Content-Type" content="text/html; charset=koi8-r">') == 'koi8-r'
+    assert sniff_charset(b"<?xml version='1.0' encoding='windows-1251'?><rss>") == 'windows-1251'
+    assert sniff_charset(b'<html><body>') is None
+
+
+def test_detect_charset_prefers_valid_utf8():
+    assert detect_charset('Привет, мир'.encode('utf-8')) == 'utf-8'
+    assert detect_charset(RUSSIAN_TEXT.encode('cp1251')) == 'cp1251'
+
+
+def test_single_flight_shares_concurrent_calls_and_copies_results():
+    calls = []
+
+    async def fetch(name):
+        calls.append(name)
+        await asyncio.sleep(0.01)
+        return [{'text': name}]
+
+    async def scenario():
+        flight = SingleFlight(ttl=60)
+        first, second = await asyncio.gather(
+            flight.run('@channel', fetch, '@channel'),
+            flight.run('@channel', fetch, '@channel'),
+        )
+        first[0]['source'] = 'folder-a'
+        third = await flight.run('@channel', fetch, '@channel')
+        return flight, first, second, third
+
+    flight, first, second, third = asyncio.run(scenario())
+    assert calls == ['@channel']
+    assert (flight.misses, flight.hits) == (1, 2)
+    # Каждый вызов получает свою копию постов
+    assert second == [{'text': '@channel'}]
+    assert third == [{'text': '@channel'}]
+
+
+def test_single_flight_does_not_keep_empty_or_failed_results():
+    results = iter([[], RuntimeError('сбой'), [{'text': 'ok'}]])
+
+    async def fetch():
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def scenario():
+        flight = SingleFlight(ttl=60)
+        empty = await flight.run('key', fetch)
+        try:
+            await flight.run('key', fetch)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('исключение загрузки должно доходить до вызывающего')
+        return empty, await flight.run('key', fetch), flight.misses
+
+    empty, loaded, misses = asyncio.run(scenario())
+    assert empty == []
+    assert loaded == [{'text': 'ok'}]
+    assert misses == 3
+
+
+def test_single_flight_expires_after_ttl():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return ['post']
+
+    async def scenario():
+        flight = SingleFlight(ttl=0)
+        await flight.run('key', fetch)
+        await asyncio.sleep(0.01)
+        await flight.run('key', fetch)
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+
+def test_single_flight_cancelling_one_waiter_keeps_shared_fetch():
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return ['post']
+
+    async def scenario():
+        flight = SingleFlight(ttl=60)
+        first = asyncio.create_task(flight.run('key', fetch))
+        second = asyncio.create_task(flight.run('key', fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) == ['post']
+
+
+class FakeStatusResponse:
+    def __init__(self, status: int, retry_after=None):
+        self.status = status
+        self.headers = {'Retry-After': retry_after} if retry_after is not None else {}
+
+
+def make_scheduler(concurrency=1, min_interval=0.0, default_backoff=0.05, retry_after_max=1.0):
+    return DomainScheduler(concurrency, min_interval, default_backoff, retry_after_max)
+
+
+def test_parse_retry_after_seconds_and_http_date():
+    assert parse_retry_after('120') == 120.0
+    assert parse_retry_after(' 5 ') == 5.0
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=60)
+    assert 55 <= parse_retry_after(format_datetime(retry_at, usegmt=True)) <= 60
+    # Дата в прошлом - ждать не нужно
+    assert parse_retry_after('Tue, 10 Jun 2025 12:00:00 GMT') == 0.0
+    assert parse_retry_after('скоро') is None
+    assert parse_retry_after(None) is None
+
+
+def test_domain_scheduler_limits_concurrency_per_domain():
+    active = {'count': 0, 'max': 0}
+
+    async def request(scheduler, url):
+        async with scheduler.slot(url):
+            active['count'] += 1
+            active['max'] = max(active['max'], active['count'])
+            await asyncio.sleep(0.01)
+            active['count'] -= 1
+
+    async def scenario():
+        scheduler = make_scheduler(concurrency=2)
+        await asyncio.gather(*(request(scheduler, f'https://example.com/{i}') for i in range(6)))
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert active['max'] == 2
+    assert scheduler.get_stats()['requests'] == 6
+    assert scheduler.get_stats()['domains'] == 1
+
+
+def test_domain_scheduler_keeps_min_interval_between_starts():
+    starts = []
+
+    async def request(scheduler, url):
+        async with scheduler.slot(url):
+            starts.append(time.monotonic())
+
+    async def scenario():
+        scheduler = make_scheduler(concurrency=3, min_interval=0.05)
+        await asyncio.gather(*(request(scheduler, 'https://Example.com/news') for _ in range(3)))
+
+    asyncio.run(scenario())
+    gaps = [later - earlier for earlier, later in zip(starts, starts[1:])]
+    assert all(gap >= 0.045 for gap in gaps)
+
+
+def test_domain_scheduler_domains_do_not_block_each_other():
+    async def scenario():
+        scheduler = make_scheduler(min_interval=10)
+        started = time.monotonic()
+        async with scheduler.slot('https://a.example.com/'):
+            pass
+        async with scheduler.slot('https://b.example.com/'):
+            pass
+        return time.monotonic() - started, scheduler.get_stats()
+
+    elapsed, stats = asyncio.run(scenario())
+    assert elapsed < 1
+    assert stats['domains'] == 2
+    assert stats['waited'] == 0
+
+
+def test_domain_scheduler_penalize_pauses_domain():
+    async def scenario():
+        scheduler = make_scheduler()
+        assert scheduler.penalize('https://example.com/', None) == 0.05
+        started = time.monotonic()
+        async with scheduler.slot('https://example.com/other'):
+            pass
+        return time.monotonic() - started, scheduler.penalties
+
+    elapsed, penalties = asyncio.run(scenario())
+    assert elapsed >= 0.045
+    assert penalties == 1
+
+
+def test_domain_scheduler_raises_when_pause_is_too_long():
+    async def scenario():
+        scheduler = make_scheduler(retry_after_max=1)
+        scheduler.penalize('https://example.com/', 30)
+        async with scheduler.slot('https://example.com/'):
+            pass
+
+    with pytest.raises(DomainRateLimited) as error:
+        asyncio.run(scenario())
+    assert error.value.retry_after > 29
+
+
+def test_domain_scheduler_check_response():
+    scheduler = make_scheduler(default_backoff=7)
+    scheduler.check_response('https://example.com/', FakeStatusResponse(200))
+    # 503 без Retry-After - обычная ошибка сервера, домен не приостанавливаем
+    scheduler.check_response('https://example.com/', FakeStatusResponse(503))
+    assert scheduler.penalties == 0
+
+    with pytest.raises(DomainRateLimited) as error:
+        scheduler.check_response('https://example.com/', FakeStatusResponse(429))
+    assert error.value.retry_after == 7
+
+    with pytest.raises(DomainRateLimited) as error:
+        scheduler.check_response('https://example.com/', FakeStatusResponse(503, retry_after='20'))
+    assert error.value.retry_after == 20
+    assert scheduler.penalties == 2
+
+
+def test_domain_scheduler_check_status_accepts_plain_headers():
+    # Так проверяются ответы CloudScraper: статус и заголовки без объекта aiohttp
+    scheduler = make_scheduler()
+    with pytest.raises(DomainRateLimited) as error:
+        scheduler.check_status('https://example.com/', 503, {'Retry-After': '15'})
+    assert error.value.retry_after == 15
+    scheduler.check_status('https://other.example.com/', 403, {})
+    assert scheduler.penalties == 1
+
+
+def test_pooled_http_client_reuses_session_and_connections():
+    async def handler(request):
+        return web.Response(text='ok')
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        await web.SockSite(runner, sock).start()
+        client = PooledHttpClient('test', {'limit': 2, 'keepalive_timeout': 30})
+        try:
+            session = client.get_session()
+            for _ in range(3):
+                async with client.get_session().get(f'http://127.0.0.1:{port}/') as response:
+                    assert await response.text() == 'ok'
+            assert client.get_session() is session
+            stats = client.get_stats()
+        finally:
+            await client.close()
+            await runner.cleanup()
+        return stats, client.session
+
+    stats, session = asyncio.run(scenario())
+    assert stats == {'requests': 3, 'connections_created': 1, 'connections_reused': 2}
+    assert session is None
+
+
+def test_evict_cache_files_by_age_and_size(tmp_path):
+    now = time.time()
+    for name, age in [('old.json', 1000), ('lru.json', 50), ('recent.json', 10), ('notes.txt', 1000)]:
+        path = tmp_path / name
+        path.write_bytes(b'x' * 100)
+        os.utime(path, (now - age, now - age))
+
+    removed, total_size = evict_cache_files(str(tmp_path), max_age=500, max_bytes=150)
+
+    assert (removed, total_size) == (2, 100)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['notes.txt', 'recent.json']
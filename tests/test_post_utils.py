@@ -0,0 +1,136 @@
+from telethon import types
+
+from post_utils import build_channel_posts, choose_photo_size, choose_photo_thumb, deduplicate_posts, format_post_for_prompt
+
+def make_photo():
+    return types.Photo(
+        id=1,
+        access_hash=2,
+        file_reference=b'ref',
+        date=None,
+        sizes=[
+            types.PhotoStrippedSize(type='i', bytes=b'\x01\x02'),
+            types.PhotoSize(type='m', w=320, h=240, size=10000),
+            types.PhotoSize(type='x', w=800, h=600, size=50000),
+            types.PhotoSizeProgressive(type='y', w=1280, h=960, sizes=[20000, 60000, 120000]),
+        ],
+        dc_id=2
+    )
+
+def test_choose_photo_size_picks_smallest_size_above_limit():
+    photo = make_photo()
+    assert choose_photo_size(photo, 700).type == 'x'
+    assert choose_photo_size(photo, 1280).type == 'y'
+    # Все размеры меньше лимита - самый большой
+    assert choose_photo_size(photo, 5000).type == 'y'
+
+def test_choose_photo_thumb_returns_size_type():
+    photo = make_photo()
+    # Прогрессивный размер передается в download_media по типу, а не объектом
+    assert choose_photo_thumb(photo, 1280) == 'y'
+    assert choose_photo_thumb(photo, 700) == 'x'
+
+def test_choose_photo_thumb_without_sized_entries():
+    photo = make_photo()
+    photo.sizes = [types.PhotoStrippedSize(type='i', bytes=b'\x01\x02')]
+    assert choose_photo_size(photo, 700) is None
+    assert choose_photo_thumb(photo, 700) is None
+
+
+NEWS = "Глава республики открыл новый детский сад на сто двадцать мест в микрорайоне Затон города Уфы"
+
+
+def make_text_post(text, source, date):
+    return {'date': date, 'text': text, 'has_text': True, 'has_photo': False, 'source': source}
+
+
+def test_deduplicate_keeps_earliest_and_records_other_sources():
+    later = make_text_post(NEWS + " Подробности по ссылке https://t.me/a/1", '@second', '2025-06-10 12:00:00')
+    earliest = make_text_post(NEWS, '@first', '2025-06-10 09:00:00')
+    repost = make_text_post("Срочно! " + NEWS, '@third', '2025-06-10 10:00:00')
+    other = make_text_post("В Стерлитамаке завершили ремонт моста через реку Ашкадар и открыли движение", '@first', '2025-06-10 11:00:00')
+
+    result = deduplicate_posts([later, earliest, repost, other], max_distance=12, min_words=8)
+
+    assert result == [earliest, other]
+    assert earliest['also_in'] == ['@third', '@second']
+    assert 'also_in' not in other
+
+
+def test_deduplicate_ignores_same_source_and_short_posts():
+    first = make_text_post(NEWS, '@first', '2025-06-10 09:00:00')
+    same_channel = make_text_post(NEWS, '@first', '2025-06-10 10:00:00')
+    short_a = make_text_post("Доброе утро!", '@a', '2025-06-10 08:00:00')
+    short_b = make_text_post("Доброе утро!", '@b', '2025-06-10 08:30:00')
+
+    result = deduplicate_posts([first, same_channel, short_a, short_b], max_distance=12, min_words=8)
+
+    assert result == [first, short_a, short_b]
+    assert first['also_in'] == []
+
+
+def test_deduplicate_matches_website_posts_by_url():
+    channel_post = make_text_post(NEWS, '@first', '2025-06-10 09:00:00')
+    article = {'date': '2025-06-10 09:30:00', 'text': NEWS, 'has_text': True, 'source_url': 'https://ufa.ru/news/1'}
+
+    result = deduplicate_posts([article, channel_post], max_distance=12, min_words=8)
+
+    assert result == [channel_post]
+    assert channel_post['also_in'] == ['https://ufa.ru/news/1']
+
+
+def test_deduplicate_finds_every_signature_within_max_distance(monkeypatch):
+    # Отличия во всех полосах сразу: полосы сами по себе не совпадают, нужен multi-probe
+    base = 0x0123456789abcdef
+    for distance, flipped_bits in [(12, [0, 1, 2, 16, 17, 18, 32, 33, 34, 48, 49, 50]), (13, list(range(0, 64, 5))[:13])]:
+        near = base
+        for bit in flipped_bits:
+            near ^= 1 << bit
+        signatures = iter([base, near])
+        monkeypatch.setattr('post_utils.simhash', lambda words: next(signatures))
+        first = make_text_post(NEWS, '@first', '2025-06-10 09:00:00')
+        second = make_text_post(NEWS, '@second', '2025-06-10 10:00:00')
+
+        result = deduplicate_posts([first, second], max_distance=12, min_words=8)
+
+        assert len(result) == (1 if distance <= 12 else 2)
+
+
+def test_format_post_for_prompt_lists_other_sources():
+    post = make_text_post("Текст", '@first', '2025-06-10 09:00:00')
+    post['also_in'] = ['@second', '@third']
+    assert format_post_for_prompt(post) == "[2025-06-10 09:00:00]\nТекст\n(Также опубликовано: @second, @third)"
+
+
+def test_build_channel_posts_coalesces_album():
+    # Сообщения из хранилища идут от новых к старым: (id, дата, текст, есть фото, grouped_id)
+    stored = [
+        (13, 1749549720, '', True, 777),
+        (12, 1749549660, 'Подпись альбома', True, 777),
+        (11, 1749549600, '', True, 777),
+        (10, 1749546000, 'Отдельный пост', False, None),
+    ]
+
+    posts = build_channel_posts('@channel', stored)
+
+    assert len(posts) == 2
+    album, single = posts
+    assert album['text'] == 'Подпись альбома'
+    assert album['has_text'] and album['has_photo']
+    assert [ref['message_id'] for ref in album['photo_refs']] == [11, 12, 13]
+    assert album['date'] == '2025-06-10 10:00:00'
+    assert single == {
+        'date': '2025-06-10 09:00:00',
+        'has_text': True,
+        'text': 'Отдельный пост',
+        'has_photo': False,
+        'photo_paths': [],
+        'photo_refs': []
+    }
+
+
+def test_build_channel_posts_album_without_caption():
+    posts = build_channel_posts('@channel', [(2, 1749549660, '', True, 5), (1, 1749549600, '  ', True, 5)])
+    assert len(posts) == 1
+    assert not posts[0]['has_text']
+    assert len(posts[0]['photo_refs']) == 2
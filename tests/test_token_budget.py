@@ -0,0 +1,78 @@
+import json
+
+import token_budget
+from token_budget import TokenCalibration, estimate_raw_tokens, pack_posts, post_priority
+
+
+def make_post(date, text='текст', also_in=None, has_text=True):
+    return {'date': date, 'text': text, 'has_text': has_text, 'also_in': also_in or []}
+
+
+def test_pack_posts_keeps_everything_within_budget():
+    posts = [make_post('2024-01-01 10:00:00'), make_post('2024-01-01 11:00:00')]
+    kept, dropped = pack_posts(posts, budget=100, cost_func=lambda post: 10)
+    assert kept == posts
+    assert dropped == []
+
+
+def test_pack_posts_prefers_cross_posted_then_text_then_fresh():
+    old_repost = make_post('2024-01-01 08:00:00', also_in=['@other'])
+    fresh = make_post('2024-01-01 12:00:00')
+    old = make_post('2024-01-01 09:00:00')
+    photo_only = make_post('2024-01-01 13:00:00', text='', has_text=False)
+    posts = [old_repost, fresh, old, photo_only]
+
+    kept, dropped = pack_posts(posts, budget=20, cost_func=lambda post: 10)
+
+    assert kept == [old_repost, fresh]
+    assert dropped == [old, photo_only]
+
+
+def test_pack_posts_fills_budget_with_smaller_posts_after_skipping():
+    big = make_post('2024-01-01 12:00:00', text='x' * 100)
+    small = make_post('2024-01-01 11:00:00', text='x')
+    kept, dropped = pack_posts([small, big], budget=50, cost_func=lambda post: len(post['text']))
+    assert kept == [small]
+    assert dropped == [big]
+
+
+def test_pack_posts_keeps_original_order():
+    posts = [make_post(f'2024-01-01 {hour:02d}:00:00') for hour in range(5)]
+    kept, _ = pack_posts(posts, budget=30, cost_func=lambda post: 10)
+    assert kept == posts[2:]
+
+
+def test_post_priority_orders_by_sources_count_first():
+    assert post_priority(make_post('2024-01-01', also_in=['@a', '@b'])) > post_priority(make_post('2024-12-31'))
+
+
+def test_calibration_saves_in_batches(tmp_path):
+    path = tmp_path / 'calibration.json'
+    calibration = TokenCalibration(str(path), save_interval=3600)
+
+    calibration.update('model', estimated=100, actual=150)
+    calibration.update('model', estimated=100, actual=150)
+    assert not path.exists()
+
+    calibration.flush()
+    saved = json.loads(path.read_text(encoding='utf-8'))
+    assert saved['model']['samples'] == 2
+    assert saved['model']['factor'] == calibration.get_factor('model')
+
+
+def test_calibration_saves_when_interval_passed(tmp_path):
+    path = tmp_path / 'calibration.json'
+    calibration = TokenCalibration(str(path), save_interval=0)
+    calibration.update('model', estimated=100, actual=200)
+    assert json.loads(path.read_text(encoding='utf-8'))['model']['factor'] == 2.0
+
+
+def test_calibration_factor_is_clamped(tmp_path):
+    calibration = TokenCalibration(str(tmp_path / 'calibration.json'), save_interval=3600)
+    calibration.update('model', estimated=100, actual=10000)
+    assert calibration.get_factor('model') == token_budget.CALIBRATION_MAX_FACTOR
+
+
+def test_estimate_raw_tokens_counts_cyrillic_denser_than_latin():
+    assert estimate_raw_tokens('привет') > estimate_raw_tokens('hello!')
+    assert estimate_raw_tokens('') == 0.0
@@ -0,0 +1,195 @@
+from lxml import html as lxml_html
+
+from web_extract import (
+    extract_fallback, find_feed_links, find_main_element, link_density, parse_feed, parse_feed_date,
+    parse_html, parse_sitemap, selector_to_xpath
+)
+
+
+def test_parse_feed_date_rfc822_is_converted_to_utc():
+    parsed = parse_feed_date('Tue, 10 Jun 2025 15:30:00 +0300')
+    assert parsed.isoformat() == '2025-06-10T12:30:00+00:00'
+
+
+def test_parse_feed_date_iso_with_z_and_naive():
+    assert parse_feed_date('2025-06-10T12:30:00Z').isoformat() == '2025-06-10T12:30:00+00:00'
+    assert parse_feed_date('2025-06-10').isoformat() == '2025-06-10T00:00:00+00:00'
+
+
+def test_parse_feed_date_rejects_garbage():
+    assert parse_feed_date('вчера') is None
+    assert parse_feed_date('') is None
+    assert parse_feed_date(None) is None
+
+
+def test_parse_rss_items():
+    xml = '''<?xml version="1.0"?>
+    <rss version="2.0"><channel>
+      <title>Новости</title>
+      <item>
+        <title>Первая</title>
+        <link>https://example.com/1</link>
+        <pubDate>Tue, 10 Jun 2025 15:30:00 +0300</pubDate>
+      </item>
+      <item>
+        <title>Без даты</title>
+        <link>https://example.com/2</link>
+      </item>
+    </channel></rss>'''
+    assert parse_feed(xml) == [
+        {'url': 'https://example.com/1', 'title': 'Первая', 'published': '2025-06-10T12:30:00+00:00'},
+        {'url': 'https://example.com/2', 'title': 'Без даты', 'published': None},
+    ]
+
+
+def test_parse_atom_prefers_published_over_updated():
+    xml = '''<feed xmlns="http://www.w3.org/2005/Atom">
+      <entry>
+        <title>Статья</title>
+        <link rel="alternate" href="https://example.com/a"/>
+        <link rel="edit" href="https://example.com/edit/a"/>
+        <updated>2025-06-12T00:00:00Z</updated>
+        <published>2025-06-10T08:00:00Z</published>
+      </entry>
+      <entry>
+        <title>Только updated</title>
+        <link href="https://example.com/b"/>
+        <updated>2025-06-11T00:00:00+03:00</updated>
+      </entry>
+    </feed>'''
+    articles = parse_feed(xml)
+    assert articles[0]['url'] == 'https://example.com/a'
+    assert articles[0]['published'] == '2025-06-10T08:00:00+00:00'
+    assert articles[1]['published'] == '2025-06-10T21:00:00+00:00'
+
+
+def test_parse_rss_dublin_core_date():
+    xml = '''<rss xmlns:dc="http://purl.org/dc/elements/1.1/"><channel><item>
+      <link>https://example.com/dc</link>
+      <dc:date>2025-06-10T10:00:00+00:00</dc:date>
+    </item></channel></rss>'''
+    assert parse_feed(xml)[0]['published'] == '2025-06-10T10:00:00+00:00'
+
+
+def test_parse_sitemap_urls_and_news_publication_date():
+    xml = '''<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"
+                     xmlns:news="http://www.google.com/schemas/sitemap-news/0.9">
+      <url>
+        <loc>https://example.com/news/1</loc>
+        <lastmod>2025-06-12T00:00:00Z</lastmod>
+        <news:news>
+          <news:publication_date>2025-06-10T09:00:00Z</news:publication_date>
+          <news:title>Новость</news:title>
+        </news:news>
+      </url>
+      <url>
+        <loc>https://example.com/page</loc>
+        <lastmod>2025-06-11</lastmod>
+      </url>
+      <url>
+        <loc>https://example.com/undated</loc>
+      </url>
+    </urlset>'''
+    articles, sitemaps = parse_sitemap(xml)
+    assert sitemaps == []
+    assert articles == [
+        {'url': 'https://example.com/news/1', 'published': '2025-06-10T09:00:00+00:00', 'title': 'Новость'},
+        {'url': 'https://example.com/page', 'published': '2025-06-11T00:00:00+00:00', 'title': None},
+        {'url': 'https://example.com/undated', 'published': None, 'title': None},
+    ]
+
+
+def test_parse_sitemap_index():
+    xml = '''<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+      <sitemap><loc>https://example.com/sitemap-1.xml</loc><lastmod>2025-06-10</lastmod></sitemap>
+      <sitemap><loc>https://example.com/sitemap-2.xml</loc></sitemap>
+    </sitemapindex>'''
+    articles, sitemaps = parse_sitemap(xml)
+    assert articles == []
+    assert sitemaps == [
+        {'url': 'https://example.com/sitemap-1.xml', 'published': '2025-06-10T00:00:00+00:00'},
+        {'url': 'https://example.com/sitemap-2.xml', 'published': None},
+    ]
+
+
+def test_find_feed_links_resolves_relative_urls():
+    html = '''<html><head>
+      <link rel="alternate" type="application/rss+xml" href="/rss.xml">
+      <link rel="alternate" type="application/atom+xml" href="https://example.com/atom">
+      <link rel="stylesheet" href="/style.css">
+    </head><body></body></html>'''
+    assert find_feed_links(html, 'https://example.com/news/') == [
+        'https://example.com/rss.xml',
+        'https://example.com/atom',
+    ]
+
+
+ARTICLE_PARAGRAPHS = [
+    "Власти Уфы объявили о начале ремонта улицы Ленина, работы продлятся до конца сентября, движение ограничат частично.",
+    "По словам мэрии, подрядчик заменит покрытие, бордюры и освещение, а также обустроит новые пешеходные переходы.",
+    "Жителей просят заранее планировать маршруты, автобусы на время ремонта пойдут в объезд по соседним улицам.",
+]
+
+LINK_HEAVY_SIDEBAR = """
+<div class="sidebar">
+  <p><a href="/1">Самые читаемые новости недели, подборка, рейтинг, лучшее, главное за сутки</a></p>
+  <p><a href="/2">Погода в Уфе на выходные, прогноз синоптиков, осадки, ветер, температура</a></p>
+  <p><a href="/3">Курс валют на сегодня, доллар, евро, юань, биржевые котировки и новости</a></p>
+  <p><a href="/4">Афиша города, концерты, выставки, спектакли, кино и события на неделю</a></p>
+</div>
+"""
+
+
+def make_page(body: str) -> str:
+    return f"<html><head><title>Новости</title></head><body>{body}</body></html>"
+
+
+def test_find_main_element_prefers_article_over_link_heavy_sidebar():
+    article = ''.join(f"<p>{text}</p>" for text in ARTICLE_PARAGRAPHS)
+    root = parse_html(make_page(f'{LINK_HEAVY_SIDEBAR}<div id="story">{article}</div>'))
+
+    main_element = find_main_element(root)
+
+    assert main_element.get('id') == 'story'
+
+
+def test_link_density_of_sidebar_and_article():
+    sidebar = lxml_html.fromstring(LINK_HEAVY_SIDEBAR)
+    article = lxml_html.fromstring(f"<div><p>{ARTICLE_PARAGRAPHS[0]} <a href='/more'>Подробнее</a></p></div>")
+    assert link_density(sidebar, len(sidebar.text_content())) > 0.9
+    assert link_density(article, len(article.text_content())) < 0.1
+
+
+def test_extract_fallback_returns_article_body():
+    article = ''.join(f"<p>{text}</p>" for text in ARTICLE_PARAGRAPHS)
+    html = make_page(f'<nav><a href="/">Главная</a></nav>{LINK_HEAVY_SIDEBAR}<div class="post">{article}</div>')
+
+    content, method = extract_fallback(html)
+
+    assert method == 'readability'
+    assert content == "\n".join(ARTICLE_PARAGRAPHS)
+
+
+def test_selector_to_xpath_matches_whole_class_name():
+    root = parse_html(make_page(
+        '<div class="content-footer">Подвал</div><div class="page content wide">Текст статьи</div>'
+    ))
+    matches = root.xpath(selector_to_xpath('div.content'))
+    assert [element.text for element in matches] == ['Текст статьи']
+    assert selector_to_xpath('article') == '//article'
+
+
+def test_extract_fallback_uses_main_tag_for_short_pages():
+    html = make_page('<div class="menu-block">Меню</div><div class="content">Короткая заметка</div>')
+    assert extract_fallback(html, find_main=True) == ('Короткая заметка', 'main_tag')
+
+
+def test_extract_fallback_boilerplate_only_page_returns_none():
+    html = make_page(
+        '<header><a href="/">Логотип</a></header>'
+        '<nav><a href="/news">Новости</a><a href="/about">О нас</a></nav>'
+        '<script>var counter = 1;</script>'
+        '<footer>© 2025 Все права защищены</footer>'
+    )
+    assert extract_fallback(html)[0] is None
+    assert extract_fallback(html, find_main=True)[0] is None
@@ -0,0 +1,156 @@
+"""
+Оценка числа токенов и упаковка постов в бюджет контекста модели
+
+Точный токенизатор у каждого провайдера свой, поэтому токены оцениваются по классам
+символов (кириллица, латиница, цифры, пробелы, прочее). Поправочный коэффициент для
+каждой модели уточняется по фактическому числу токенов из ответов провайдера и
+сохраняется между запусками.
+"""
+import json
+import logging
+import math
+import os
+import re
+import time
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Файл с поправочными коэффициентами моделей
+TOKEN_CALIBRATION_FILE = os.getenv('TOKEN_CALIBRATION_FILE', 'token_calibration.json')
+
+# Вес нового замера при обновлении коэффициента и допустимые границы коэффициента
+CALIBRATION_SMOOTHING = float(os.getenv('CALIBRATION_SMOOTHING', '0.2'))
+CALIBRATION_MIN_FACTOR = 0.5
+CALIBRATION_MAX_FACTOR = 2.5
+
+# Как часто (в секундах) сохранять обновленные коэффициенты в файл
+CALIBRATION_SAVE_INTERVAL = int(os.getenv('CALIBRATION_SAVE_INTERVAL', '300'))
+
+# Сколько символов каждого класса в среднем приходится на один токен
+CHARS_PER_TOKEN = {
+    'cyrillic': 2.6,
+    'latin': 4.0,
+    'digit': 2.5,
+    'space': 8.0,
+    'other': 1.2
+}
+
+CHAR_CLASSES = {
+    'cyrillic': re.compile(r'[а-яА-ЯёЁ]'),
+    'latin': re.compile(r'[a-zA-Z]'),
+    'digit': re.compile(r'[0-9]'),
+    'space': re.compile(r'\s')
+}
+
+def count_char_classes(text: str) -> dict:
+    """Число символов каждого класса в тексте"""
+    counts = {name: len(pattern.findall(text)) for name, pattern in CHAR_CLASSES.items()}
+    counts['other'] = len(text) - sum(counts.values())
+    return counts
+
+def estimate_raw_tokens(text: str) -> float:
+    """Оценка числа токенов без поправки на модель"""
+    if not text:
+        return 0.0
+    counts = count_char_classes(text)
+    return sum(count / CHARS_PER_TOKEN[name] for name, count in counts.items())
+
+class TokenCalibration:
+    """
+    Поправочные коэффициенты оценки токенов по моделям
+
+    Коэффициент - сглаженное отношение фактического числа токенов (usage.prompt_tokens
+    из ответа провайдера) к оценке estimate_raw_tokens. Изменения пишутся в файл не
+    чаще раза в save_interval секунд, остаток сохраняет flush при остановке бота.
+    """
+    def __init__(self, path: str, save_interval: int = CALIBRATION_SAVE_INTERVAL):
+        self.path = path
+        self.save_interval = save_interval
+        self.factors = self.load()
+        self.dirty = False
+        self.saved_at = time.monotonic()
+
+    def load(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить калибровку токенов: {str(e)}")
+            return {}
+
+    def save(self):
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.factors, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить калибровку токенов: {str(e)}")
+
+    def flush(self):
+        """Сохраняет коэффициенты, если они менялись после последнего сохранения"""
+        if self.dirty:
+            self.save()
+            self.dirty = False
+        self.saved_at = time.monotonic()
+
+    def get_factor(self, model: Optional[str]) -> float:
+        entry = self.factors.get(model) if model else None
+        return entry['factor'] if entry else 1.0
+
+    def update(self, model: str, estimated: float, actual: int):
+        """Учитывает замер: estimated - оценка без поправки, actual - токены по данным провайдера"""
+        if not model or estimated <= 0 or not actual:
+            return
+        ratio = min(max(actual / estimated, CALIBRATION_MIN_FACTOR), CALIBRATION_MAX_FACTOR)
+        entry = self.factors.get(model)
+        if entry:
+            entry['factor'] = entry['factor'] * (1 - CALIBRATION_SMOOTHING) + ratio * CALIBRATION_SMOOTHING
+            entry['samples'] += 1
+        else:
+            entry = self.factors[model] = {'factor': ratio, 'samples': 1}
+        logger.info(f"Калибровка токенов для {model}: оценка {estimated:.0f}, факт {actual}, коэффициент {entry['factor']:.3f}")
+        self.dirty = True
+        if time.monotonic() - self.saved_at >= self.save_interval:
+            self.flush()
+
+token_calibration = TokenCalibration(TOKEN_CALIBRATION_FILE)
+
+def estimate_tokens(text: str, model: Optional[str] = None) -> int:
+    """Оценка числа токенов текста с поправкой на модель"""
+    if not text:
+        return 0
+    return math.ceil(estimate_raw_tokens(text) * token_calibration.get_factor(model))
+
+def post_priority(post: dict) -> tuple:
+    """
+    Приоритет поста при нехватке места: сначала новости, опубликованные в нескольких
+    источниках, затем посты с текстом, затем более свежие
+    """
+    return (len(post.get('also_in') or []), bool(post.get('has_text')), post.get('date', ''))
+
+def pack_posts(posts: list, budget: int, cost_func: Callable[[dict], int],
+               priority_func: Callable[[dict], tuple] = post_priority) -> Tuple[List[dict], List[dict]]:
+    """
+    Заполняет бюджет токенов постами в порядке убывания приоритета
+
+    Пост, который не помещается, пропускается, а следующие (менее важные, но короткие)
+    еще могут поместиться.
+
+    Returns:
+        Кортеж (вошедшие посты в исходном порядке, не вошедшие посты)
+    """
+    used = 0
+    kept = set()
+    for index in sorted(range(len(posts)), key=lambda i: priority_func(posts[i]), reverse=True):
+        cost = cost_func(posts[index])
+        if used + cost <= budget:
+            kept.add(index)
+            used += cost
+
+    packed = [post for index, post in enumerate(posts) if index in kept]
+    dropped = [post for index, post in enumerate(posts) if index not in kept]
+    if dropped:
+        logger.info(f"В бюджет {budget} токенов вошло {len(packed)} постов из {len(posts)} ({used} токенов)")
+    return packed, dropped
@@ -0,0 +1,268 @@
+"""Извлечение текста из HTML страниц и разбор RSS/Atom-лент и sitemap"""
+import logging
+import re
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import List, Optional, Tuple
+from urllib.parse import urljoin
+from xml.etree import ElementTree
+import trafilatura
+from lxml import etree
+from lxml import html as lxml_html
+
+logger = logging.getLogger(__name__)
+
+# Элементы, которые никогда не относятся к основному тексту
+NOISE_TAGS = ('head', 'script', 'style', 'noscript', 'nav', 'footer', 'header', 'aside', 'form', 'iframe', 'svg', 'button')
+
+# Типичные контейнеры основного контента (тег или тег.класс), в порядке приоритета
+MAIN_SELECTORS = ('article', 'main', 'div.content', 'div.main', 'div.article', 'body')
+
+# Подсказки в class/id, повышающие и понижающие оценку блока
+POSITIVE_HINTS = re.compile(r'article|body|content|entry|main|news|page|post|story|text', re.IGNORECASE)
+NEGATIVE_HINTS = re.compile(r'ad-|banner|comment|footer|menu|meta|nav|promo|related|share|sidebar|social|subscribe|widget', re.IGNORECASE)
+
+# Минимальная длина абзаца, который учитывается при оценке блоков
+MIN_PARAGRAPH_LENGTH = 25
+
+def extract_content(html: str, find_main: bool = False) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Извлекает основной текст страницы
+
+    Функция выполняется в отдельном процессе пула извлечения, поэтому не должна
+    зависеть от состояния бота.
+
+    Args:
+        html: HTML страницы
+        find_main: если текста слишком мало, искать основной контент по типичным тегам
+
+    Returns:
+        Кортеж (текст, способ извлечения); текст None, если извлечь ничего не удалось
+    """
+    # Используем trafilatura для извлечения основного текста
+    content = trafilatura.extract(html, include_comments=False, include_tables=True,
+                                  include_links=True, include_images=False)
+    if content:
+        return content, 'trafilatura'
+
+    # Запасной разбор, если trafilatura не справилась
+    return extract_fallback(html, find_main)
+
+def selector_to_xpath(selector: str) -> str:
+    """Переводит селектор вида 'tag' или 'tag.class' в XPath с точным совпадением класса"""
+    tag, _, class_name = selector.partition('.')
+    if not class_name:
+        return f"//{tag}"
+    return f"//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')]"
+
+def parse_html(html: str):
+    """Разбирает HTML парсером lxml. None, если документ пустой или не разбирается"""
+    if not html or not html.strip():
+        return None
+    try:
+        # Строку с XML-декларацией lxml не принимает, поэтому передаем байты
+        parser = lxml_html.HTMLParser(encoding='utf-8', remove_comments=True)
+        return lxml_html.fromstring(html.encode('utf-8', errors='replace'), parser=parser)
+    except (etree.ParserError, ValueError):
+        return None
+
+def element_text(element) -> str:
+    """Текст элемента: непустые фрагменты через перевод строки"""
+    return "\n".join(part.strip() for part in element.itertext() if part.strip())
+
+def class_weight(element) -> int:
+    """Поправка к оценке блока по его class и id"""
+    weight = 0
+    for hint in (element.get('class'), element.get('id')):
+        if hint:
+            if NEGATIVE_HINTS.search(hint):
+                weight -= 25
+            if POSITIVE_HINTS.search(hint):
+                weight += 25
+    return weight
+
+def link_density(element, text_length: int) -> float:
+    """Доля текста элемента, приходящаяся на ссылки"""
+    if not text_length:
+        return 0.0
+    link_length = sum(len(link.text_content()) for link in element.iter('a'))
+    return min(1.0, link_length / text_length)
+
+def find_main_element(root):
+    """
+    Ищет блок с основным текстом по оценкам, как в Readability
+    
+    Каждый абзац добавляет очки родителю и половину - прародителю: за сам абзац, за
+    запятые и за длину. Итоговая оценка блока учитывает class/id и снижается
+    пропорционально доле текста в ссылках.
+    """
+    scores = {}
+    for paragraph in root.iter('p', 'pre', 'td', 'blockquote'):
+        text = paragraph.text_content().strip()
+        if len(text) < MIN_PARAGRAPH_LENGTH:
+            continue
+        score = 1 + text.count(',') + min(len(text) // 100, 3)
+        parent = paragraph.getparent()
+        for ancestor, share in ((parent, 1.0), (parent.getparent() if parent is not None else None, 0.5)):
+            if ancestor is None or not isinstance(ancestor.tag, str):
+                continue
+            if ancestor not in scores:
+                scores[ancestor] = class_weight(ancestor)
+            scores[ancestor] += score * share
+    
+    best = None
+    best_score = 0.0
+    for element, score in scores.items():
+        score *= 1 - link_density(element, len(element.text_content()))
+        if score > best_score:
+            best, best_score = element, score
+    return best
+
+def extract_fallback(html: str, find_main: bool = False) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Запасное извлечение текста, если trafilatura ничего не нашла
+    
+    Returns:
+        Кортеж (текст, способ извлечения): 'readability' - найден блок с основным текстом,
+        'lxml' - текст всей страницы, 'main_tag' - текст типичного контейнера контента
+    """
+    root = parse_html(html)
+    if root is None:
+        return None, 'lxml'
+    
+    # Удаляем скрипты, стили и другие ненужные элементы
+    etree.strip_elements(root, *NOISE_TAGS, with_tail=False)
+    
+    main_element = find_main_element(root)
+    if main_element is not None:
+        content = element_text(main_element)
+        if len(content) >= 100:
+            return content, 'readability'
+    
+    content = element_text(root)
+    if content and len(content) >= 100:
+        return content, 'lxml'
+    
+    if find_main:
+        # Пробуем найти основной контент по типичным тегам
+        for selector in MAIN_SELECTORS:
+            matches = root.xpath(selector_to_xpath(selector))
+            if matches:
+                return element_text(matches[0]) or None, 'main_tag'
+    
+    return content or None, 'lxml'
+
+def local_name(tag: str) -> str:
+    """Имя XML-тега без пространства имен"""
+    return tag.rsplit('}', 1)[-1].lower() if isinstance(tag, str) else ''
+
+def parse_feed_date(value: Optional[str]) -> Optional[datetime]:
+    """Разбирает дату из RSS (RFC 822), Atom или sitemap (ISO 8601) и приводит ее к UTC"""
+    if not value:
+        return None
+    value = value.strip()
+    parsed = None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if parsed is None:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+def find_feed_links(html: str, base_url: str) -> List[str]:
+    """Находит ссылки на RSS/Atom-ленты в <link rel="alternate"> страницы"""
+    root = parse_html(html)
+    if root is None:
+        return []
+    feeds = []
+    for link in root.iter('link'):
+        rel = (link.get('rel') or '').lower().split()
+        link_type = (link.get('type') or '').lower()
+        if 'alternate' in rel and link_type in ('application/rss+xml', 'application/atom+xml') and link.get('href'):
+            feed_url = urljoin(base_url, link.get('href').strip())
+            if feed_url not in feeds:
+                feeds.append(feed_url)
+    return feeds
+
+def parse_feed(xml_text: str) -> List[dict]:
+    """
+    Разбирает RSS или Atom-ленту
+
+    Returns:
+        Список статей {'url', 'title', 'published'}; published - ISO-строка в UTC или None
+    """
+    root = ElementTree.fromstring(xml_text)
+    articles = []
+    for item in root.iter():
+        if local_name(item.tag) not in ('item', 'entry'):
+            continue
+        url = None
+        title = None
+        published = None
+        for child in item:
+            name = local_name(child.tag)
+            if name == 'link':
+                # В RSS ссылка в тексте тега, в Atom - в атрибуте href
+                href = child.get('href')
+                if href and child.get('rel', 'alternate') == 'alternate':
+                    url = href
+                elif not href and child.text and child.text.strip():
+                    url = child.text.strip()
+            elif name == 'title' and child.text:
+                title = child.text.strip()
+            elif name in ('pubdate', 'published', 'date') and child.text:
+                published = parse_feed_date(child.text) or published
+            elif name == 'updated' and child.text and not published:
+                published = parse_feed_date(child.text)
+        if url:
+            articles.append({
+                'url': url,
+                'title': title,
+                'published': published.isoformat() if published else None
+            })
+    return articles
+
+def parse_sitemap(xml_text: str) -> Tuple[List[dict], List[dict]]:
+    """
+    Разбирает sitemap или индекс sitemap
+
+    Returns:
+        Кортеж (статьи, вложенные sitemap). Статьи - {'url', 'title', 'published'},
+        вложенные sitemap - {'url', 'published'}
+    """
+    root = ElementTree.fromstring(xml_text)
+    articles = []
+    sitemaps = []
+    for entry in root:
+        name = local_name(entry.tag)
+        if name not in ('url', 'sitemap'):
+            continue
+        url = None
+        title = None
+        published = None
+        for child in entry.iter():
+            child_name = local_name(child.tag)
+            if child_name == 'loc' and child.text:
+                url = child.text.strip()
+            elif child_name == 'title' and child.text:
+                title = child.text.strip()
+            elif child_name == 'publication_date' and child.text:
+                # Дата публикации из news-sitemap точнее, чем lastmod
+                published = parse_feed_date(child.text) or published
+            elif child_name == 'lastmod' and child.text and not published:
+                published = parse_feed_date(child.text)
+        if not url:
+            continue
+        item = {'url': url, 'published': published.isoformat() if published else None}
+        if name == 'sitemap':
+            sitemaps.append(item)
+        else:
+            item['title'] = title
+            articles.append(item)
+    return articles, sitemaps